@@ -9,6 +9,8 @@ import json
 import uuid
 import secrets
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, date, timedelta
 from functools import wraps
@@ -22,9 +24,19 @@ from flask_wtf.csrf import CSRFProtect, generate_csrf
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from werkzeug.utils import secure_filename
 
 from google_sheets import db
+from chat_store import chat_store, PAGE_SIZE as CHAT_PAGE_SIZE
+from presence import presence
+from chat_unread import unread_tracker
+from search_index import search_index, KINDS as SEARCH_KINDS
+from blob_store import blob_store
+from chunked_upload import upload_sessions, OffsetMismatch, CHUNK_SIZE as UPLOAD_CHUNK_SIZE
+from thumbnails import thumbnailer
+from file_serving import send_upload
+from metrics import metrics
+from ratelimit import rate_limiter, sheets_governor
+from socketio_queue import queue_options
 
 # ---------------------------------------------------------------------------
 # App setup
@@ -59,8 +71,16 @@ def inject_csrf_token(response):
         response.set_cookie('csrf_token', generate_csrf(), samesite='Lax')
     return response
 
-# SocketIO for real-time chat
-socketio = SocketIO(app, cors_allowed_origins="*", manage_session=False)
+@app.before_request
+def start_chat_flusher():
+    """
+    Replay chat messages journaled before a restart under any runner, not
+    only gunicorn's post_fork (once per process; later calls are a check).
+    """
+    chat_store.start_flusher(db)
+
+# SocketIO for real-time chat (relayed between workers, see socketio_queue.py)
+socketio = SocketIO(app, cors_allowed_origins="*", manage_session=False, **queue_options())
 
 BUSINESSES = ["Unithread", "Merchoteket"]
 
@@ -103,12 +123,73 @@ def _verify_password(pw, hashed):
     return hashlib.sha256(pw.encode()).hexdigest() == hashed
 
 
-def _upgrade_password_if_needed(users, user_dict, pw):
+# bcrypt is slow on purpose; a few OS threads keep it off the SocketIO loop
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", 2))
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+
+def _in_password_pool(func, *args):
+    """
+    Run a bcrypt call (hash or verify) in the small password thread pool.
+    bcrypt releases the GIL, so under eventlet/gevent the event loop keeps
+    serving other requests and SocketIO traffic while a login is checked.
+    """
+    global _password_pool
+    if socketio.async_mode == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(func, *args)
+    with _password_pool_lock:
+        if _password_pool is None:
+            if socketio.async_mode == "gevent":
+                from gevent.threadpool import ThreadPool
+                _password_pool = ThreadPool(PASSWORD_WORKERS)
+            else:
+                _password_pool = ThreadPoolExecutor(PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+    if socketio.async_mode == "gevent":
+        return _password_pool.apply(func, args)
+    return _password_pool.submit(func, *args).result()
+
+
+class _UserIndex:
+    """
+    username → user row over the cached users sheet. Rebuilt only when
+    db.load_data returns a new list (cache refreshed, or invalidated by a
+    write), and dropped by the user admin routes after they write.
+    """
+
+    def __init__(self):
+        self._source = None
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        users = db.load_data("users")
+        with self._lock:
+            if users is not self._source:
+                by_name = {}
+                for u in users:
+                    by_name.setdefault(u.get("username"), u)
+                self._by_name = by_name
+                self._source = users
+            return self._by_name.get(username)
+
+    def invalidate(self):
+        with self._lock:
+            self._source = None
+            self._by_name = {}
+
+
+_user_index = _UserIndex()
+
+
+def _upgrade_password_if_needed(user_dict, pw):
     """Upgrade legacy SHA-256 hash to bcrypt on successful login."""
     hashed = user_dict.get('password_hash', '')
     if not (hashed.startswith('$2b$') or hashed.startswith('$2a$')):
-        user_dict['password_hash'] = _hash_password(pw)
-        db.save_data('users', users)
+        new_hash = _in_password_pool(_hash_password, pw)
+        db.update_row('users', 'username', user_dict.get('username'), {'password_hash': new_hash})
+        _user_index.invalidate()
 
 
 def _validate_amount(value, field_name='belopp'):
@@ -205,7 +286,27 @@ def index():
 @app.route("/uploads/<path:filename>")
 @login_required
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    return send_upload(app.config["UPLOAD_FOLDER"], filename)
+
+
+def _send_thumbnail(folder, filename):
+    """A small JPEG of an uploaded image or PDF (first page), ?w= pixels wide."""
+    try:
+        width = int(request.args.get("w", 320))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Ogiltig bredd"}), 400
+    if "/" in filename or filename.startswith("."):
+        return jsonify({"ok": False, "error": "Fil hittades inte"}), 404
+    path = thumbnailer.get(folder, filename, width)
+    if path is None:
+        return jsonify({"ok": False, "error": "Ingen förhandsvisning"}), 404
+    return send_upload(folder, f"thumbs/{path.name}")
+
+
+@app.route("/uploads/<filename>/thumb")
+@login_required
+def uploaded_file_thumbnail(filename):
+    return _send_thumbnail(app.config["UPLOAD_FOLDER"], filename)
 
 
 # ---------------------------------------------------------------------------
@@ -223,18 +324,17 @@ def api_login():
     if not username or not password:
         return jsonify({"ok": False, "error": "Ange användarnamn och lösenord"}), 400
 
-    users = db.load_data("users")
-    for u in users:
-        if u.get("username") == username:
-            if _verify_password(password, u.get("password_hash", "")):
-                _upgrade_password_if_needed(users, u, password)
-                session["user"] = username
-                session["role"] = u.get("role", "user")
-                session["permissions"] = _parse_permissions(u.get("permissions"))
-                _log_activity(username, "Loggade in")
-                return jsonify({"ok": True, "user": username, "role": session["role"]})
-            return jsonify({"ok": False, "error": "Fel lösenord"}), 401
-    return jsonify({"ok": False, "error": "Användaren finns inte"}), 401
+    u = _user_index.get(username)
+    if u is None:
+        return jsonify({"ok": False, "error": "Användaren finns inte"}), 401
+    if not _in_password_pool(_verify_password, password, u.get("password_hash", "")):
+        return jsonify({"ok": False, "error": "Fel lösenord"}), 401
+    _upgrade_password_if_needed(u, password)
+    session["user"] = username
+    session["role"] = u.get("role", "user")
+    session["permissions"] = _parse_permissions(u.get("permissions"))
+    _log_activity(username, "Loggade in")
+    return jsonify({"ok": True, "user": username, "role": session["role"]})
 
 
 @app.route("/api/logout", methods=["POST"])
@@ -444,6 +544,7 @@ def add_expense():
         expense["belopp"] * expense["moms_sats"] / (100 + expense["moms_sats"]), 2
     )
     db.append_row("expenses", expense)
+    search_index.put("expenses", expense)
     _log_activity(session["user"], "Lade till utgift",
                   f"{expense['beskrivning']} — {expense['belopp']} kr ({expense['bolag']})")
     return jsonify({"ok": True, "expense": expense})
@@ -461,6 +562,7 @@ def update_expense(eid):
                 belopp = float(row.get("belopp", 0))
                 sats = int(row.get("moms_sats", 25))
                 row["moms_belopp"] = round(belopp * sats / (100 + sats), 2)
+            search_index.put("expenses", row)
             break
     db.save_data("expenses", data)
     _log_activity(session["user"], "Uppdaterade utgift", eid)
@@ -473,6 +575,8 @@ def delete_expense(eid):
     data = db.load_data("expenses")
     data = [e for e in data if str(e.get("id")) != eid]
     db.save_data("expenses", data)
+    source_index.forget_row("expenses", eid)
+    search_index.remove("expenses", eid)
     _log_activity(session["user"], "Raderade utgift", eid)
     return jsonify({"ok": True})
 
@@ -529,6 +633,7 @@ def delete_revenue(rid):
     data = db.load_data("revenue")
     data = [r for r in data if str(r.get("id")) != rid]
     db.save_data("revenue", data)
+    source_index.forget_row("revenue", rid)
     _log_activity(session["user"], "Raderade intäkt", rid)
     return jsonify({"ok": True})
 
@@ -697,16 +802,19 @@ def add_receipt():
     kategori = request.form.get("kategori", "Övrigt")
     datum = request.form.get("datum", date.today().isoformat())
 
-    # Handle file uploads
+    # Files sent in chunks beforehand (see chunked_upload.py)
+    try:
+        file_paths = [name for name, _ in _claim_uploads("receipts")]
+    except (LookupError, PermissionError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    # Handle file uploads (stored once per content, see blob_store.py)
     files = request.files.getlist("files")
-    file_paths = []
     for f in files:
         if f and f.filename:
-            fname = f"{uuid.uuid4().hex[:8]}_{secure_filename(f.filename)}"
-            save_path = app.config["UPLOAD_FOLDER"] / fname
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-            f.save(str(save_path))
-            file_paths.append(fname)
+            file_paths.append(blob_store.put("receipts", app.config["UPLOAD_FOLDER"], f.stream, f.filename))
+    for fname in file_paths:
+        thumbnailer.schedule(app.config["UPLOAD_FOLDER"], fname)
 
     receipt = {
         "id": str(uuid.uuid4())[:8],
@@ -846,22 +954,48 @@ def delete_todo(tid):
 # Chat API
 # ---------------------------------------------------------------------------
 
+def _chat_members(group):
+    members = group.get("members", "[]")
+    if isinstance(members, str):
+        try:
+            members = json.loads(members)
+        except Exception:
+            members = []
+    return members if isinstance(members, list) else []
+
+
+def _chat_group(gid):
+    for g in db.load_data("chat_groups"):
+        if str(g.get("id")) == str(gid):
+            return g
+    return None
+
+
+def _push_unread(user, gid):
+    """Send a user's unread count and latest message for a group to all their sockets."""
+    summary = unread_tracker.summaries(user, [gid])[str(gid)]
+    socketio.emit("unread", {"group_id": gid, **summary}, room=f"user_{user}")
+
+
 @app.route("/api/chat/groups", methods=["GET"])
 @login_required
 def get_chat_groups():
+    """The user's groups with unread counts and the newest message of each."""
     groups = db.load_data("chat_groups")
     user = session["user"]
     result = []
     for g in groups:
-        members = g.get("members", "[]")
-        if isinstance(members, str):
-            try:
-                members = json.loads(members)
-            except Exception:
-                members = []
+        members = _chat_members(g)
         if user in members or session.get("role") == "admin":
-            g["members"] = members
-            result.append(g)
+            result.append(dict(g, members=members))
+    gids = [str(g.get("id")) for g in result]
+    for gid in unread_tracker.missing(gids):
+        # No summary yet (new group or fresh disk): start from its newest message
+        newest = chat_store.page(db, gid, limit=1)
+        unread_tracker.seed(gid, newest[-1] if newest else None)
+    summaries = unread_tracker.summaries(user, gids)
+    for g in result:
+        g.update(summaries[str(g.get("id"))])
     return jsonify(result)
 
 
@@ -876,8 +1010,9 @@ def create_chat_group():
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "members": json.dumps(d.get("members", [session["user"]]), ensure_ascii=False),
         "archived": False,
+        "partitioned": True,  # messages in their own worksheet, see chat_store.py
     }
-    db.append_row("chat_groups", group)
+    db.append_rows("chat_groups", [group])
     _log_activity(session["user"], "Skapade chattgrupp", group["name"])
     return jsonify({"ok": True, "group": group})
 
@@ -898,12 +1033,11 @@ def delete_chat_group(gid):
         return jsonify({"ok": False, "error": "Grupp hittades inte"}), 404
     if role != "admin" and target.get("created_by") != user:
         return jsonify({"ok": False, "error": "Ingen behörighet"}), 403
-    groups = [g for g in groups if str(g.get("id")) != gid]
-    db.save_data("chat_groups", groups)
-    # Also delete messages belonging to this group
-    messages = db.load_data("chat_messages")
-    messages = [m for m in messages if str(m.get("group_id")) != gid]
-    db.save_data("chat_messages", messages)
+    # Delete the group's messages first (chat_store checks how they are stored)
+    chat_store.drop(db, gid)
+    unread_tracker.forget(gid)
+    search_index.remove_ref("chat", gid)
+    db.delete_row("chat_groups", "id", gid)
     _log_activity(user, "Raderade chattgrupp", target.get("name", gid))
     return jsonify({"ok": True})
 
@@ -911,10 +1045,13 @@ def delete_chat_group(gid):
 @app.route("/api/chat/groups/<gid>/messages", methods=["GET"])
 @login_required
 def get_messages(gid):
-    messages = db.load_data("chat_messages")
-    msgs = [m for m in messages if str(m.get("group_id")) == gid]
-    msgs.sort(key=lambda x: x.get("timestamp", ""))
-    return jsonify(msgs)
+    """The newest messages, oldest first; ?before=<message id> pages back in history."""
+    before = request.args.get("before") or None
+    try:
+        limit = int(request.args.get("limit", CHAT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Ogiltigt värde för limit"}), 400
+    return jsonify(chat_store.page(db, gid, before=before, limit=limit))
 
 
 @app.route("/api/chat/groups/<gid>/messages", methods=["POST"])
@@ -928,15 +1065,35 @@ def send_message(gid):
         "content": d.get("content", ""),
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
-    db.append_row("chat_messages", msg)
+    # Journaled locally and written to Sheets in the background (chat_store.py)
+    chat_store.append(db, gid, msg)
+    search_index.put("chat", msg)
     # Broadcast via WebSocket to all in room
     socketio.emit("new_message", msg, room=f"chat_{gid}")
+    # Unread badges for the other members, wherever they are in the app
+    group = _chat_group(gid)
+    members = _chat_members(group) if group else []
+    unread_tracker.record_message(gid, msg, members)
+    for member in members:
+        if member != msg["sender"]:
+            _push_unread(member, gid)
     return jsonify({"ok": True, "message": msg})
 
 
-    # Broadcast via WebSocket to all in room
-    socketio.emit("new_message", msg, room=f"chat_{gid}")
-    return jsonify({"ok": True, "message": msg})
+@app.route("/api/chat/groups/<gid>/read", methods=["POST"])
+@login_required
+def mark_chat_read(gid):
+    """Mark the group as read up to its newest message (clears the badge in every tab)."""
+    unread_tracker.mark_read(session["user"], gid)
+    _push_unread(session["user"], gid)
+    return jsonify({"ok": True})
+
+
+@app.route("/api/chat/groups/<gid>/presence", methods=["GET"])
+@login_required
+def get_chat_presence(gid):
+    """Users currently connected to the group's chat room."""
+    return jsonify({"group_id": gid, "members": presence.members(gid)})
 
 
 # ---------------------------------------------------------------------------
@@ -1032,12 +1189,10 @@ def delete_project(pid):
     # Delete files belonging to this project
     files = db.load_data("project_files")
     proj_files = [f for f in files if str(f.get("project_id")) == pid]
-    for pf in proj_files:
-        fpath = app.config["PROJECT_UPLOAD_FOLDER"] / pf.get("filename", "")
-        if fpath.exists():
-            fpath.unlink()
     files = [f for f in files if str(f.get("project_id")) != pid]
     db.save_data("project_files", files)
+    for pf in proj_files:
+        _release_project_file(pf.get("filename", ""))
     # Delete related calendar events
     events = db.load_data("calendar_events")
     events = [e for e in events if e.get("project_id") != pid]
@@ -1188,28 +1343,30 @@ def get_project_files(pid):
 @app.route("/api/projects/<pid>/files", methods=["POST"])
 @login_required
 def upload_project_file(pid):
-    """Upload a file to a project."""
-    files = request.files.getlist("files")
-    if not files:
+    """Upload files to a project (multipart "files", or "uploads" ids of chunked uploads)."""
+    try:
+        stored = _claim_uploads("projects")
+    except (LookupError, PermissionError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    for f in request.files.getlist("files"):
+        if f and f.filename:
+            stored.append((blob_store.put("projects", app.config["PROJECT_UPLOAD_FOLDER"], f.stream, f.filename),
+                           f.filename))
+    if not stored:
         return jsonify({"ok": False, "error": "Ingen fil vald"}), 400
     uploaded = []
-    for f in files:
-        if f and f.filename:
-            safe_name = secure_filename(f.filename)
-            fname = f"{uuid.uuid4().hex[:8]}_{safe_name}"
-            save_path = app.config["PROJECT_UPLOAD_FOLDER"] / fname
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-            f.save(str(save_path))
-            file_rec = {
-                "id": f"pfile_{uuid.uuid4().hex[:8]}",
-                "project_id": pid,
-                "filename": fname,
-                "original_name": f.filename,
-                "uploaded_by": session["user"],
-                "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            db.append_row("project_files", file_rec)
-            uploaded.append(file_rec)
+    for fname, original_name in stored:
+        file_rec = {
+            "id": f"pfile_{uuid.uuid4().hex[:8]}",
+            "project_id": pid,
+            "filename": fname,
+            "original_name": original_name,
+            "uploaded_by": session["user"],
+            "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        db.append_row("project_files", file_rec)
+        uploaded.append(file_rec)
+        thumbnailer.schedule(app.config["PROJECT_UPLOAD_FOLDER"], fname)
     _log_activity(session["user"], "Laddade upp projektfil",
                   f"{len(uploaded)} filer till projekt {pid}")
     return jsonify({"ok": True, "files": uploaded})
@@ -1226,46 +1383,182 @@ def delete_project_file(pid, fid):
             break
     if not target:
         return jsonify({"ok": False, "error": "Fil hittades inte"}), 404
-    # Delete physical file
-    fpath = app.config["PROJECT_UPLOAD_FOLDER"] / target.get("filename", "")
-    if fpath.exists():
-        fpath.unlink()
     files = [f for f in files if str(f.get("id")) != fid]
     db.save_data("project_files", files)
+    # Other rows may share the stored file; it is deleted with its last reference
+    _release_project_file(target.get("filename", ""))
     return jsonify({"ok": True})
 
 
+def _release_project_file(filename):
+    """Drop a project file row's reference to its stored file (and thumbnails with the file)."""
+    folder = app.config["PROJECT_UPLOAD_FOLDER"]
+    if blob_store.release("projects", folder, filename):
+        thumbnailer.discard(folder, filename)
+
+
 @app.route("/api/projects/files/<filename>")
 @login_required
 def serve_project_file(filename):
     """Serve an uploaded project file."""
-    folder = app.config["PROJECT_UPLOAD_FOLDER"]
-    return send_from_directory(str(folder), filename)
+    return send_upload(app.config["PROJECT_UPLOAD_FOLDER"], filename)
+
+
+@app.route("/api/projects/files/<filename>/thumb")
+@login_required
+def serve_project_file_thumbnail(filename):
+    return _send_thumbnail(app.config["PROJECT_UPLOAD_FOLDER"], filename)
+
+
+# ---------------------------------------------------------------------------
+# Chunked uploads API (resumable, for files of any size)
+# ---------------------------------------------------------------------------
+
+_UPLOAD_TARGETS = {"receipts": "UPLOAD_FOLDER", "projects": "PROJECT_UPLOAD_FOLDER"}
+
+
+def _upload_json(upload):
+    return {
+        "id": upload["id"],
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "offset": upload["received"],
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "complete": bool(upload["name"]),
+        "name": upload["name"],
+        "sha256": upload["sha256"],
+    }
+
+
+def _upload_error(e):
+    status = 404 if isinstance(e, LookupError) else 403 if isinstance(e, PermissionError) else 400
+    return jsonify({"ok": False, "error": str(e)}), status
+
+
+def _claim_uploads(namespace):
+    """
+    Take over the blobs of the completed uploads named in the request
+    ("uploads" form fields or JSON list) → [(stored name, original filename)].
+    """
+    ids = request.form.getlist("uploads")
+    if not ids and request.is_json:
+        ids = (request.get_json(silent=True) or {}).get("uploads") or []
+    claimed = []
+    try:
+        for upload_id in ids:
+            upload = upload_sessions.claim(str(upload_id), session["user"], namespace)
+            claimed.append((upload["name"], upload["filename"]))
+    except Exception:
+        folder = app.config[_UPLOAD_TARGETS[namespace]]
+        for name, _ in claimed:
+            blob_store.release(namespace, folder, name)
+        raise
+    return claimed
+
+
+@app.route("/api/uploads", methods=["POST"])
+@login_required
+def create_upload():
+    """Start a chunked upload: {"filename", "size", "target": "receipts" | "projects"}."""
+    d = request.get_json(force=True)
+    target = d.get("target", "receipts")
+    if target not in _UPLOAD_TARGETS:
+        return jsonify({"ok": False, "error": "Ogiltigt mål"}), 400
+    try:
+        upload = upload_sessions.create(session["user"], target, app.config[_UPLOAD_TARGETS[target]],
+                                        d.get("filename", ""), d.get("size", -1))
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True, "upload": _upload_json(upload)})
+
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+@login_required
+def get_upload(upload_id):
+    """Where to resume an interrupted upload."""
+    upload = upload_sessions.get(upload_id)
+    if upload is None or upload["user"] != session["user"]:
+        return jsonify({"ok": False, "error": "Uppladdningen finns inte"}), 404
+    return jsonify({"ok": True, "upload": _upload_json(upload)})
+
+
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+@login_required
+def upload_chunk(upload_id):
+    """Append the raw request body at ?offset= (streamed to disk, never buffered whole)."""
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Ogiltigt värde för offset"}), 400
+    try:
+        received = upload_sessions.write_chunk(upload_id, session["user"], offset, request.stream)
+    except OffsetMismatch as e:
+        return jsonify({"ok": False, "error": str(e), "offset": e.offset}), 409
+    except (LookupError, PermissionError, ValueError) as e:
+        return _upload_error(e)
+    return jsonify({"ok": True, "offset": received})
+
+
+@app.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+@login_required
+def complete_upload(upload_id):
+    """Store the received file; pass its id as "uploads" to /api/receipts or project files."""
+    d = request.get_json(silent=True) or {}
+    try:
+        upload = upload_sessions.complete(upload_id, session["user"], d.get("sha256"))
+    except OffsetMismatch as e:
+        return jsonify({"ok": False, "error": "Filen är inte färdigöverförd", "offset": e.offset}), 409
+    except (LookupError, PermissionError, ValueError) as e:
+        return _upload_error(e)
+    return jsonify({"ok": True, "upload": _upload_json(upload)})
+
+
+@app.route("/api/uploads/<upload_id>", methods=["DELETE"])
+@login_required
+def abort_upload(upload_id):
+    try:
+        upload_sessions.abort(upload_id, session["user"])
+    except (LookupError, PermissionError) as e:
+        return _upload_error(e)
+    return jsonify({"ok": True})
 
 
 # ---------------------------------------------------------------------------
 # WebSocket events (real-time chat)
 # ---------------------------------------------------------------------------
 
+@socketio.on("connect")
+def handle_connect(auth=None):
+    """Every socket of a user joins their personal room (unread badges)."""
+    if "user" in session:
+        join_room(f"user_{session['user']}")
+
+
 @socketio.on("join_chat")
 def handle_join_chat(data):
-    """User joins a chat room for real-time updates."""
+    """User joins a chat room; the room hears about it in the next presence diff."""
     gid = data.get("group_id")
     if gid and "user" in session:
         join_room(f"chat_{gid}")
-        emit("user_joined", {"user": session["user"], "group_id": gid}, room=f"chat_{gid}")
+        presence.join(gid, session["user"], request.sid)
+        presence.start_emitter(socketio)
 
 @socketio.on("leave_chat")
 def handle_leave_chat(data):
     gid = data.get("group_id")
     if gid:
         leave_room(f"chat_{gid}")
+        presence.leave(gid, request.sid)
+
+@socketio.on("disconnect")
+def handle_disconnect(*args):
+    presence.disconnect(request.sid)
 
 @socketio.on("typing")
 def handle_typing(data):
-    """Broadcast typing indicator to room."""
+    """Broadcast typing indicator to room, at most once per user and interval."""
     gid = data.get("group_id")
-    if gid and "user" in session:
+    if gid and "user" in session and presence.should_broadcast_typing(gid, session["user"]):
         emit("user_typing", {"user": session["user"], "group_id": gid}, room=f"chat_{gid}", include_self=False)
 
 
@@ -1306,19 +1599,17 @@ def admin_create_user():
     if role not in ("admin", "user"):
         return jsonify({"ok": False, "error": "Ogiltig roll"}), 400
 
-    users = db.load_data("users")
-    for u in users:
-        if u.get("username") == username:
-            return jsonify({"ok": False, "error": "Användaren finns redan"}), 409
+    if _user_index.get(username) is not None:
+        return jsonify({"ok": False, "error": "Användaren finns redan"}), 409
 
     new_user = {
         "username": username,
-        "password_hash": _hash_password(password),
+        "password_hash": _in_password_pool(_hash_password, password),
         "role": role,
         "permissions": json.dumps(permissions, ensure_ascii=False),
     }
-    users.append(new_user)
-    db.save_data("users", users)
+    db.append_row("users", new_user)
+    _user_index.invalidate()
     _log_activity(session["user"], "Skapade användare", username)
     return jsonify({"ok": True})
 
@@ -1327,19 +1618,18 @@ def admin_create_user():
 @admin_required
 def admin_update_user(username):
     d = request.get_json(force=True)
-    users = db.load_data("users")
-    for u in users:
-        if u.get("username") == username:
-            if "role" in d:
-                u["role"] = d["role"]
-            if "permissions" in d:
-                u["permissions"] = json.dumps(d["permissions"], ensure_ascii=False)
-            if "password" in d and d["password"]:
-                if len(d["password"]) < 6:
-                    return jsonify({"ok": False, "error": "Lösenord måste vara minst 6 tecken"}), 400
-                u["password_hash"] = _hash_password(d["password"])
-            break
-    db.save_data("users", users)
+    updates = {}
+    if "role" in d:
+        updates["role"] = d["role"]
+    if "permissions" in d:
+        updates["permissions"] = json.dumps(d["permissions"], ensure_ascii=False)
+    if "password" in d and d["password"]:
+        if len(d["password"]) < 6:
+            return jsonify({"ok": False, "error": "Lösenord måste vara minst 6 tecken"}), 400
+        updates["password_hash"] = _in_password_pool(_hash_password, d["password"])
+    if updates:
+        db.update_row("users", "username", username, updates)
+        _user_index.invalidate()
     _log_activity(session["user"], "Uppdaterade användare", username)
     return jsonify({"ok": True})
 
@@ -1349,13 +1639,23 @@ def admin_update_user(username):
 def admin_delete_user(username):
     if username in ("Viktor", "admin"):
         return jsonify({"ok": False, "error": "Kan inte ta bort denna användare"}), 403
-    users = db.load_data("users")
-    users = [u for u in users if u.get("username") != username]
-    db.save_data("users", users)
+    while db.delete_row("users", "username", username):
+        pass  # every row: older saves could leave a username duplicated
+    _user_index.invalidate()
     _log_activity(session["user"], "Raderade användare", username)
     return jsonify({"ok": True})
 
 
+@app.route("/api/admin/metrics")
+@admin_required
+def admin_metrics():
+    """In-process counters/timings, the Sheets budget and the integration rate limiters."""
+    snapshot = metrics.snapshot()
+    snapshot["sheets_budget"] = sheets_governor.state()
+    snapshot["rate_limits"] = rate_limiter.snapshot()
+    return jsonify(snapshot)
+
+
 @app.route("/api/admin/activity-log")
 @login_required
 def get_activity_log():
@@ -1364,6 +1664,46 @@ def get_activity_log():
     return jsonify(logs[:100])
 
 
+# ---------------------------------------------------------------------------
+# Search API
+# ---------------------------------------------------------------------------
+
+@app.route("/api/search", methods=["GET"])
+@login_required
+def global_search():
+    """
+    Ranked hits across chat, customers, notes, quotes, invoices and expenses.
+    ?q= words (prefixes, å/ä/ö-insensitive), ?kinds=a,b to narrow, ?limit=.
+    Chat hits only come from groups the user is a member of (admins: all).
+    """
+    started = datetime.now()
+    query = request.args.get("q", "").strip()
+    kinds = [k for k in request.args.get("kinds", "").split(",") if k] or list(SEARCH_KINDS)
+    unknown = [k for k in kinds if k not in SEARCH_KINDS]
+    if unknown:
+        return jsonify({"ok": False, "error": f"Okänd typ: {', '.join(unknown)}"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 100))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Ogiltigt värde för limit"}), 400
+    if len(query) < 2:
+        return jsonify({"query": query, "hits": []})
+
+    search_index.ensure_built(db, kinds)
+    user = session["user"]
+    allowed_groups = None
+    if "chat" in kinds and session.get("role") != "admin":
+        allowed_groups = {str(g.get("id")) for g in db.load_data("chat_groups")
+                          if user in _chat_members(g)}
+
+    def allow(kind, ref):
+        return kind != "chat" or allowed_groups is None or ref in allowed_groups
+
+    hits = search_index.search(query, kinds, limit=limit, allow=allow)
+    took_ms = round((datetime.now() - started).total_seconds() * 1000, 1)
+    return jsonify({"query": query, "hits": hits, "took_ms": took_ms})
+
+
 # ---------------------------------------------------------------------------
 # CRM — Customers API
 # ---------------------------------------------------------------------------
@@ -1374,13 +1714,15 @@ def get_customers():
     data = db.load_data("customers")
     stage = request.args.get("stage")
     bolag = request.args.get("bolag")
-    search = request.args.get("q", "").lower()
+    search = request.args.get("q", "").strip()
     if stage and stage != "Alla":
         data = [c for c in data if c.get("stage") == stage]
     if bolag and bolag != "Alla":
         data = [c for c in data if c.get("bolag") == bolag]
     if search:
-        data = [c for c in data if search in (c.get("name", "") + c.get("email", "") + c.get("company", "")).lower()]
+        search_index.ensure_built(db, ["customers"])
+        matches = search_index.ids("customers", search)
+        data = [c for c in data if str(c.get("id")) in matches]
     data.sort(key=lambda x: x.get("updated", x.get("created", "")), reverse=True)
     return jsonify(data)
 
@@ -1405,6 +1747,7 @@ def add_customer():
         "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     db.append_row("customers", customer)
+    search_index.put("customers", customer)
     _log_activity(session["user"], "Lade till kund", customer["name"])
     return jsonify({"ok": True, "customer": customer})
 
@@ -1418,6 +1761,7 @@ def update_customer(cid):
         if str(row.get("id")) == cid:
             row.update(updates)
             row["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            search_index.put("customers", row)
             break
     db.save_data("customers", data)
     _log_activity(session["user"], "Uppdaterade kund", cid)
@@ -1430,6 +1774,7 @@ def delete_customer(cid):
     data = db.load_data("customers")
     data = [c for c in data if str(c.get("id")) != cid]
     db.save_data("customers", data)
+    search_index.remove("customers", cid)
     _log_activity(session["user"], "Raderade kund", cid)
     return jsonify({"ok": True})
 
@@ -1446,6 +1791,7 @@ def add_customer_note(cid):
         "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     db.append_row("customer_notes", note)
+    search_index.put("customer_notes", note)
     return jsonify({"ok": True, "note": note})
 
 
@@ -1543,6 +1889,7 @@ def create_quote():
         "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     db.append_row("quotes", quote)
+    search_index.put("quotes", quote)
     _log_activity(session["user"], "Skapade offert", f"{quote['id']} — {quote['customer_name']}")
     return jsonify({"ok": True, "quote": quote})
 
@@ -1565,6 +1912,7 @@ def update_quote(qid):
                 updates["total"] = updates["subtotal"]
             row.update(updates)
             row["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            search_index.put("quotes", row)
             break
     db.save_data("quotes", data)
     _log_activity(session["user"], "Uppdaterade offert", qid)
@@ -1577,6 +1925,7 @@ def delete_quote(qid):
     data = db.load_data("quotes")
     data = [q for q in data if str(q.get("id")) != qid]
     db.save_data("quotes", data)
+    search_index.remove("quotes", qid)
     _log_activity(session["user"], "Raderade offert", qid)
     return jsonify({"ok": True})
 
@@ -1772,6 +2121,7 @@ def create_invoice():
         "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     db.append_row("invoices", invoice)
+    search_index.put("invoices", invoice)
     _log_activity(session["user"], "Skapade faktura", f"{invoice['id']} — {invoice['customer_name']}")
     return jsonify({"ok": True, "invoice": invoice})
 
@@ -1785,6 +2135,7 @@ def update_invoice(iid):
         if str(row.get("id")) == iid:
             row.update(updates)
             row["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            search_index.put("invoices", row)
             break
     db.save_data("invoices", data)
     _log_activity(session["user"], "Uppdaterade faktura", iid)
@@ -1813,6 +2164,7 @@ def delete_invoice(iid):
     data = db.load_data("invoices")
     data = [inv for inv in data if str(inv.get("id")) != iid]
     db.save_data("invoices", data)
+    search_index.remove("invoices", iid)
     _log_activity(session["user"], "Raderade faktura", iid)
     return jsonify({"ok": True})
 
@@ -1856,6 +2208,7 @@ def convert_quote_to_invoice(qid):
         "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     db.append_row("invoices", invoice)
+    search_index.put("invoices", invoice)
 
     # Mark quote as Fakturerad
     quote["status"] = "Fakturerad"
@@ -2160,7 +2513,33 @@ def _export_pdf_table(title, data, fields, headers):
 # Integrations API
 # ---------------------------------------------------------------------------
 
-from integrations import get_all_platforms, create_adapter
+from integrations import get_all_platforms, create_adapter, get_adapter_class
+from ingestion import ingest_records
+from backfill import backfill_store, is_running as backfill_is_running, run_job as run_backfill_job
+from sync_index import source_index
+
+
+def _load_checkpoint(config):
+    """
+    Parse the stored sync checkpoint of an integration row.
+    Rows synced before checkpoints existed resume from their last_sync date.
+    """
+    raw = config.get("checkpoint", "")
+    if isinstance(raw, dict):
+        return raw
+    if isinstance(raw, str) and raw.strip().startswith("{"):
+        try:
+            return json.loads(raw)
+        except Exception:
+            pass
+    last_sync = str(config.get("last_sync", ""))[:10]
+    if last_sync:
+        try:
+            last_day = date.fromisoformat(last_sync) - timedelta(days=1)
+            return {"last_complete_day": last_day.isoformat()}
+        except ValueError:
+            pass
+    return {}
 
 
 @app.route("/api/integrations/platforms")
@@ -2233,6 +2612,13 @@ def save_integration():
         for field in cls.REQUIRED_FIELDS:
             config[field["key"]] = d.get(field["key"], "")
 
+    # Optional late-data window override (days re-read after the checkpoint)
+    if str(d.get("late_data_days", "")).strip() != "":
+        try:
+            config["late_data_days"] = max(0, int(d["late_data_days"]))
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "Ogiltigt antal dagar"}), 400
+
     # Check if integration for this platform+bolag already exists → update it
     data = db.load_data("integrations")
     existing = None
@@ -2321,8 +2707,14 @@ def sync_integration(int_id):
     if not adapter:
         return jsonify({"ok": False, "error": "Okänd plattform"}), 400
 
+    checkpoint = _load_checkpoint(config)
     try:
-        result = adapter.sync_data(since_date)
+        if since_date:
+            records = adapter.iter_records(since_date)
+        else:
+            records = adapter.iter_incremental(checkpoint)
+        counts = ingest_records(db, records, platform, bolag,
+                                upsert_changed=adapter.UPSERT_CHANGED)
     except Exception as e:
         # Update status
         config["last_sync"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -2331,76 +2723,25 @@ def sync_integration(int_id):
         db.save_data("integrations", data)
         return jsonify({"ok": False, "error": str(e)[:200]}), 500
 
-    added_expenses = 0
-    added_revenue = 0
-    skipped = 0
-
-    # Load existing to deduplicate by source_id
-    existing_expenses = db.load_data("expenses")
-    existing_revenue = db.load_data("revenue")
-    existing_exp_source_ids = {str(e.get("source_id", "")) for e in existing_expenses if e.get("source_id")}
-    existing_rev_source_ids = {str(r.get("source_id", "")) for r in existing_revenue if r.get("source_id")}
-
-    # Add new expenses
-    for exp in result.get("expenses", []):
-        source_id = exp.get("source_id", "")
-        if source_id and source_id in existing_exp_source_ids:
-            skipped += 1
-            continue
-        expense = {
-            "id": str(uuid.uuid4())[:8],
-            "bolag": bolag,
-            "datum": exp.get("datum", date.today().isoformat()),
-            "kategori": exp.get("kategori", "Övrigt"),
-            "beskrivning": exp.get("beskrivning", ""),
-            "leverantor": platform.replace("_", " ").title(),
-            "belopp": float(exp.get("belopp", 0)),
-            "moms_sats": int(exp.get("moms_sats", 0)),
-            "moms_belopp": 0,
-            "source": platform,
-            "source_id": source_id,
-        }
-        expense["moms_belopp"] = round(
-            expense["belopp"] * expense["moms_sats"] / (100 + expense["moms_sats"]), 2
-        ) if expense["moms_sats"] > 0 else 0
-        db.append_row("expenses", expense)
-        added_expenses += 1
-
-    # Add new revenue
-    for rev in result.get("revenue", []):
-        source_id = rev.get("source_id", "")
-        if source_id and source_id in existing_rev_source_ids:
-            skipped += 1
-            continue
-        revenue_entry = {
-            "id": str(uuid.uuid4())[:8],
-            "bolag": bolag,
-            "datum": rev.get("datum", date.today().isoformat()),
-            "kategori": rev.get("kategori", "Övrigt"),
-            "beskrivning": rev.get("beskrivning", ""),
-            "kund": rev.get("kund", ""),
-            "belopp": float(rev.get("belopp", 0)),
-            "source": platform,
-            "source_id": source_id,
-        }
-        db.append_row("revenue", revenue_entry)
-        added_revenue += 1
-
     # Update sync status
     config["last_sync"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     config["last_sync_status"] = "success" if not adapter.errors else "partial"
     config["sync_errors"] = "; ".join(adapter.errors) if adapter.errors else ""
+    # A range starting after the resume day leaves a gap before it: only
+    # advance the checkpoint when the synced range covers the resume day
+    resume = adapter.since_from_checkpoint(checkpoint)
+    if not since_date or (resume and str(since_date)[:10] <= resume):
+        config["checkpoint"] = json.dumps(adapter.next_checkpoint(checkpoint), ensure_ascii=False)
     db.save_data("integrations", data)
 
     _log_activity(
         session["user"], "Synkade integration",
-        f"{platform} ({bolag}): +{added_expenses} utgifter, +{added_revenue} intäkter, {skipped} hoppade"
+        f"{platform} ({bolag}): +{counts['added_expenses']} utgifter, +{counts['added_revenue']} intäkter, "
+        f"{counts['updated']} uppdaterade, {counts['skipped']} hoppade"
     )
     return jsonify({
         "ok": True,
-        "added_expenses": added_expenses,
-        "added_revenue": added_revenue,
-        "skipped": skipped,
+        **counts,
         "errors": adapter.errors,
     })
 
@@ -2424,61 +2765,15 @@ def sync_all_integrations():
             continue
 
         try:
-            last_sync = config.get("last_sync", "")
-            since = last_sync[:10] if last_sync else None
-            sync_result = adapter.sync_data(since)
-
-            # Deduplicate
-            existing_expenses = db.load_data("expenses")
-            existing_revenue = db.load_data("revenue")
-            exp_ids = {str(e.get("source_id", "")) for e in existing_expenses if e.get("source_id")}
-            rev_ids = {str(r.get("source_id", "")) for r in existing_revenue if r.get("source_id")}
-
-            added_exp = 0
-            for exp in sync_result.get("expenses", []):
-                sid = exp.get("source_id", "")
-                if sid and sid in exp_ids:
-                    continue
-                expense = {
-                    "id": str(uuid.uuid4())[:8],
-                    "bolag": bolag,
-                    "datum": exp.get("datum", date.today().isoformat()),
-                    "kategori": exp.get("kategori", "Övrigt"),
-                    "beskrivning": exp.get("beskrivning", ""),
-                    "leverantor": platform.replace("_", " ").title(),
-                    "belopp": float(exp.get("belopp", 0)),
-                    "moms_sats": int(exp.get("moms_sats", 0)),
-                    "moms_belopp": 0,
-                    "source": platform,
-                    "source_id": sid,
-                }
-                db.append_row("expenses", expense)
-                added_exp += 1
-
-            added_rev = 0
-            for rev in sync_result.get("revenue", []):
-                sid = rev.get("source_id", "")
-                if sid and sid in rev_ids:
-                    continue
-                revenue_entry = {
-                    "id": str(uuid.uuid4())[:8],
-                    "bolag": bolag,
-                    "datum": rev.get("datum", date.today().isoformat()),
-                    "kategori": rev.get("kategori", "Övrigt"),
-                    "beskrivning": rev.get("beskrivning", ""),
-                    "kund": rev.get("kund", ""),
-                    "belopp": float(rev.get("belopp", 0)),
-                    "source": platform,
-                    "source_id": sid,
-                }
-                db.append_row("revenue", revenue_entry)
-                added_rev += 1
+            checkpoint = _load_checkpoint(config)
+            counts = ingest_records(db, adapter.iter_incremental(checkpoint), platform, bolag,
+                                    upsert_changed=adapter.UPSERT_CHANGED)
 
             config["last_sync"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            config["last_sync_status"] = "success"
-            config["sync_errors"] = ""
-            results.append({"platform": platform, "bolag": bolag, "ok": True,
-                            "added_expenses": added_exp, "added_revenue": added_rev})
+            config["last_sync_status"] = "success" if not adapter.errors else "partial"
+            config["sync_errors"] = "; ".join(adapter.errors) if adapter.errors else ""
+            config["checkpoint"] = json.dumps(adapter.next_checkpoint(checkpoint), ensure_ascii=False)
+            results.append({"platform": platform, "bolag": bolag, "ok": True, **counts})
 
         except Exception as e:
             config["last_sync"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -2490,6 +2785,57 @@ def sync_all_integrations():
     return jsonify({"ok": True, "results": results})
 
 
+@app.route("/api/integrations/<int_id>/backfill", methods=["POST"])
+@admin_required
+def start_backfill(int_id):
+    """Import history for an integration over a date range, in the background."""
+    d = request.get_json(force=True)
+    try:
+        date_from = date.fromisoformat(str(d.get("from", "")))
+        date_to = date.fromisoformat(str(d.get("to") or date.today().isoformat()))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Ogiltigt datum (YYYY-MM-DD)"}), 400
+    if date_from > date_to:
+        return jsonify({"ok": False, "error": "Startdatum måste vara före slutdatum"}), 400
+    if date_to > date.today():
+        date_to = date.today()
+
+    config = next((row for row in db.load_data("integrations") if str(row.get("id")) == int_id), None)
+    if not config:
+        return jsonify({"ok": False, "error": "Integration ej hittad"}), 404
+    if not get_adapter_class(config.get("platform", "")):
+        return jsonify({"ok": False, "error": "Okänd plattform"}), 400
+
+    job = backfill_store.create_job(config, date_from.isoformat(), date_to.isoformat())
+    socketio.start_background_task(run_backfill_job, db, job["id"])
+    _log_activity(session["user"], "Startade historikimport",
+                  f"{config.get('platform')} ({config.get('bolag')}): {date_from} → {date_to}")
+    return jsonify({"ok": True, "job": job})
+
+
+@app.route("/api/integrations/backfill/<job_id>")
+@admin_required
+def get_backfill(job_id):
+    """Progress of a backfill job, per chunk."""
+    job = backfill_store.get_job(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "Jobb ej hittat"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/integrations/backfill/<job_id>/resume", methods=["POST"])
+@admin_required
+def resume_backfill(job_id):
+    """Re-run the unfinished chunks of an interrupted or partially failed backfill."""
+    job = backfill_store.get_job(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "Jobb ej hittat"}), 404
+    if backfill_is_running(job_id):
+        return jsonify({"ok": False, "error": "Jobbet körs redan"}), 409
+    socketio.start_background_task(run_backfill_job, db, job_id)
+    return jsonify({"ok": True, "job": job})
+
+
 @app.route("/api/integrations/summary")
 @login_required
 def get_integrations_summary():
@@ -2548,4 +2894,5 @@ def get_integrations_summary():
 if __name__ == "__main__":
     app.config["UPLOAD_FOLDER"].mkdir(parents=True, exist_ok=True)
     app.config["PROJECT_UPLOAD_FOLDER"].mkdir(parents=True, exist_ok=True)
+    chat_store.start_flusher(db)  # write messages journaled before the last stop
     socketio.run(app, debug=True, port=5000)
@@ -0,0 +1,251 @@
+"""
+Unithread App — Async Google Sheets client for bulk jobs.
+
+Same data model as google_sheets.GoogleSheetsDB (one list of dicts per
+worksheet, first row = headers), but talks to the Sheets REST API v4 over
+httpx so batch jobs can overlap independent worksheet reads and writes:
+
+    async with AsyncSheetsDB(creds, spreadsheet_id) as adb:
+        users, expenses = await asyncio.gather(adb.aload_data("users"),
+                                               adb.aload_data("expenses"))
+
+Every coroutine has a blocking twin without the "a" prefix (load_data,
+save_data, append_row, append_rows) for scripts that are not async.
+At most max_concurrency requests are in flight, and each one takes a
+background slot from the shared Sheets budget (ratelimit.sheets_governor).
+
+httpx is an optional dependency (pip install httpx), only needed by the
+bulk scripts that use this module. base_url/transport point the client at
+a local fake Sheets server for offline runs and tests.
+"""
+
+import json
+import asyncio
+import logging
+from urllib.parse import quote
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+from ratelimit import sheets_governor, BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+SHEETS_API_URL = "https://sheets.googleapis.com/v4"
+MAX_CONCURRENCY = 4
+
+
+def _cell(val):
+    """Sheets cell value for a Python value (same rules as GoogleSheetsDB)."""
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, ensure_ascii=False)
+    if val is None:
+        return ""
+    return val
+
+
+def _value(cell):
+    """A formatted cell as get_all_records() returns it: numbers become int/float."""
+    if not isinstance(cell, str) or not cell or "_" in cell:
+        return cell
+    try:
+        return int(cell)
+    except ValueError:
+        pass
+    try:
+        return float(cell)
+    except ValueError:
+        return cell
+
+
+def _a1(sheet_name):
+    """Whole-sheet A1 range for a worksheet title, URL-encoded."""
+    return quote("'" + sheet_name.replace("'", "''") + "'", safe="")
+
+
+class AsyncSheetsDB:
+    """Async Sheets REST client with a concurrency cap."""
+
+    def __init__(self, credentials, spreadsheet_id, max_concurrency=MAX_CONCURRENCY,
+                 base_url=SHEETS_API_URL, transport=None, timeout=30):
+        if httpx is None:
+            raise RuntimeError("AsyncSheetsDB kräver httpx (pip install httpx)")
+        self.credentials = credentials
+        self.spreadsheet_id = spreadsheet_id
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.base_url = base_url.rstrip("/")
+        self._transport = transport
+        self._timeout = timeout
+        self._client = None
+        self._semaphore = None
+        self._titles = None
+        self._titles_lock = None
+
+    # -- connection -------------------------------------------------------
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+        self._titles_lock = None
+
+    def _http(self):
+        # Created lazily so the client and semaphore belong to the running loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(transport=self._transport, timeout=self._timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._titles_lock = asyncio.Lock()
+        return self._client
+
+    async def _auth_headers(self):
+        creds = self.credentials
+        if creds is None:
+            return {}
+        if not creds.valid:
+            from google.auth.transport.requests import Request
+            await asyncio.to_thread(creds.refresh, Request())
+        return {"Authorization": f"Bearer {creds.token}"}
+
+    async def _request(self, method, path, max_retries=3, **kwargs):
+        """One Sheets API call with retries, inside the concurrency cap and Sheets budget."""
+        client = self._http()
+        url = f"{self.base_url}/spreadsheets/{self.spreadsheet_id}{path}"
+        for attempt in range(max_retries):
+            await asyncio.to_thread(sheets_governor.acquire, BACKGROUND)
+            async with self._semaphore:
+                try:
+                    resp = await client.request(method, url, headers=await self._auth_headers(), **kwargs)
+                except httpx.TransportError:
+                    if attempt < max_retries - 1:
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+                    raise
+            if resp.status_code == 429 and attempt < max_retries - 1:
+                sheets_governor.pause(2 ** attempt)
+                continue
+            if resp.status_code in (500, 502, 503, 504) and attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            resp.raise_for_status()
+            return resp.json() if resp.content else {}
+
+    async def _ensure_worksheet(self, sheet_name):
+        """Create the worksheet if the spreadsheet does not have it yet."""
+        self._http()
+        async with self._titles_lock:
+            if self._titles is None:
+                meta = await self._request("GET", "", params={"fields": "sheets.properties.title"})
+                self._titles = {s["properties"]["title"] for s in meta.get("sheets", [])}
+            if sheet_name in self._titles:
+                return
+            await self._request("POST", ":batchUpdate", json={"requests": [{"addSheet": {"properties": {
+                "title": sheet_name, "gridProperties": {"rowCount": 1000, "columnCount": 26},
+            }}}]})
+            self._titles.add(sheet_name)
+
+    async def _header_row(self, sheet_name):
+        data = await self._request("GET", f"/values/{_a1(sheet_name)}!1:1")
+        values = data.get("values") or [[]]
+        return list(values[0])
+
+    # -- coroutines -------------------------------------------------------
+
+    async def aload_data(self, sheet_name):
+        """All rows of a worksheet as a list of dicts ([] if it does not exist)."""
+        try:
+            # Formatted values, like gspread's get_all_records()
+            data = await self._request("GET", f"/values/{_a1(sheet_name)}")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404 or (
+                    e.response.status_code == 400 and "Unable to parse range" in e.response.text):
+                return []  # unknown sheet
+            raise
+        values = data.get("values") or []
+        if not values:
+            return []
+        headers = values[0]
+        return [
+            {h: (_value(row[i]) if i < len(row) else "") for i, h in enumerate(headers)}
+            for row in values[1:]
+        ]
+
+    async def asave_data(self, sheet_name, data_list):
+        """Overwrite a worksheet with a list of dicts."""
+        await self._ensure_worksheet(sheet_name)
+        await self._request("POST", f"/values/{_a1(sheet_name)}:clear")
+        if not data_list:
+            return
+        headers = []
+        for row in data_list:
+            for key in row.keys():
+                if key not in headers:
+                    headers.append(key)
+        rows = [headers] + [[_cell(item.get(h, "")) for h in headers] for item in data_list]
+        await self._request("PUT", f"/values/{_a1(sheet_name)}!A1",
+                            params={"valueInputOption": "USER_ENTERED"}, json={"values": rows})
+
+    async def aappend_rows(self, sheet_name, rows):
+        """Append many rows, extending the header row when new keys appear."""
+        if not rows:
+            return
+        await self._ensure_worksheet(sheet_name)
+        existing = await self._header_row(sheet_name)
+        headers = list(existing)
+        for row in rows:
+            for key in row.keys():
+                if key not in headers:
+                    headers.append(key)
+
+        values = []
+        if not existing:
+            values.append(headers)
+        elif len(headers) > len(existing):
+            await self._request("PUT", f"/values/{_a1(sheet_name)}!A1",
+                                params={"valueInputOption": "USER_ENTERED"}, json={"values": [headers]})
+        values.extend([_cell(row.get(h, "")) for h in headers] for row in rows)
+        await self._request("POST", f"/values/{_a1(sheet_name)}:append",
+                            params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+                            json={"values": values})
+
+    async def aappend_row(self, sheet_name, row_dict):
+        await self.aappend_rows(sheet_name, [row_dict])
+
+    async def aload_many(self, sheet_names):
+        """Load several worksheets concurrently → {sheet_name: rows}."""
+        results = await asyncio.gather(*(self.aload_data(name) for name in sheet_names))
+        return dict(zip(sheet_names, results))
+
+    async def asave_many(self, sheets):
+        """Overwrite several worksheets concurrently from {sheet_name: rows}."""
+        await asyncio.gather(*(self.asave_data(name, rows) for name, rows in sheets.items()))
+
+    # -- blocking twins ---------------------------------------------------
+
+    def _run(self, coro_name, *args):
+        async def run():
+            try:
+                return await getattr(self, coro_name)(*args)
+            finally:
+                await self.aclose()
+        return asyncio.run(run())
+
+    def load_data(self, sheet_name):
+        return self._run("aload_data", sheet_name)
+
+    def save_data(self, sheet_name, data_list):
+        return self._run("asave_data", sheet_name, data_list)
+
+    def append_rows(self, sheet_name, rows):
+        return self._run("aappend_rows", sheet_name, rows)
+
+    def append_row(self, sheet_name, row_dict):
+        return self._run("aappend_row", sheet_name, row_dict)
@@ -3,8 +3,8 @@ import json
 import hashlib
 from pathlib import Path
 from datetime import datetime
-import uuid
 from db_handler import db
+from session_store import session_store
 
 # USERS_FILE = Path(__file__).parent / "foretag_data" / "system_users.json"
 # SESSIONS_FILE = Path(__file__).parent / "foretag_data" / "sessions.json"
@@ -117,71 +117,30 @@ def update_password(username, new_password):
     return False
 
 
-@st.cache_data(ttl=300)
-def load_sessions():
+def _sessions():
+    """Session store, with legacy sheet sessions imported and the sweeper running."""
     try:
-        rows = db.load_data("sessions")
-        sessions = {}
-        for row in rows:
-            token = row.get("token")
-            if token:
-                sessions[token] = {
-                    "username": row.get("username"),
-                    "expires": float(row.get("expires", 0))
-                }
-        return sessions
-    except Exception:
-        return {}
-
-
-def save_sessions(sessions):
-    rows = []
-    for token, data in sessions.items():
-        rows.append({
-            "token": token,
-            "username": data.get("username"),
-            "expires": data.get("expires")
-        })
-    try:
-        db.save_data("sessions", rows)
-        load_sessions.clear()
+        session_store.import_sheet(db)
     except Exception as e:
-        print(f"Error saving sessions: {e}")
+        print(f"Error importing sessions: {e}")
+    session_store.start_sweeper()
+    return session_store
 
 
 def create_session(username):
-    token = str(uuid.uuid4())
-    sessions = load_sessions()
-    # Rensa gamla sessioner
-    now = datetime.now().timestamp()
-    sessions = {k: v for k, v in sessions.items() if v.get("expires", 0) > now}
-
-    # Skapa ny session (giltig i 30 dagar)
-    sessions[token] = {
-        "username": username,
-        "expires": now + (30 * 24 * 3600)
-    }
-    save_sessions(sessions)
-    return token
+    # Ny session (giltig i 30 dagar); utgångna rensas av svepet
+    return _sessions().create(username)
 
 
 def validate_session(token):
-    sessions = load_sessions()
-    if token in sessions:
-        session = sessions[token]
-        if session.get("expires", 0) > datetime.now().timestamp():
-            return session["username"]
-    return None
+    return _sessions().validate(token)
 
 
 def logout():
-    # Ta bort session från fil
+    # Ta bort sessionen
     token = st.query_params.get("token")
     if token:
-        sessions = load_sessions()
-        if token in sessions:
-            del sessions[token]
-            save_sessions(sessions)
+        _sessions().delete(token)
 
     # Rensa state och params
     st.query_params.clear()
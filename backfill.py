@@ -0,0 +1,294 @@
+"""
+Unithread App — Historical backfill for integrations.
+
+Splits a [from, to] date range into per-platform chunks (each adapter's
+BACKFILL_CHUNK_DAYS, kept under the API row/range limits), imports them
+with bounded concurrency through the ingestion pipeline and records the
+progress of every chunk in a local SQLite file. An interrupted backfill
+is resumed by re-running only the chunks that are not done.
+
+Usage:
+    python backfill.py <integration_id> --from 2023-01-01 --to 2024-12-31
+    python backfill.py --resume <job_id>
+    python backfill.py --list
+"""
+
+import os
+import sqlite3
+import logging
+import argparse
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from integrations import create_adapter, get_adapter_class
+from ingestion import ingest_records
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_FILE = Path(os.environ.get(
+    "BACKFILL_FILE", Path(__file__).parent / "foretag_data" / "backfill.db"
+))
+MAX_WORKERS = 3
+
+COUNT_FIELDS = ("added_expenses", "added_revenue", "updated", "skipped", "invalid")
+
+# Jobs running in this process. A job left "running" in the store after a
+# crash is not in here, so it can be resumed.
+_active_jobs = set()
+_active_lock = threading.Lock()
+
+
+def is_running(job_id):
+    with _active_lock:
+        return job_id in _active_jobs
+
+
+def plan_chunks(date_from, date_to, chunk_days):
+    """Split [date_from, date_to] (inclusive, YYYY-MM-DD) into (start, end) chunks."""
+    start = date.fromisoformat(str(date_from)[:10])
+    end = date.fromisoformat(str(date_to)[:10])
+    chunk_days = max(1, int(chunk_days))
+    chunks = []
+    while start <= end:
+        chunk_end = min(end, start + timedelta(days=chunk_days - 1))
+        chunks.append((start.isoformat(), chunk_end.isoformat()))
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class BackfillStore:
+    """Backfill jobs and per-chunk progress, stored in SQLite."""
+
+    def __init__(self, path=BACKFILL_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    integration_id TEXT NOT NULL,
+                    platform TEXT NOT NULL,
+                    bolag TEXT NOT NULL,
+                    date_from TEXT NOT NULL,
+                    date_to TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created TEXT NOT NULL,
+                    updated TEXT NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    job_id TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    "end" TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    added_expenses INTEGER DEFAULT 0,
+                    added_revenue INTEGER DEFAULT 0,
+                    updated INTEGER DEFAULT 0,
+                    skipped INTEGER DEFAULT 0,
+                    invalid INTEGER DEFAULT 0,
+                    error TEXT DEFAULT '',
+                    PRIMARY KEY (job_id, start)
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def create_job(self, config, date_from, date_to):
+        """Create a job for an integration row and plan its chunks."""
+        platform = config.get("platform", "")
+        cls = get_adapter_class(platform)
+        chunk_days = cls.BACKFILL_CHUNK_DAYS if cls else 31
+        job_id = f"bf_{uuid.uuid4().hex[:8]}"
+        chunks = plan_chunks(date_from, date_to, chunk_days)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                job_id, str(config.get("id", "")), platform, config.get("bolag", ""),
+                str(date_from)[:10], str(date_to)[:10], "pending", _now(), _now(),
+            ))
+            conn.executemany(
+                'INSERT INTO chunks (job_id, start, "end", status) VALUES (?, ?, ?, ?)',
+                [(job_id, start, end, "pending") for start, end in chunks],
+            )
+            conn.commit()
+        return self.get_job(job_id)
+
+    def get_job(self, job_id):
+        """Return a job with its chunks and summed counts, or None."""
+        with self._lock:
+            conn = self._connect()
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not job:
+                return None
+            chunks = conn.execute(
+                "SELECT * FROM chunks WHERE job_id = ? ORDER BY start", (job_id,)
+            ).fetchall()
+        result = dict(job)
+        result["chunks"] = [dict(c) for c in chunks]
+        for field in COUNT_FIELDS:
+            result[field] = sum(c[field] or 0 for c in result["chunks"])
+        result["done_chunks"] = sum(1 for c in result["chunks"] if c["status"] == "done")
+        result["total_chunks"] = len(result["chunks"])
+        return result
+
+    def list_jobs(self, integration_id=None):
+        with self._lock:
+            conn = self._connect()
+            if integration_id:
+                rows = conn.execute("SELECT id FROM jobs WHERE integration_id = ? ORDER BY created DESC",
+                                    (integration_id,)).fetchall()
+            else:
+                rows = conn.execute("SELECT id FROM jobs ORDER BY created DESC").fetchall()
+        return [self.get_job(r["id"]) for r in rows]
+
+    def pending_chunks(self, job_id):
+        """Chunks that still need to run (pending, failed, or interrupted while running)."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT start, \"end\" FROM chunks WHERE job_id = ? AND status != 'done' ORDER BY start",
+                (job_id,),
+            ).fetchall()
+        return [(r["start"], r["end"]) for r in rows]
+
+    def mark_chunk(self, job_id, start, status, counts=None, error=""):
+        counts = counts or {}
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                f"UPDATE chunks SET status = ?, error = ?, "
+                f"{', '.join(f'{f} = ?' for f in COUNT_FIELDS)} WHERE job_id = ? AND start = ?",
+                (status, error[:300], *(int(counts.get(f, 0)) for f in COUNT_FIELDS), job_id, start),
+            )
+            conn.commit()
+
+    def set_job_status(self, job_id, status):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (status, _now(), job_id))
+            conn.commit()
+
+
+def run_job(db, job_id, max_workers=MAX_WORKERS, store=None):
+    """
+    Run (or resume) a backfill job. Chunks run in parallel on at most
+    max_workers threads; each chunk is marked done only when its whole
+    date range was imported without adapter errors.
+    """
+    store = store or backfill_store
+    job = store.get_job(job_id)
+    if not job:
+        raise ValueError(f"Okänt backfill-jobb: {job_id}")
+
+    config = next((row for row in db.load_data("integrations")
+                   if str(row.get("id")) == job["integration_id"]), None)
+    if not config:
+        store.set_job_status(job_id, "error")
+        raise ValueError(f"Integration {job['integration_id']} hittades inte")
+
+    with _active_lock:
+        if job_id in _active_jobs:
+            raise RuntimeError(f"Backfill {job_id} körs redan")
+        _active_jobs.add(job_id)
+    try:
+        return _run(db, store, job, config, max_workers)
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+
+
+def _run(db, store, job, config, max_workers):
+    job_id = job["id"]
+    platform = job["platform"]
+    bolag = job["bolag"]
+    store.set_job_status(job_id, "running")
+
+    def run_chunk(chunk):
+        start, end = chunk
+        store.mark_chunk(job_id, start, "running")
+        # Fresh adapter per chunk: errors and high-water marks are per instance
+        adapter = create_adapter(platform, config)
+        try:
+            counts = ingest_records(db, adapter.iter_records(start, end), platform, bolag,
+                                    upsert_changed=adapter.UPSERT_CHANGED)
+        except Exception as e:
+            logger.error(f"Backfill {job_id} {start}–{end} failed: {e}")
+            store.mark_chunk(job_id, start, "error", error=str(e))
+            return False
+        if adapter.errors:
+            store.mark_chunk(job_id, start, "error", counts, "; ".join(adapter.errors))
+            return False
+        store.mark_chunk(job_id, start, "done", counts)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        results = list(pool.map(run_chunk, store.pending_chunks(job_id)))
+
+    store.set_job_status(job_id, "done" if all(results) else "partial")
+    return store.get_job(job_id)
+
+
+# Singleton
+backfill_store = BackfillStore()
+
+
+def _print_job(job):
+    print(f"   {job['id']}  {job['platform']} ({job['bolag']})  {job['date_from']} → {job['date_to']}  "
+          f"{job['status']}  {job['done_chunks']}/{job['total_chunks']} delar  "
+          f"+{job['added_expenses']} utgifter, +{job['added_revenue']} intäkter, "
+          f"{job['updated']} uppdaterade")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importera historik för en integration.")
+    parser.add_argument("integration_id", nargs="?", help="Integrationens id (se /api/integrations)")
+    parser.add_argument("--from", dest="date_from", help="Startdatum YYYY-MM-DD")
+    parser.add_argument("--to", dest="date_to", default=date.today().isoformat(),
+                        help="Slutdatum YYYY-MM-DD (standard: idag)")
+    parser.add_argument("--resume", metavar="JOB_ID", help="Återuppta ett avbrutet jobb")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Max parallella delar")
+    parser.add_argument("--list", action="store_true", help="Lista backfill-jobb")
+    args = parser.parse_args()
+
+    if args.list:
+        for job in backfill_store.list_jobs(args.integration_id):
+            _print_job(job)
+        return
+
+    from google_sheets import db
+
+    if args.resume:
+        job_id = args.resume
+    else:
+        if not args.integration_id or not args.date_from:
+            parser.error("ange integration_id och --from (eller --resume JOB_ID)")
+        config = next((row for row in db.load_data("integrations")
+                       if str(row.get("id")) == args.integration_id), None)
+        if not config:
+            parser.error(f"integration {args.integration_id} hittades inte")
+        job_id = backfill_store.create_job(config, args.date_from, args.date_to)["id"]
+
+    print(f"🚀 Kör backfill {job_id}...")
+    job = run_job(db, job_id, max_workers=args.workers)
+    _print_job(job)
+    if job["status"] != "done":
+        print(f"⚠️ Alla delar blev inte klara — kör igen med: python backfill.py --resume {job_id}")
+
+
+if __name__ == "__main__":
+    main()
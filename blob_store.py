@@ -0,0 +1,165 @@
+"""
+Unithread App — Content-addressed upload storage.
+
+An uploaded file is hashed (SHA-256) while it is streamed to a temp file
+and then stored under its hash, <sha256><ext>, in its upload folder, so
+the same receipt uploaded twice is kept once. Every row that points to a
+blob (receipts.files, project_files.filename) holds one reference, counted
+in a SQLite file shared by the workers; releasing the last reference
+deletes the blob.
+
+Placing a blob and counting its reference happen in one write
+transaction, as do dropping the last reference and deleting the file, so
+an upload and a delete of the same content in two workers cannot leave a
+row pointing at a deleted file. Files saved before this store (named
+<uuid>_<name>) have exactly one reference and are deleted on release.
+"""
+
+import os
+import re
+import time
+import uuid
+import sqlite3
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+from werkzeug.utils import secure_filename
+
+BLOB_INDEX_FILE = Path(os.environ.get(
+    "BLOB_INDEX_FILE", Path(__file__).parent / "foretag_data" / "blobs.db"
+))
+CHUNK_SIZE = 1024 * 1024  # bytes read per step while hashing an upload
+
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,10})?$")
+
+
+def is_blob_name(name):
+    """True for content-addressed names (<sha256><ext>)."""
+    return bool(_BLOB_NAME.match(str(name)))
+
+
+def blob_name(digest, filename):
+    """Stored name for content with this hash; keeps the extension for the content type."""
+    ext = Path(secure_filename(filename or "")).suffix.lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,10}", ext):
+        ext = ""
+    return f"{digest}{ext}"
+
+
+class BlobStore:
+    """Reference-counted, content-addressed files in upload folders."""
+
+    def __init__(self, path=BLOB_INDEX_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    namespace TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (namespace, name)
+                )
+            """)
+            self._conn = conn
+        return self._conn
+
+    def put(self, namespace, folder, stream, filename):
+        """
+        Store an uploaded stream in folder and add one reference to it.
+        Returns the stored name; identical content gets the same name.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        tmp = folder / f".upload-{uuid.uuid4().hex}"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, "wb") as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            name = blob_name(digest.hexdigest(), filename)
+            self.add(namespace, folder, name, size, tmp)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        return name
+
+    def add(self, namespace, folder, name, size, source=None):
+        """
+        Count a reference to blob `name`, moving `source` (a file with that
+        content) into place unless the blob is already stored.
+        """
+        target = Path(folder) / name
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if source is not None and not target.exists():
+                    shutil.move(str(source), str(target))  # a rename unless across filesystems
+                conn.execute("""
+                    INSERT INTO blobs VALUES (?, ?, ?, 1, ?)
+                    ON CONFLICT (namespace, name) DO UPDATE SET refs = refs + 1
+                """, (namespace, name, int(size), time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def release(self, namespace, folder, name):
+        """Drop one reference; deletes the file with the last one. Returns True if deleted."""
+        if not name:
+            return False
+        target = Path(folder) / name
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT refs FROM blobs WHERE namespace = ? AND name = ?",
+                                   (namespace, name)).fetchone()
+                if row is None:
+                    # Pre-store upload: its only reference is going away.
+                    # A content-addressed name without a count is kept (count unknown).
+                    delete = not is_blob_name(name)
+                elif row[0] > 1:
+                    conn.execute("UPDATE blobs SET refs = refs - 1 WHERE namespace = ? AND name = ?",
+                                 (namespace, name))
+                    delete = False
+                else:
+                    conn.execute("DELETE FROM blobs WHERE namespace = ? AND name = ?", (namespace, name))
+                    delete = True
+                if delete and target.exists():
+                    target.unlink()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return delete
+
+    def refs(self, namespace, name):
+        with self._lock:
+            row = self._connect().execute("SELECT refs FROM blobs WHERE namespace = ? AND name = ?",
+                                          (namespace, name)).fetchone()
+        return row[0] if row else 0
+
+
+# Singleton
+blob_store = BlobStore()
@@ -0,0 +1,124 @@
+"""
+Unithread App — Durable write-behind journal for chat messages.
+
+send_message records a message here (one local SQLite insert) and
+broadcasts it right away; chat_store's flusher later writes journaled
+messages to their group worksheets in batches and removes them once
+Sheets has them. Anything still journaled when a process dies is
+written by the next flusher, so delivery to Sheets is at-least-once
+(readers drop duplicate message ids).
+
+Rows are claimed with a lease before they are written, so flushers in
+several workers sharing the file do not write the same batch twice.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from pathlib import Path
+
+OUTBOX_FILE = Path(os.environ.get(
+    "CHAT_OUTBOX_FILE", Path(__file__).parent / "foretag_data" / "chat_outbox.db"
+))
+LEASE_SECONDS = 60  # a claim older than this is taken over (its flusher died)
+
+
+class ChatOutbox:
+    """Journal of chat messages not yet written to Google Sheets, backed by SQLite."""
+
+    def __init__(self, path=OUTBOX_FILE):
+        self.path = Path(path)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the journal on first use in this process (no disk access at import time)."""
+        if self._conn is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_group ON outbox (group_id, seq)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+            self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return self._conn
+
+    def add(self, gid, msg):
+        """Journal one message. Returns once it is on disk."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO outbox (group_id, payload, created) VALUES (?, ?, ?)",
+                         (str(gid), json.dumps(msg, ensure_ascii=False), time.time()))
+            conn.commit()
+
+    def pending(self, gid):
+        """Journaled messages of a group, oldest first."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT payload FROM outbox WHERE group_id = ? ORDER BY seq", (str(gid),)
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def claim(self, limit):
+        """Lease up to `limit` unclaimed (or abandoned) rows → [(seq, group_id, msg)]."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("""
+                UPDATE outbox SET claimed_by = ?, claimed_at = ?
+                WHERE seq IN (
+                    SELECT seq FROM outbox
+                    WHERE claimed_at IS NULL OR claimed_at < ?
+                    ORDER BY seq LIMIT ?
+                )
+            """, (self.owner, now, now - LEASE_SECONDS, int(limit)))
+            conn.commit()
+            rows = conn.execute(
+                "SELECT seq, group_id, payload FROM outbox WHERE claimed_by = ? AND claimed_at = ? ORDER BY seq",
+                (self.owner, now),
+            ).fetchall()
+        return [(seq, gid, json.loads(payload)) for seq, gid, payload in rows]
+
+    def done(self, seqs):
+        """Remove rows that are now stored in Sheets."""
+        self._by_seq("DELETE FROM outbox WHERE seq = ?", seqs)
+
+    def release(self, seqs):
+        """Give back claimed rows after a failed write so they are retried."""
+        self._by_seq("UPDATE outbox SET claimed_by = NULL, claimed_at = NULL WHERE seq = ?", seqs)
+
+    def _by_seq(self, sql, seqs):
+        if not seqs:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(sql, [(s,) for s in seqs])
+            conn.commit()
+
+    def discard(self, gid):
+        """Forget a deleted group's unwritten messages."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM outbox WHERE group_id = ?", (str(gid),))
+            conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
@@ -0,0 +1,305 @@
+"""
+Unithread App — Chat messages partitioned by group.
+
+Each group's messages live in their own worksheet, chat_<group id>,
+appended in timestamp order. Opening a group reads only that group's
+history, a page of older messages is a binary search in it, and deleting
+a group drops one worksheet instead of rewriting every group's history.
+
+The newest TAIL_SIZE messages of each active group are kept in memory and
+extended in place on send, so reopening a busy group does not reload its
+worksheet after every message. A tail is reloaded after TAIL_TTL seconds
+(the sheet cache TTL), which picks up messages sent through other workers.
+
+New messages are written behind: append() journals the message locally
+(chat_outbox.py) and returns, so the caller can broadcast it without
+waiting for Sheets. A flusher thread writes the journal to the group
+worksheets in batches, one append per group, every FLUSH_INTERVAL seconds
+(sooner once FLUSH_BATCH messages are waiting). Reads merge in journaled
+messages that are not in Sheets yet.
+
+Groups created before partitioning keep their messages in the shared
+chat_messages sheet; they are moved to the group's worksheet the first
+time the group is opened (the group row is then marked "partitioned").
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows dev machines
+    fcntl = None
+
+from chat_outbox import ChatOutbox
+from ratelimit import background_priority
+
+logger = logging.getLogger(__name__)
+
+LEGACY_SHEET = "chat_messages"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+TAIL_SIZE = 200
+TAIL_TTL = 60  # seconds
+FLUSH_INTERVAL = 1.0  # seconds between journal flushes
+FLUSH_BATCH = 200  # messages per flush; also wakes the flusher early
+MESSAGE_FIELDS = ("id", "group_id", "sender", "content", "timestamp")
+# Serializes legacy migrations across the workers of this host
+MIGRATION_LOCK_FILE = Path(os.environ.get(
+    "CHAT_MIGRATION_LOCK_FILE", Path(__file__).parent / "foretag_data" / "chat_migration.lock"
+))
+
+
+def partition_name(gid):
+    """Worksheet holding a group's messages."""
+    return f"chat_{gid}"
+
+
+def _is_partitioned(group):
+    return str(group.get("partitioned", "")).strip().lower() in ("true", "1", "yes")
+
+
+def _ts(msg):
+    return str(msg.get("timestamp", ""))
+
+
+def _position(messages, before):
+    """Index of the message with id `before` (the end for None), or None if it is not there."""
+    if before is None:
+        return len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        if str(messages[i].get("id", "")) == before:
+            return i
+    return None
+
+
+_migration_lock = threading.Lock()
+
+
+@contextmanager
+def _migrating():
+    """Exclusive across threads and worker processes while a group is migrated."""
+    with _migration_lock:
+        if fcntl is None:
+            yield
+            return
+        MIGRATION_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(MIGRATION_LOCK_FILE, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+
+
+class _Tail:
+    """Newest messages of one group; `complete` when it holds the whole partition."""
+
+    def __init__(self, messages):
+        self.messages = deque(messages[-TAIL_SIZE:], maxlen=TAIL_SIZE)
+        self.complete = len(messages) <= TAIL_SIZE
+        self.loaded_at = time.time()
+
+    def append(self, msg):
+        if len(self.messages) == TAIL_SIZE:
+            self.complete = False
+        self.messages.append(msg)
+
+
+class ChatStore:
+    """Per-group message partitions with an in-memory tail per active group."""
+
+    def __init__(self, outbox=None):
+        self.outbox = outbox or ChatOutbox()
+        self._tails = {}
+        self._partitions = set()  # groups whose worksheet is known to exist in this process
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._wake = threading.Event()
+
+    def _group(self, db, gid, fresh=False):
+        for g in db.load_data("chat_groups", fresh=fresh):
+            if str(g.get("id")) == str(gid):
+                return g
+        return None
+
+    def _create_partition(self, db, gid):
+        """Create the group's worksheet with a minimal grid (appends grow it)."""
+        if gid not in self._partitions:
+            db.ensure_sheet(partition_name(gid), MESSAGE_FIELDS)
+            self._partitions.add(gid)
+
+    def _ensure_partition(self, db, gid, group=None):
+        """Create the group's worksheet, moving a legacy group's messages out of chat_messages (once)."""
+        group = group or self._group(db, gid)
+        if group is None:
+            return
+        if _is_partitioned(group):
+            self._create_partition(db, gid)
+            return
+        with _migrating():
+            group = self._group(db, gid, fresh=True)  # another worker may have migrated it meanwhile
+            if group is None or _is_partitioned(group):
+                return
+            self._create_partition(db, gid)
+            legacy = [m for m in db.load_data(LEGACY_SHEET, fresh=True) if str(m.get("group_id")) == str(gid)]
+            if legacy:
+                # Skip what an interrupted migration already copied
+                copied = {str(m.get("id", "")) for m in db.load_data(partition_name(gid), fresh=True)}
+                legacy = [m for m in legacy if not m.get("id") or str(m["id"]) not in copied]
+                legacy.sort(key=_ts)
+                db.append_rows(partition_name(gid), legacy)
+                db.delete_rows_by_field(LEGACY_SHEET, "group_id", gid)
+            db.update_row("chat_groups", "id", gid, {"partitioned": True})
+
+    def _load(self, db, gid):
+        """Whole partition plus journaled messages, oldest first, without duplicate ids."""
+        self._ensure_partition(db, gid)
+        messages = []
+        seen = set()
+        for msg in list(db.load_data(partition_name(gid))) + self.outbox.pending(gid):
+            msg_id = str(msg.get("id", ""))
+            if msg_id and msg_id in seen:
+                continue  # written twice (at-least-once) or still journaled
+            seen.add(msg_id)
+            messages.append(msg)
+        if any(_ts(a) > _ts(b) for a, b in zip(messages, messages[1:])):
+            messages.sort(key=_ts)
+        return messages
+
+    def _tail(self, db, gid):
+        """(tail, partition) — partition is None when a fresh tail was cached."""
+        with self._lock:
+            tail = self._tails.get(gid)
+            if tail is not None and time.time() - tail.loaded_at < TAIL_TTL:
+                return tail, None
+        messages = self._load(db, gid)
+        tail = _Tail(messages)
+        with self._lock:
+            self._tails[gid] = tail
+        return tail, messages
+
+    def page(self, db, gid, before=None, limit=PAGE_SIZE):
+        """
+        Up to `limit` messages of a group, oldest first: the newest ones, or
+        with `before` (a message id) the ones sent before that message. Ids
+        are the cursor because timestamps only have one-second resolution.
+        """
+        gid = str(gid)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        before = None if before is None else str(before)
+        tail, messages = self._tail(db, gid)
+        with self._lock:
+            cached = list(tail.messages)
+            complete = tail.complete
+        end = _position(cached, before)
+        if end is not None and (end >= limit or complete):
+            return cached[max(0, end - limit):end]
+        if end is None and complete:
+            return []
+
+        # Older than the tail reaches: read the partition
+        if messages is None:
+            messages = self._load(db, gid)
+        end = _position(messages, before)
+        if end is None:
+            return []
+        return messages[max(0, end - limit):end]
+
+    def all_messages(self, db):
+        """Every stored message of every group (for indexing), without migrating legacy groups."""
+        messages = list(db.load_data(LEGACY_SHEET))
+        for group in db.load_data("chat_groups"):
+            if _is_partitioned(group):
+                gid = str(group.get("id"))
+                messages.extend(dict(m, group_id=gid) for m in self._load(db, gid))
+        return messages
+
+    def append(self, db, gid, msg):
+        """Journal a new message for the flusher and add it to the group's tail."""
+        gid = str(gid)
+        self.outbox.add(gid, msg)
+        with self._lock:
+            tail = self._tails.get(gid)
+            if tail is not None:
+                tail.append(msg)
+        self.start_flusher(db)
+
+    def flush(self, db, limit=FLUSH_BATCH):
+        """Write one batch of journaled messages to Sheets. Returns how many were written."""
+        batch = self.outbox.claim(limit)
+        by_group = {}
+        for seq, gid, msg in batch:
+            by_group.setdefault(gid, []).append((seq, msg))
+        written = 0
+        error = None
+        with background_priority():
+            for gid, entries in by_group.items():
+                seqs = [seq for seq, _ in entries]
+                try:
+                    # Another worker's group may be newer than our cached list: only a
+                    # fresh read can tell that the group was deleted
+                    group = self._group(db, gid) or self._group(db, gid, fresh=True)
+                    if group is not None:
+                        self._ensure_partition(db, gid, group)
+                        db.append_rows(partition_name(gid), [msg for _, msg in entries])
+                        written += len(entries)
+                    # else: the group was deleted before its messages were written
+                except Exception as e:
+                    error = e
+                    logger.warning(f"Chat flush for group {gid} failed: {e}")
+                    self.outbox.release(seqs)
+                    continue
+                self.outbox.done(seqs)
+        if error is not None and not written:
+            raise error  # nothing got through: let the flusher back off
+        return written
+
+    def start_flusher(self, db, interval=FLUSH_INTERVAL, stop=None):
+        """Run flush() from a daemon thread, once per process (also replays a journal left by a crash)."""
+        stop = stop or threading.Event()
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                if self.outbox.count() >= FLUSH_BATCH:
+                    self._wake.set()
+                return self._flusher
+
+            def run():
+                failures = 0
+                while not stop.is_set():
+                    self._wake.wait(min(60, interval * 2 ** failures))
+                    self._wake.clear()
+                    try:
+                        while self.flush(db) >= FLUSH_BATCH:
+                            pass
+                        failures = 0
+                    except Exception as e:
+                        failures = min(failures + 1, 6)
+                        logger.warning(f"Chat flusher error: {e}")
+
+            self._flusher = threading.Thread(target=run, name="chat-flusher", daemon=True)
+            self._flusher.start()
+            return self._flusher
+
+    def drop(self, db, gid):
+        """Delete all messages of a group (its partition, or its legacy rows)."""
+        gid = str(gid)
+        with self._lock:
+            self._tails.pop(gid, None)
+        self.outbox.discard(gid)
+        db.drop_sheet(partition_name(gid))
+        self._partitions.discard(gid)
+        group = self._group(db, gid)
+        if group is None or not _is_partitioned(group):
+            db.delete_rows_by_field(LEGACY_SHEET, "group_id", gid)
+
+    def clear(self):
+        with self._lock:
+            self._tails.clear()
+            self._partitions.clear()
+
+
+# Singleton
+chat_store = ChatStore()
@@ -0,0 +1,164 @@
+"""
+Unithread App — Unread counters and last-message summaries for chat groups.
+
+Every group has a message counter and a summary of its newest message;
+every (user, group) pair has a read cursor (the counter value the user
+has read up to). send_message bumps the counter, and a user's unread
+count is counter - cursor, so listing groups with unread counts and
+previews is one indexed query instead of reading every group's messages.
+
+State lives in a SQLite file shared by the workers. A group without a
+summary (new disk) is seeded from its newest message with nothing unread,
+and so is a user who was not a member when the group's messages were sent.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+UNREAD_FILE = Path(os.environ.get(
+    "CHAT_UNREAD_FILE", Path(__file__).parent / "foretag_data" / "chat_unread.db"
+))
+PREVIEW_LENGTH = 80
+
+
+def _summary(row):
+    if row is None or row[0] is None:
+        return None
+    msg_id, sender, content, timestamp = row
+    return {"id": msg_id, "sender": sender, "content": content, "timestamp": timestamp}
+
+
+class UnreadTracker:
+    """Per-group message counters and per-user read cursors backed by SQLite."""
+
+    def __init__(self, path=UNREAD_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS groups (
+                    group_id TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    last_id TEXT,
+                    last_sender TEXT,
+                    last_preview TEXT,
+                    last_timestamp TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cursors (
+                    username TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    PRIMARY KEY (username, group_id)
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def missing(self, gids):
+        """The groups among gids that have no summary yet."""
+        gids = [str(g) for g in gids]
+        if not gids:
+            return []
+        with self._lock:
+            known = {r[0] for r in self._connect().execute(
+                f"SELECT group_id FROM groups WHERE group_id IN ({','.join('?' * len(gids))})", gids)}
+        return [g for g in gids if g not in known]
+
+    def seed(self, gid, last_msg=None):
+        """Create a missing group summary from its newest message, with nothing unread."""
+        msg = last_msg or {}
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO groups VALUES (?, 0, ?, ?, ?, ?)",
+                         (str(gid), msg.get("id"), msg.get("sender"),
+                          str(msg.get("content", ""))[:PREVIEW_LENGTH] if msg else None,
+                          msg.get("timestamp")))
+            conn.commit()
+
+    def record_message(self, gid, msg, members=()):
+        """
+        Count a new message. Members without a cursor get one just before
+        it (so it counts as unread for them); the sender has read it.
+        Returns the group's new counter.
+        """
+        gid = str(gid)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO groups (group_id, seq) VALUES (?, 0)", (gid,))
+            before = conn.execute("SELECT seq FROM groups WHERE group_id = ?", (gid,)).fetchone()[0]
+            conn.executemany("INSERT OR IGNORE INTO cursors VALUES (?, ?, ?)",
+                             [(m, gid, before) for m in members])
+            conn.execute("""
+                UPDATE groups SET seq = seq + 1, last_id = ?, last_sender = ?,
+                                  last_preview = ?, last_timestamp = ?
+                WHERE group_id = ?
+            """, (msg.get("id"), msg.get("sender"), str(msg.get("content", ""))[:PREVIEW_LENGTH],
+                  msg.get("timestamp"), gid))
+            if msg.get("sender"):
+                conn.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)", (msg["sender"], gid, before + 1))
+            conn.commit()
+        return before + 1
+
+    def mark_read(self, username, gid):
+        """Move the user's cursor to the group's newest message."""
+        gid = str(gid)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("""
+                INSERT OR REPLACE INTO cursors
+                SELECT ?, ?, COALESCE((SELECT seq FROM groups WHERE group_id = ?), 0)
+            """, (username, gid, gid))
+            conn.commit()
+
+    def summaries(self, username, gids):
+        """{gid: {"unread", "last_message"}} for the user's groups, in one query."""
+        gids = [str(g) for g in gids]
+        if not gids:
+            return {}
+        marks = ",".join("?" * len(gids))
+        with self._lock:
+            conn = self._connect()
+            # A user seen for the first time in a group has read everything so far
+            conn.execute(f"""
+                INSERT OR IGNORE INTO cursors
+                SELECT ?, group_id, seq FROM groups WHERE group_id IN ({marks})
+            """, (username, *gids))
+            conn.commit()
+            rows = conn.execute(f"""
+                SELECT g.group_id, g.seq - COALESCE(c.seq, g.seq),
+                       g.last_id, g.last_sender, g.last_preview, g.last_timestamp
+                FROM groups g
+                LEFT JOIN cursors c ON c.group_id = g.group_id AND c.username = ?
+                WHERE g.group_id IN ({marks})
+            """, (username, *gids)).fetchall()
+        result = {gid: {"unread": 0, "last_message": None} for gid in gids}
+        for gid, unread, *last in rows:
+            result[gid] = {"unread": max(0, unread), "last_message": _summary(last)}
+        return result
+
+    def unread(self, username, gid):
+        return self.summaries(username, [gid])[str(gid)]["unread"]
+
+    def forget(self, gid):
+        """Drop a deleted group's counter and cursors."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM groups WHERE group_id = ?", (str(gid),))
+            conn.execute("DELETE FROM cursors WHERE group_id = ?", (str(gid),))
+            conn.commit()
+
+
+# Singleton
+unread_tracker = UnreadTracker()
@@ -0,0 +1,277 @@
+"""
+Unithread App — Resumable chunked uploads.
+
+Large files are sent as a series of raw chunks instead of one multipart
+request, so they are never buffered whole (MAX_CONTENT_LENGTH only limits
+each chunk) and an interrupted upload continues where it stopped:
+
+    POST /api/uploads                  {filename, size, target} → upload id
+    PUT  /api/uploads/<id>?offset=N    raw bytes, appended at N
+    GET  /api/uploads/<id>             → offset to resume from
+    POST /api/uploads/<id>/complete    → stored blob (see blob_store.py)
+
+Chunks are streamed to a partial file and hashed as they arrive; the
+hash state lives in memory and is rebuilt from the partial file when a
+chunk lands on another worker or after a restart. Upload state is kept
+in a SQLite file shared by the workers; a chunk takes a short lease on
+its upload so two requests cannot write the same upload at once.
+
+A completed upload holds one blob reference until a receipt or project
+file row claims it. Uploads left unfinished or unclaimed for UPLOAD_TTL
+seconds are removed by sweep().
+"""
+
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+from blob_store import blob_store, blob_name, CHUNK_SIZE as READ_SIZE
+
+UPLOADS_FILE = Path(os.environ.get(
+    "CHUNKED_UPLOADS_FILE", Path(__file__).parent / "foretag_data" / "uploads.db"
+))
+PARTIAL_DIR = Path(os.environ.get(
+    "PARTIAL_UPLOAD_DIR", Path(__file__).parent / "uploads" / "partial"
+))
+CHUNK_SIZE = 8 * 1024 * 1024  # suggested chunk size, well under MAX_CONTENT_LENGTH
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 2 * 1024 ** 3))  # bytes
+UPLOAD_TTL = 24 * 3600  # seconds an upload may stay unfinished or unclaimed
+LEASE_SECONDS = 300  # a chunk write older than this is assumed dead
+SWEEP_INTERVAL = 3600  # seconds between sweeps triggered by create()
+
+
+class OffsetMismatch(ValueError):
+    """A chunk did not start where the upload stands; `offset` is where to resume."""
+
+    def __init__(self, offset):
+        super().__init__(f"Uppladdningen fortsätter vid byte {offset}")
+        self.offset = offset
+
+
+_COLUMNS = ("id", "user", "namespace", "folder", "filename", "size", "received",
+            "writing_at", "sha256", "name", "created", "updated")
+
+
+class UploadSessions:
+    """Resumable upload state (SQLite) and partial files on disk."""
+
+    def __init__(self, path=UPLOADS_FILE, partial_dir=PARTIAL_DIR):
+        self.path = Path(path)
+        self.partial_dir = Path(partial_dir)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._hashers = {}  # upload id -> (bytes hashed, sha256 object), this process only
+        self._swept_at = 0.0
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    id TEXT PRIMARY KEY,
+                    user TEXT NOT NULL,
+                    namespace TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    received INTEGER NOT NULL,
+                    writing_at REAL,
+                    sha256 TEXT,
+                    name TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _partial(self, upload_id):
+        return self.partial_dir / upload_id
+
+    def get(self, upload_id):
+        """The upload as a dict, or None."""
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM uploads WHERE id = ?", (str(upload_id),)
+            ).fetchone()
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def _owned(self, upload_id, user):
+        upload = self.get(upload_id)
+        if upload is None:
+            raise LookupError("Uppladdningen finns inte")
+        if upload["user"] != user:
+            raise PermissionError("Ingen behörighet")
+        return upload
+
+    def create(self, user, namespace, folder, filename, size):
+        """Start an upload of `size` bytes into folder. Returns the upload dict."""
+        size = int(size)
+        if size < 0 or size > MAX_UPLOAD_SIZE:
+            raise ValueError(f"Filen är för stor (max {MAX_UPLOAD_SIZE // 1024 ** 2} MB)")
+        if not filename:
+            raise ValueError("Filnamn saknas")
+        if time.time() - self._swept_at > SWEEP_INTERVAL:
+            self.sweep()
+        upload_id = uuid.uuid4().hex
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self._partial(upload_id).touch()
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("""
+                INSERT INTO uploads (id, user, namespace, folder, filename, size, received, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)
+            """, (upload_id, user, namespace, str(folder), str(filename)[:255], size, now, now))
+            conn.commit()
+        return self.get(upload_id)
+
+    def write_chunk(self, upload_id, user, offset, stream):
+        """
+        Append a chunk read from `stream` at `offset` (which must be where
+        the upload stands). Returns the new offset.
+        """
+        upload = self._owned(upload_id, user)
+        offset = int(offset)
+        if upload["name"]:
+            raise ValueError("Uppladdningen är redan klar")
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            leased = conn.execute("""
+                UPDATE uploads SET writing_at = ?
+                WHERE id = ? AND received = ? AND (writing_at IS NULL OR writing_at < ?)
+            """, (now, upload_id, offset, now - LEASE_SECONDS)).rowcount
+            conn.commit()
+        if not leased:
+            current = self.get(upload_id)
+            raise OffsetMismatch(current["received"] if current else 0)
+
+        received = offset
+        hasher = None
+        try:
+            _, hasher = self._hasher(upload_id, offset)
+            with open(self._partial(upload_id), "r+b") as out:
+                out.seek(offset)
+                out.truncate()  # bytes of a chunk that broke off earlier
+                while True:
+                    data = stream.read(READ_SIZE)
+                    if not data:
+                        break
+                    if received + len(data) > upload["size"]:
+                        raise ValueError("Mer data än den angivna filstorleken")
+                    out.write(data)
+                    hasher.update(data)
+                    received += len(data)
+        finally:
+            if hasher is not None:
+                self._hashers[upload_id] = (received, hasher)
+            with self._lock:
+                conn = self._connect()
+                conn.execute("UPDATE uploads SET received = ?, writing_at = NULL, updated = ? WHERE id = ?",
+                             (received, time.time(), upload_id))
+                conn.commit()
+        return received
+
+    def _hasher(self, upload_id, offset):
+        """SHA-256 state over the first `offset` bytes (re-read from disk if not in memory)."""
+        hashed, hasher = self._hashers.pop(upload_id, (None, None))
+        if hashed == offset:
+            return hashed, hasher
+        hasher = hashlib.sha256()
+        remaining = offset
+        with open(self._partial(upload_id), "rb") as f:
+            while remaining:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+        return offset, hasher
+
+    def complete(self, upload_id, user, sha256=None):
+        """
+        Store a fully received upload as a blob (holding one reference until
+        claimed). A mismatching `sha256` from the client restarts the upload.
+        """
+        upload = self._owned(upload_id, user)
+        if upload["name"]:
+            return upload
+        if upload["received"] != upload["size"]:
+            raise OffsetMismatch(upload["received"])
+        _, hasher = self._hasher(upload_id, upload["received"])
+        self._hashers.pop(upload_id, None)
+        digest = hasher.hexdigest()
+        if sha256 and sha256.lower() != digest:
+            with open(self._partial(upload_id), "r+b") as f:
+                f.truncate(0)
+            with self._lock:
+                conn = self._connect()
+                conn.execute("UPDATE uploads SET received = 0 WHERE id = ?", (upload_id,))
+                conn.commit()
+            raise ValueError("Kontrollsumman stämmer inte — ladda upp filen igen")
+        name = blob_name(digest, upload["filename"])
+        Path(upload["folder"]).mkdir(parents=True, exist_ok=True)
+        blob_store.add(upload["namespace"], upload["folder"], name, upload["size"],
+                       source=self._partial(upload_id))
+        self._partial(upload_id).unlink(missing_ok=True)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE uploads SET sha256 = ?, name = ?, updated = ? WHERE id = ?",
+                         (digest, name, time.time(), upload_id))
+            conn.commit()
+        return self.get(upload_id)
+
+    def claim(self, upload_id, user, namespace):
+        """
+        Hand a completed upload's blob reference to the caller's new row.
+        Returns {"name", "filename", "size"}.
+        """
+        upload = self._owned(upload_id, user)
+        if upload["namespace"] != namespace or not upload["name"]:
+            raise ValueError("Uppladdningen är inte klar")
+        with self._lock:
+            conn = self._connect()
+            claimed = conn.execute("DELETE FROM uploads WHERE id = ? AND name IS NOT NULL",
+                                   (upload_id,)).rowcount
+            conn.commit()
+        if not claimed:
+            raise LookupError("Uppladdningen finns inte")
+        return {"name": upload["name"], "filename": upload["filename"], "size": upload["size"]}
+
+    def abort(self, upload_id, user):
+        """Cancel an upload and drop what it stored."""
+        self._discard(self._owned(upload_id, user))
+
+    def _discard(self, upload):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM uploads WHERE id = ?", (upload["id"],))
+            conn.commit()
+        self._hashers.pop(upload["id"], None)
+        self._partial(upload["id"]).unlink(missing_ok=True)
+        if upload["name"]:
+            blob_store.release(upload["namespace"], upload["folder"], upload["name"])
+
+    def sweep(self, ttl=UPLOAD_TTL):
+        """Remove uploads untouched for `ttl` seconds. Returns how many."""
+        self._swept_at = time.time()
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM uploads WHERE updated < ?", (time.time() - ttl,)
+            ).fetchall()
+        for row in rows:
+            self._discard(dict(zip(_COLUMNS, row)))
+        return len(rows)
+
+
+# Singleton
+upload_sessions = UploadSessions()
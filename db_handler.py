@@ -13,6 +13,9 @@ import time
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 import pickle
+import threading
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 
 # --- KONFIGURATION ---
 SCOPES = [
@@ -33,6 +36,7 @@ class DBHandler:
         self.sheet = None
         self.drive_service = None
         self.drive_folder_id = None
+        self._local = threading.local()  # httplib2 är inte trådsäkert: en Http per tråd
         self._authenticate()
 
     def _authenticate(self):
@@ -192,13 +196,42 @@ class DBHandler:
             self._retry_api_call(
                 lambda: ws.append_row(list(row_dict.values())))
 
-    def upload_file(self, file_obj, filename, folder_subpath=None):
-        """Laddar upp en fil till Google Drive och returnerar ID/Länk."""
+    def replace_in_column(self, sheet_name, field, old, new):
+        """Byter `old` mot `new` i den första cellen i kolumnen `field` som innehåller `old`.
+        Skriver bara den cellen, så fliken skrivs aldrig om. Returnerar False om ingen cell matchar."""
+        ws = self._get_worksheet(sheet_name)
+        headers = self._retry_api_call(lambda: ws.row_values(1))
+        if field not in headers:
+            return False
+        col = headers.index(field) + 1
+        values = self._retry_api_call(lambda: ws.col_values(col))
+        for row, value in enumerate(values[1:], start=2):
+            if old in str(value):
+                self._retry_api_call(lambda: ws.update_cell(row, col, str(value).replace(old, new)))
+                return True
+        return False
+
+    def _thread_http(self):
+        """Autentiserad Http för den aktuella tråden (uppladdningskön kör flera samtidigt)."""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return http
+
+    def create_drive_file(self, file_obj, filename):
+        """Laddar upp en fil till Google Drive och returnerar länken. Fel kastas vidare."""
+        if not self.drive_folder_id:
+            self._find_drive_folder()
+
+        if not self.drive_folder_id:
+            # Försök en gång till med en bredare sökning om det behövs, eller ge upp
+            raise Exception(
+                f"Mappen '{DRIVE_FOLDER_NAME}' hittades inte. Kontrollera att den är delad med: {self.creds.service_account_email}")
 
         # Metadata för filen
         file_metadata = {
             'name': filename,
-            'parents': [self.drive_folder_id] if self.drive_folder_id else []
+            'parents': [self.drive_folder_id]
         }
 
         # Skapa media-objekt
@@ -207,26 +240,19 @@ class DBHandler:
 
         # Ladda upp
         # Lägg till supportsAllDrives=True för att stödja uppladdning till delade enheter
-        try:
-            if not self.drive_folder_id:
-                self._find_drive_folder()
-
-            if not self.drive_folder_id:
-                # Försök en gång till med en bredare sökning om det behövs, eller ge upp
-                raise Exception(
-                    f"Mappen '{DRIVE_FOLDER_NAME}' hittades inte. Kontrollera att den är delad med: {self.creds.service_account_email}")
-
-            # Uppdatera parents om vi hittade IDt nu
-            file_metadata['parents'] = [self.drive_folder_id]
+        file = self.drive_service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id, webContentLink, webViewLink',
+            supportsAllDrives=True
+        ).execute(http=self._thread_http())
 
-            file = self.drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webContentLink, webViewLink',
-                supportsAllDrives=True
-            ).execute()
+        return file.get('webViewLink')  # Länk för att visa filen
 
-            return file.get('webViewLink')  # Länk för att visa filen
+    def upload_file(self, file_obj, filename, folder_subpath=None):
+        """Laddar upp en fil till Google Drive och returnerar ID/Länk."""
+        try:
+            return self.create_drive_file(file_obj, filename)
 
         except Exception as e:
             error_msg = str(e)
@@ -0,0 +1,270 @@
+"""
+Unithread App — Background upload queue for Google Drive.
+
+The Streamlit apps used to upload an attached file to Drive while the
+user waited. Now the file is saved locally and queued here, the receipt
+is saved at once, and a background worker uploads queued files
+(DRIVE_UPLOAD_WORKERS at a time). A failed upload is retried with
+exponential backoff, up to MAX_ATTEMPTS times. Some errors are never
+retried: the local file is gone, or the Drive account has no storage quota.
+
+Once uploaded, the Drive link is handed to the write-back function
+registered for the row's target (e.g. "kvitto_app"). That function
+stores the link in the row that has the file attached. If that row is
+not saved yet, or was deleted, the write-back is retried until LINK_TTL
+has passed. Links stay queryable with links() for LINK_TTL, so an app
+saving a copy of its data loaded before the write-back can put the link
+back instead of losing it.
+
+The queue is a SQLite file, so uploads left unfinished by a restart are
+picked up by the next worker. Rows are claimed with a lease so that
+processes sharing the file do not upload the same file twice.
+"""
+
+import os
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DRIVE_QUEUE_FILE = Path(os.environ.get(
+    "DRIVE_QUEUE_FILE", Path(__file__).parent / "foretag_data" / "drive_uploads.db"
+))
+DRIVE_UPLOAD_WORKERS = int(os.environ.get("DRIVE_UPLOAD_WORKERS", 2))
+MAX_ATTEMPTS = 8
+RETRY_BASE = 15  # seconds before the first retry; doubles per attempt
+RETRY_MAX = 3600  # longest wait between two attempts
+LINK_TTL = 7 * 24 * 3600  # stop trying to write back a link after this (its row is gone)
+LEASE_SECONDS = 600  # a claim older than this is taken over (its worker died)
+POLL_INTERVAL = 5.0  # seconds between queue checks when idle
+
+# Errors that retrying does not fix
+PERMANENT_ERRORS = ("storage quota", "storageQuotaExceeded")
+
+_COLUMNS = ("id", "target", "ref", "path", "filename", "status", "attempts", "next_attempt",
+            "link", "error", "created")
+
+
+def _drive_upload(path, filename):
+    """Upload a local file with the Streamlit apps' Drive credentials. Returns its link."""
+    from db_handler import db  # authenticates on import: only inside the Streamlit apps
+    with open(path, "rb") as f:
+        return db.create_drive_file(f, filename)
+
+
+def _is_permanent(error):
+    if isinstance(error, FileNotFoundError):
+        return True
+    return any(marker in str(error) for marker in PERMANENT_ERRORS)
+
+
+class DriveUploadQueue:
+    """Persistent queue of files waiting for Drive, worked off by a background thread."""
+
+    def __init__(self, path=DRIVE_QUEUE_FILE, workers=DRIVE_UPLOAD_WORKERS, uploader=None):
+        self.path = Path(path)
+        self.workers = workers
+        self.uploader = uploader or _drive_upload
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._conn = None
+        self._lock = threading.Lock()
+        self._handlers = {}  # target -> write_back(ref, filename, link) -> bool
+        self._pool = None
+        self._worker = None
+        self._wake = threading.Event()
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    ref TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    link TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS uploads_due ON uploads (status, next_attempt)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def register(self, target, write_back):
+        """
+        Handle the uploads of a target in this process. write_back(ref,
+        filename, link) stores the link and returns False if the row the
+        file belongs to was not found (it is then retried later).
+        """
+        self._handlers[target] = write_back
+
+    def enqueue(self, target, ref, path, filename=None):
+        """Queue a saved local file for upload. Returns the queue id."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            cur = conn.execute("""
+                INSERT INTO uploads (target, ref, path, filename, status, next_attempt, created)
+                VALUES (?, ?, ?, ?, 'pending', ?, ?)
+            """, (target, str(ref), str(path), filename or Path(path).name, now, now))
+            conn.commit()
+        self._wake.set()
+        return cur.lastrowid
+
+    def get(self, upload_id):
+        """The queue row as a dict, or None."""
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM uploads WHERE id = ?", (upload_id,)
+            ).fetchone()
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def status(self, target, ref):
+        """'pending' (waiting for Drive), 'uploaded' (link not written back yet), 'done', 'failed' or None."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT status FROM uploads WHERE target = ? AND ref = ? ORDER BY id DESC LIMIT 1",
+                (target, str(ref)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def links(self, target, refs):
+        """{ref: Drive link} of the given refs that are uploaded."""
+        refs = [str(r) for r in refs]
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(refs), 400):
+                chunk = refs[i:i + 400]
+                rows = conn.execute(f"""
+                    SELECT ref, link FROM uploads
+                    WHERE target = ? AND link IS NOT NULL AND ref IN ({",".join("?" * len(chunk))})
+                """, (target, *chunk)).fetchall()
+                found.update(rows)
+        return found
+
+    def claim(self, limit):
+        """Lease up to `limit` due rows of the registered targets."""
+        targets = list(self._handlers)
+        if not targets:
+            return []
+        now = time.time()
+        marks = ",".join("?" * len(targets))
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM uploads WHERE status = 'done' AND created < ?", (now - LINK_TTL,))
+            conn.execute(f"""
+                UPDATE uploads SET claimed_by = ?, claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM uploads
+                    WHERE status IN ('pending', 'uploaded') AND next_attempt <= ?
+                      AND target IN ({marks})
+                      AND (claimed_at IS NULL OR claimed_at < ?)
+                    ORDER BY id LIMIT ?
+                )
+            """, (self.owner, now, now, *targets, now - LEASE_SECONDS, int(limit)))
+            conn.commit()
+            rows = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM uploads WHERE claimed_by = ? AND claimed_at = ? ORDER BY id",
+                (self.owner, now),
+            ).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def _release(self, upload_id, **fields):
+        """Update a claimed row and give up the claim."""
+        self._set(upload_id, claimed_by=None, claimed_at=None, **fields)
+
+    def _set(self, upload_id, **fields):
+        sets = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(f"UPDATE uploads SET {sets} WHERE id = ?", (*fields.values(), upload_id))
+            conn.commit()
+
+    def _retry(self, row, error):
+        attempts = row["attempts"] + 1
+        delay = min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1))
+        self._release(row["id"], attempts=attempts, next_attempt=time.time() + delay, error=str(error)[:500])
+
+    def process(self, row):
+        """Upload one claimed row (unless done already) and write its link back."""
+        if row["status"] == "pending":
+            try:
+                link = self.uploader(row["path"], row["filename"])
+                if not link:
+                    raise RuntimeError("Drive returnerade ingen länk")
+            except Exception as e:
+                logger.warning(f"Drive upload of {row['filename']} failed: {e}")
+                if _is_permanent(e) or row["attempts"] + 1 >= MAX_ATTEMPTS:
+                    self._release(row["id"], status="failed", attempts=row["attempts"] + 1, error=str(e)[:500])
+                else:
+                    self._retry(row, e)
+                return
+            self._set(row["id"], status="uploaded", link=link, attempts=0, error=None)  # still claimed
+            row = dict(row, status="uploaded", link=link, attempts=0)
+
+        try:
+            linked = self._handlers[row["target"]](row["ref"], row["filename"], row["link"])
+        except Exception as e:
+            logger.warning(f"Could not record Drive link of {row['filename']}: {e}")
+            linked = False
+        if linked:
+            self._release(row["id"], status="done", error=None)  # kept for links() until LINK_TTL
+        elif time.time() - row["created"] > LINK_TTL:
+            self._release(row["id"], status="failed", error="Raden som filen hör till finns inte längre")
+        else:
+            self._retry(row, "Raden som filen hör till hittades inte")
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="drive-upload")
+            return self._pool
+
+    def run_once(self):
+        """Process one batch of due rows, at most `workers` at a time. Returns how many."""
+        rows = self.claim(self.workers)
+        if rows:
+            list(self._executor().map(self.process, rows))
+        return len(rows)
+
+    def start(self, interval=POLL_INTERVAL, stop=None):
+        """Work off the queue from a daemon thread, once per process."""
+        stop = stop or threading.Event()
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return self._worker
+
+            def run():
+                while not stop.is_set():
+                    try:
+                        while self.run_once():
+                            pass
+                    except Exception as e:
+                        logger.warning(f"Drive upload worker error: {e}")
+                    self._wake.wait(interval)
+                    self._wake.clear()
+
+            self._worker = threading.Thread(target=run, name="drive-uploads", daemon=True)
+            self._worker.start()
+            return self._worker
+
+
+# Singleton
+drive_queue = DriveUploadQueue()
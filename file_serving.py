@@ -0,0 +1,76 @@
+"""
+Unithread App — Serving uploaded files with HTTP caching and ranges.
+
+Content-addressed uploads (<sha256><ext>, see blob_store.py) and their
+thumbnails never change, so their name is a strong ETag and they are sent
+with an immutable one-year Cache-Control: a browser shows a receipt it has
+seen without asking again. Older uploads get an mtime/size ETag and
+"no-cache", so they are revalidated and answered with 304 when unchanged.
+If-None-Match → 304 and Range → 206 (partial PDF/video loading) are
+handled by send_file's conditional mode.
+
+Optionally the body is left to the front web server, which streams files
+far more cheaply than a Python worker. UPLOAD_OFFLOAD selects the mode:
+
+    x-sendfile        Apache mod_xsendfile / lighttpd: X-Sendfile: <absolute path>
+    x-accel-redirect  nginx: X-Accel-Redirect: <UPLOAD_ACCEL_PREFIX>/<folder>/<file>
+
+For nginx, map the prefix to the uploads directory in an internal location:
+
+    location /_uploads/ { internal; alias /app/uploads/; }
+"""
+
+import os
+import re
+import mimetypes
+from pathlib import Path
+
+from flask import request, send_file, abort, Response
+from werkzeug.security import safe_join
+
+UPLOAD_OFFLOAD = os.environ.get("UPLOAD_OFFLOAD", "").strip().lower()
+UPLOAD_ACCEL_PREFIX = os.environ.get("UPLOAD_ACCEL_PREFIX", "/_uploads").rstrip("/")
+IMMUTABLE = "private, max-age=31536000, immutable"
+REVALIDATE = "private, no-cache"
+
+# <sha256><ext>, or a thumbnail of one: <sha256><ext>-<width>.jpg
+_CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,10})?(-\d+\.jpg)?$")
+
+
+def content_etag(name):
+    """Strong ETag for a content-addressed name (the name itself), else None."""
+    return name if _CONTENT_ADDRESSED.match(name) else None
+
+
+def send_upload(folder, filename, offload=None):
+    """
+    Response for an uploaded file below folder (404 if missing), with
+    ETag, Cache-Control, 304 and Range support, optionally offloaded.
+    """
+    path = safe_join(str(folder), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = content_etag(Path(path).name)
+    offload = UPLOAD_OFFLOAD if offload is None else offload
+
+    if offload in ("x-sendfile", "x-accel-redirect"):
+        if etag is None:
+            stat = os.stat(path)
+            etag = f"{int(stat.st_mtime)}-{stat.st_size}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            response = Response(mimetype=mimetype)
+            if offload == "x-sendfile":
+                response.headers["X-Sendfile"] = os.path.abspath(path)
+            else:
+                relative = Path(path).relative_to(Path(folder).parent).as_posix()
+                response.headers["X-Accel-Redirect"] = f"{UPLOAD_ACCEL_PREFIX}/{relative}"
+        response.set_etag(etag)
+    else:
+        # conditional=True answers If-None-Match with 304 and Range with 206
+        response = send_file(path, conditional=True, etag=etag or True)
+
+    response.headers["Cache-Control"] = IMMUTABLE if content_etag(Path(path).name) else REVALIDATE
+    return response
@@ -1,6 +1,10 @@
 """
 Google Sheets database handler for Unithread App.
 No Streamlit dependency — pure Python with gspread.
+
+Importing this module does no network I/O: `db` authenticates and opens
+the spreadsheet on first use. The first admin user is created with the
+one-time command `python init_admin.py`, not at startup.
 """
 
 import gspread
@@ -9,9 +13,13 @@ import json
 import os
 import time
 import hashlib
+import threading
 from pathlib import Path
 from datetime import datetime
 
+from ratelimit import sheets_governor, current_priority
+from snapshot import snapshot_reader
+
 # --- Configuration ---
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -23,6 +31,7 @@ SPREADSHEET_ID = "1VHeYLxhU-ItlS0snz-trqp9mEjk7FchC3zymbidYNE4"
 # In-memory cache with TTL
 _cache = {}
 _cache_ttl = {}
+_written_at = {}  # sheet -> time of this process's last write
 CACHE_DURATION = 60  # seconds
 
 
@@ -31,8 +40,23 @@ class GoogleSheetsDB:
 
     def __init__(self):
         self.client = None
-        self.sheet = None
-        self._authenticate()
+        self._sheet = None
+        self._connect_lock = threading.Lock()
+
+    def reset_connection(self):
+        """Drop the client so the next access reconnects (after a fork)."""
+        with self._connect_lock:
+            self.client = None
+            self._sheet = None
+
+    @property
+    def sheet(self):
+        """The spreadsheet, authenticating on first access."""
+        if self._sheet is None:
+            with self._connect_lock:
+                if self._sheet is None:
+                    self._authenticate()
+        return self._sheet
 
     def _authenticate(self):
         """Authenticate with Google using service account (file or env var)."""
@@ -48,18 +72,27 @@ class GoogleSheetsDB:
                 str(SERVICE_ACCOUNT_FILE), scopes=SCOPES
             )
         self.client = gspread.authorize(creds)
-        self.sheet = self.client.open_by_key(SPREADSHEET_ID)
+        self._sheet = self.client.open_by_key(SPREADSHEET_ID)
 
-    def _retry(self, func, max_retries=3):
-        """Execute a function with retry logic for transient errors."""
+    def _retry(self, func, max_retries=3, write=False):
+        """
+        Execute a function with retry logic for transient errors. Every
+        attempt first takes a slot from the shared Sheets request budget.
+        """
+        priority = current_priority(write)
         last_exc = None
         for attempt in range(max_retries):
+            sheets_governor.acquire(priority)
             try:
                 return func()
             except gspread.exceptions.APIError as e:
                 last_exc = e
                 status = e.response.status_code if hasattr(e, 'response') else 0
-                if status in (429, 500, 502, 503, 504) and attempt < max_retries - 1:
+                if status == 429 and attempt < max_retries - 1:
+                    # Quota exceeded: hold every caller, not just this one
+                    sheets_governor.pause(2 ** attempt)
+                    continue
+                if status in (500, 502, 503, 504) and attempt < max_retries - 1:
                     time.sleep(2 ** attempt)
                     continue
                 raise
@@ -82,19 +115,57 @@ class GoogleSheetsDB:
             return self._retry(lambda: self.sheet.worksheet(name))
         except gspread.WorksheetNotFound:
             return self._retry(
-                lambda: self.sheet.add_worksheet(title=name, rows=1000, cols=26)
+                lambda: self.sheet.add_worksheet(title=name, rows=1000, cols=26), write=True
             )
 
+    def ensure_sheet(self, sheet_name, headers):
+        """
+        Create a worksheet holding only its header row, unless it exists.
+        For sheets that only grow by append_rows (e.g. one per chat group):
+        the default 1000×26 grid would count 26k cells against the
+        spreadsheet's cell limit for every one of them.
+        """
+        try:
+            self._retry(lambda: self.sheet.worksheet(sheet_name))
+            return
+        except gspread.WorksheetNotFound:
+            pass
+        try:
+            ws = self._retry(
+                lambda: self.sheet.add_worksheet(title=sheet_name, rows=1, cols=len(headers)), write=True
+            )
+        except gspread.exceptions.APIError as e:
+            if "already exists" in str(e):
+                return  # created by another worker meanwhile
+            raise
+        self._retry(lambda: ws.update([list(headers)], "A1", value_input_option='USER_ENTERED'), write=True)
+        self._invalidate_cache(sheet_name)
+
+    def _grow_columns(self, ws, count):
+        """Widen a worksheet's grid to hold `count` columns."""
+        if count > ws.col_count:
+            self._retry(lambda: ws.add_cols(count - ws.col_count), write=True)
+
     def _invalidate_cache(self, sheet_name):
         """Remove cached data for a worksheet."""
         _cache.pop(sheet_name, None)
         _cache_ttl.pop(sheet_name, None)
+        _written_at[sheet_name] = time.time()
 
-    def load_data(self, sheet_name):
-        """Load all rows from a worksheet as list of dicts. Cached."""
+    def load_data(self, sheet_name, fresh=False):
+        """
+        Load all rows from a worksheet as list of dicts. Cached, and served
+        from the shared snapshot (see snapshot.py) when that is recent enough.
+        fresh=True always reads from Sheets.
+        """
         now = time.time()
-        if sheet_name in _cache and now - _cache_ttl.get(sheet_name, 0) < CACHE_DURATION:
-            return _cache[sheet_name]
+        if not fresh:
+            if sheet_name in _cache and now - _cache_ttl.get(sheet_name, 0) < CACHE_DURATION:
+                return _cache[sheet_name]
+            snap = snapshot_reader.get(sheet_name, CACHE_DURATION, _written_at.get(sheet_name, 0.0))
+            if snap is not None:
+                _cache[sheet_name], _cache_ttl[sheet_name] = snap
+                return _cache[sheet_name]
 
         ws = self._get_worksheet(sheet_name)
         try:
@@ -112,7 +183,7 @@ class GoogleSheetsDB:
         ws = self._get_worksheet(sheet_name)
 
         if not data_list:
-            self._retry(lambda: ws.clear())
+            self._retry(lambda: ws.clear(), write=True)
             return
 
         # Build header from all keys across all rows
@@ -135,8 +206,8 @@ class GoogleSheetsDB:
                 row.append(val)
             rows.append(row)
 
-        self._retry(lambda: ws.clear())
-        self._retry(lambda: ws.update(rows, value_input_option='USER_ENTERED'))
+        self._retry(lambda: ws.clear(), write=True)
+        self._retry(lambda: ws.update(rows, value_input_option='USER_ENTERED'), write=True)
 
     def append_row(self, sheet_name, row_dict):
         """Append a single row to a worksheet."""
@@ -147,7 +218,7 @@ class GoogleSheetsDB:
         if not existing:
             # Empty sheet — write headers first
             headers = list(row_dict.keys())
-            self._retry(lambda: ws.append_row(headers, value_input_option='USER_ENTERED'))
+            self._retry(lambda: ws.append_row(headers, value_input_option='USER_ENTERED'), write=True)
             values = list(row_dict.values())
         else:
             headers = existing
@@ -170,7 +241,44 @@ class GoogleSheetsDB:
             else:
                 clean_values.append(v)
 
-        self._retry(lambda: ws.append_row(clean_values, value_input_option='USER_ENTERED'))
+        self._retry(lambda: ws.append_row(clean_values, value_input_option='USER_ENTERED'), write=True)
+
+    def append_rows(self, sheet_name, rows):
+        """Append many rows to a worksheet with a single API call."""
+        if not rows:
+            return
+        self._invalidate_cache(sheet_name)
+        ws = self._get_worksheet(sheet_name)
+
+        existing = self._retry(lambda: ws.row_values(1))
+        headers = list(existing)
+        for row in rows:
+            for key in row.keys():
+                if key not in headers:
+                    headers.append(key)
+
+        if len(headers) > len(existing):
+            self._grow_columns(ws, len(headers))  # appends add rows, not columns
+        values = []
+        if not existing:
+            # Empty sheet — write headers first
+            values.append(headers)
+        elif len(headers) > len(existing):
+            # New columns (e.g. source/source_id) — extend the header row
+            self._retry(lambda: ws.update([headers], "A1", value_input_option='USER_ENTERED'), write=True)
+
+        for row in rows:
+            line = []
+            for h in headers:
+                val = row.get(h, "")
+                if isinstance(val, (dict, list)):
+                    val = json.dumps(val, ensure_ascii=False)
+                elif val is None:
+                    val = ""
+                line.append(val)
+            values.append(line)
+
+        self._retry(lambda: ws.append_rows(values, value_input_option='USER_ENTERED'), write=True)
 
     def delete_rows_by_field(self, sheet_name, field, value):
         """Delete all rows where field == value."""
@@ -186,15 +294,102 @@ class GoogleSheetsDB:
                 row.update(updates)
         self.save_data(sheet_name, data)
 
+    def _find_row(self, ws, field, value):
+        """(headers, sheet row number) of the first row where field == value; row is None if absent."""
+        headers = self._retry(lambda: ws.row_values(1))
+        if field not in headers:
+            return headers, None
+        col = headers.index(field) + 1
+        cell = self._retry(lambda: ws.find(str(value), in_column=col))
+        if cell is None or cell.row == 1:
+            return headers, None
+        return headers, cell.row
+
+    def update_row(self, sheet_name, field, value, updates):
+        """
+        Update the first row where field == value, writing only the changed
+        cells instead of rewriting the sheet. Returns False if no row matched.
+        """
+        ws = self._get_worksheet(sheet_name)
+        headers, row = self._find_row(ws, field, value)
+        if row is None:
+            return False
+        self._write_cells(ws, headers, {row: updates})
+        self._invalidate_cache(sheet_name)
+        return True
+
+    def update_rows(self, sheet_name, field, updates):
+        """
+        Update many rows in one batch: updates maps a value of `field` to the
+        dict of changes for the first row with that value. Only the changed
+        cells are written. Returns the set of values that matched a row.
+        """
+        if not updates:
+            return set()
+        ws = self._get_worksheet(sheet_name)
+        headers = self._retry(lambda: ws.row_values(1))
+        if field not in headers:
+            return set()
+        keys = self._retry(lambda: ws.col_values(headers.index(field) + 1))
+        positions = {}
+        for row, key in enumerate(keys[1:], start=2):
+            positions.setdefault(str(key), row)
+        by_row = {positions[str(v)]: upd for v, upd in updates.items() if str(v) in positions}
+        if by_row:
+            self._write_cells(ws, headers, by_row)
+            self._invalidate_cache(sheet_name)
+        return {str(v) for v in updates if str(v) in positions}
+
+    def _write_cells(self, ws, headers, by_row):
+        """Write {sheet row number: {field: value}} with one batch_update, adding missing columns."""
+        new_cols = []
+        for updates in by_row.values():
+            new_cols.extend(k for k in updates if k not in headers and k not in new_cols)
+        if new_cols:
+            headers = headers + new_cols
+            self._grow_columns(ws, len(headers))
+            self._retry(lambda: ws.update([headers], "A1", value_input_option='USER_ENTERED'), write=True)
+        cells = []
+        for row, updates in by_row.items():
+            for key, val in updates.items():
+                if isinstance(val, (dict, list)):
+                    val = json.dumps(val, ensure_ascii=False)
+                elif val is None:
+                    val = ""
+                a1 = gspread.utils.rowcol_to_a1(row, headers.index(key) + 1)
+                cells.append({"range": a1, "values": [[val]]})
+        self._retry(lambda: ws.batch_update(cells, value_input_option='USER_ENTERED'), write=True)
+
+    def delete_row(self, sheet_name, field, value):
+        """Delete the first row where field == value. Returns False if no row matched."""
+        ws = self._get_worksheet(sheet_name)
+        _, row = self._find_row(ws, field, value)
+        if row is None:
+            return False
+        self._retry(lambda: ws.delete_rows(row), write=True)
+        self._invalidate_cache(sheet_name)
+        return True
+
+    def drop_sheet(self, sheet_name):
+        """Delete a whole worksheet. Returns False if it did not exist."""
+        try:
+            ws = self._retry(lambda: self.sheet.worksheet(sheet_name))
+        except gspread.WorksheetNotFound:
+            return False
+        self._retry(lambda: self.sheet.del_worksheet(ws), write=True)
+        _cache.pop(sheet_name, None)
+        _cache_ttl.pop(sheet_name, None)
+        return True
+
     def clear_cache(self):
         """Clear all cached data."""
         _cache.clear()
         _cache_ttl.clear()
 
 
-# --- Initialize default admin user if needed ---
+# --- Initialize default admin user if needed (python init_admin.py) ---
 def initialize_database(db):
-    """Create default admin user if users sheet is empty."""
+    """Create default admin user if users sheet is empty. Returns True if created."""
     import bcrypt
     users = db.load_data("users")
     if not users:
@@ -211,8 +406,9 @@ def initialize_database(db):
         }
         db.save_data("users", [default_admin])
         print("✅ Default admin user 'Viktor' created")
+        return True
+    return False
 
 
-# Singleton
+# Singleton (connects lazily)
 db = GoogleSheetsDB()
-initialize_database(db)
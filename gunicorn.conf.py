@@ -0,0 +1,48 @@
+"""
+Gunicorn configuration for Unithread App.
+
+The app is preloaded in the master, which warms the most used sheets once
+(snapshot.warm_up) before forking, so workers start with a full cache.
+Each worker then reconnects to Google on its own and keeps the shared
+snapshot file fresh (one worker at a time, see snapshot.start_refresher).
+With more than one worker, Socket.IO emits are relayed between workers
+through the local SQLite queue unless SOCKETIO_MESSAGE_QUEUE names another
+(see socketio_queue.py).
+
+    gunicorn app:app -c gunicorn.conf.py
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+timeout = 120
+preload_app = True
+
+if workers > 1:
+    # Read when app.py is imported below, so set before the preload
+    os.environ.setdefault("SOCKETIO_MESSAGE_QUEUE", "sqlite")
+
+
+def when_ready(server):
+    """Master, after the app is loaded and before workers fork."""
+    from google_sheets import db
+    from snapshot import warm_up
+    if warm_up(db):
+        server.log.info("Sheets cache warmed up before forking workers")
+    else:
+        server.log.warning("Sheets warm-up failed — workers load sheets on demand")
+
+
+def post_fork(server, worker):
+    """
+    Worker: never share the master's HTTP connections; start the snapshot
+    refresher and the chat flusher (which writes messages journaled before
+    a restart).
+    """
+    from google_sheets import db
+    from snapshot import start_refresher
+    from chat_store import chat_store
+    db.reset_connection()
+    start_refresher(db)
+    chat_store.start_flusher(db)
@@ -0,0 +1,199 @@
+"""
+Unithread App — Ingestion pipeline for integration sync results.
+
+Takes the {"expenses": [...], "revenue": [...]} dicts returned by
+IntegrationAdapter.sync_data(), normalizes, dedupes and validates the
+records and writes each sheet with one bulk append. Used by the sync
+routes and by anything else that imports adapter data (scheduler, backfill).
+"""
+
+import uuid
+import logging
+import threading
+from datetime import date
+from itertools import islice
+
+from ratelimit import background_priority
+from sync_index import source_index
+from search_index import search_index
+
+logger = logging.getLogger(__name__)
+
+VALID_VAT_RATES = (0, 6, 12, 25)
+MAX_AMOUNT = 999_999_999
+# Records buffered per bulk append when consuming an adapter stream
+INGEST_CHUNK_SIZE = 500
+
+# Serializes ingestion between concurrent syncs/backfill workers: the
+# dedup lookups must see the rows another sync is appending.
+_write_lock = threading.Lock()
+
+
+def _moms_belopp(belopp, sats):
+    """VAT part of a VAT-inclusive amount."""
+    if sats <= 0:
+        return 0
+    return round(belopp * sats / (100 + sats), 2)
+
+
+def _normalize_date(value):
+    """Return YYYY-MM-DD or raise ValueError."""
+    if not value:
+        return date.today().isoformat()
+    return date.fromisoformat(str(value)[:10]).isoformat()
+
+
+def _normalize_amount(value):
+    amount = round(float(value), 2)
+    if amount < 0 or amount > MAX_AMOUNT:
+        raise ValueError(f"Ogiltigt belopp: {value}")
+    return amount
+
+
+def normalize_expense(rec, platform, bolag):
+    """Map an adapter expense record to an expenses row. Raises ValueError if invalid."""
+    belopp = _normalize_amount(rec.get("belopp", 0))
+    sats = int(rec.get("moms_sats", 0) or 0)
+    if sats not in VALID_VAT_RATES:
+        raise ValueError(f"Ogiltig momssats: {sats}")
+    return {
+        "id": str(uuid.uuid4())[:8],
+        "bolag": bolag,
+        "datum": _normalize_date(rec.get("datum")),
+        "kategori": str(rec.get("kategori") or "Övrigt")[:50],
+        "beskrivning": str(rec.get("beskrivning") or "")[:200],
+        "leverantor": platform.replace("_", " ").title(),
+        "belopp": belopp,
+        "moms_sats": sats,
+        "moms_belopp": _moms_belopp(belopp, sats),
+        "source": platform,
+        "source_id": str(rec.get("source_id") or ""),
+    }
+
+
+def normalize_revenue(rec, platform, bolag):
+    """Map an adapter revenue record to a revenue row. Raises ValueError if invalid."""
+    return {
+        "id": str(uuid.uuid4())[:8],
+        "bolag": bolag,
+        "datum": _normalize_date(rec.get("datum")),
+        "kategori": str(rec.get("kategori") or "Övrigt")[:50],
+        "beskrivning": str(rec.get("beskrivning") or "")[:200],
+        "kund": str(rec.get("kund") or "")[:100],
+        "belopp": _normalize_amount(rec.get("belopp", 0)),
+        "source": platform,
+        "source_id": str(rec.get("source_id") or ""),
+    }
+
+
+def _empty_counts():
+    return {"added_expenses": 0, "added_revenue": 0, "updated": 0, "skipped": 0, "invalid": 0}
+
+
+SHEETS = (
+    ("expenses", "expenses", normalize_expense, "added_expenses"),
+    ("revenue", "revenue", normalize_revenue, "added_revenue"),
+)
+
+
+def ingest_sync_result(db, result, platform, bolag, upsert_changed=False, index=None):
+    """
+    Import one adapter result into the expenses/revenue sheets.
+
+    Rows whose (bolag, platform, source_id) is already imported are skipped, or —
+    with upsert_changed — updated in place when the amount differs.
+    Returns {"added_expenses", "added_revenue", "updated", "skipped", "invalid"}.
+    """
+    index = index or source_index
+    # Bulk imports yield the Sheets budget to interactive requests
+    with _write_lock, background_priority():
+        return _ingest(db, result, platform, bolag, upsert_changed, index)
+
+
+def _ingest(db, result, platform, bolag, upsert_changed, index):
+    counts = _empty_counts()
+    for key, sheet_name, normalize, added_key in SHEETS:
+        records = result.get(key) or []
+        if not records:
+            continue
+        index.ensure_built(db, sheet_name)
+
+        new_rows = []
+        updates = {}
+        seen = set()
+        for rec in records:
+            try:
+                row = normalize(rec, platform, bolag)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"{platform}: skipping invalid {key} record: {e}")
+                counts["invalid"] += 1
+                continue
+
+            sid = row["source_id"]
+            if sid:
+                if sid in seen:
+                    counts["skipped"] += 1
+                    continue
+                seen.add(sid)
+                known = index.lookup(sheet_name, bolag, platform, sid)
+                if known:
+                    old = known["belopp"]
+                    if upsert_changed and (old is None or abs(old - row["belopp"]) >= 0.005):
+                        upd = {"belopp": row["belopp"], "beskrivning": row["beskrivning"]}
+                        if "moms_belopp" in row:
+                            upd["moms_belopp"] = row["moms_belopp"]
+                        updates[known["row_id"]] = (sid, upd)
+                        counts["updated"] += 1
+                    else:
+                        counts["skipped"] += 1
+                    continue
+            new_rows.append(row)
+
+        if new_rows:
+            db.append_rows(sheet_name, new_rows)
+            search_index.put_many(sheet_name, new_rows)
+            index.add_many(sheet_name, [
+                (bolag, platform, r["source_id"], r["id"], r["belopp"]) for r in new_rows if r["source_id"]
+            ])
+            counts[added_key] += len(new_rows)
+
+        if updates:
+            _apply_updates(db, index, sheet_name, bolag, platform, updates)
+
+    return counts
+
+
+def ingest_records(db, records, platform, bolag, upsert_changed=False,
+                   chunk_size=INGEST_CHUNK_SIZE, index=None):
+    """
+    Import a stream of ("expenses" | "revenue", record) pairs, as yielded by
+    IntegrationAdapter.iter_records(), in fixed-size chunks so memory stays
+    flat however long the sync window is. Returns the summed counts.
+    """
+    totals = _empty_counts()
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        batch = {"expenses": [], "revenue": []}
+        for kind, rec in chunk:
+            batch[kind].append(rec)
+        counts = ingest_sync_result(db, batch, platform, bolag,
+                                    upsert_changed=upsert_changed, index=index)
+        for key, value in counts.items():
+            totals[key] += value
+    return totals
+
+
+def _apply_updates(db, index, sheet_name, bolag, platform, updates):
+    """Write changed amounts for already imported rows, touching only their cells."""
+    matched = db.update_rows(sheet_name, "id", {row_id: upd for row_id, (_, upd) in updates.items()})
+    if matched:
+        search_index.put_many(sheet_name, [r for r in db.load_data(sheet_name) if str(r.get("id")) in matched])
+    index.add_many(sheet_name, [
+        (bolag, platform, sid, row_id, upd["belopp"]) for row_id, (sid, upd) in updates.items()
+        if row_id in matched
+    ])
+    for row_id in updates.keys() - matched:
+        index.forget_row(sheet_name, row_id)  # deleted in the sheet: re-imported on the next sync
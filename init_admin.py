@@ -0,0 +1,21 @@
+"""
+Skapar den första admin-användaren i users-fliken om fliken är tom.
+
+Körs en gång mot ett nytt kalkylark (eller efter att users-fliken tömts):
+    DEFAULT_ADMIN_PASSWORD=... python init_admin.py
+"""
+
+from google_sheets import db, initialize_database
+
+
+def init_admin():
+    print("🚀 Kontrollerar users-fliken i Google Sheets...")
+    try:
+        if not initialize_database(db):
+            print("ℹ️ Det finns redan användare — inget att göra.")
+    except Exception as e:
+        print(f"❌ Kunde inte initiera users-fliken: {e}")
+
+
+if __name__ == "__main__":
+    init_admin()
@@ -9,14 +9,94 @@ import json
 import time
 import hashlib
 import logging
+import threading
 from abc import ABC, abstractmethod
 from datetime import datetime, date, timedelta
 from typing import Any
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+from ratelimit import rate_limiter, parse_shopify_call_limit, parse_meta_usage, retry_after
 
 logger = logging.getLogger(__name__)
 
+# One pooled HTTP session for all adapters, so syncs reuse keep-alive
+# connections. Tests and benchmarks mount a fake transport on it.
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+# ---------------------------------------------------------------------------
+# OAuth access-token cache
+# ---------------------------------------------------------------------------
+
+class TokenCache:
+    """
+    Process-wide cache of expiring OAuth access tokens, shared by all adapter
+    instances and threads. A token is refreshed REFRESH_MARGIN seconds before
+    it expires, and concurrent callers for the same key wait for a single
+    refresh instead of each doing their own round trip.
+    """
+
+    REFRESH_MARGIN = 60  # seconds
+    DEFAULT_EXPIRES_IN = 3600
+
+    def __init__(self):
+        self._tokens = {}  # key -> (access_token, expires_at monotonic)
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(platform, client_id, refresh_token):
+        """Cache key for a set of credentials (the refresh token is only stored hashed)."""
+        digest = hashlib.sha256(f"{client_id}:{refresh_token}".encode("utf-8")).hexdigest()
+        return f"{platform}:{digest}"
+
+    def _fresh(self, key):
+        entry = self._tokens.get(key)
+        if entry and entry[1] - self.REFRESH_MARGIN > time.monotonic():
+            return entry[0]
+        return None
+
+    def get(self, key, fetch):
+        """
+        Return a valid access token for key. fetch() is called on a miss and
+        must return (access_token, expires_in_seconds).
+        """
+        with self._lock:
+            token = self._fresh(key)
+            if token:
+                return token
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another thread may have refreshed while we waited
+            with self._lock:
+                token = self._fresh(key)
+            if token:
+                return token
+            token, expires_in = fetch()
+            try:
+                expires_in = float(expires_in)
+            except (TypeError, ValueError):
+                expires_in = self.DEFAULT_EXPIRES_IN
+            with self._lock:
+                self._tokens[key] = (token, time.monotonic() + expires_in)
+            return token
+
+    def invalidate(self, key):
+        """Drop a token the API rejected, so the next call refreshes it."""
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
+
+
 # ---------------------------------------------------------------------------
 # Base adapter
 # ---------------------------------------------------------------------------
@@ -30,6 +110,18 @@ class IntegrationAdapter(ABC):
     ICON = ""
     REQUIRED_FIELDS = []  # list of {"key": "...", "label": "...", "type": "text|password"}
     DESCRIPTION = ""
+    # Days before the checkpoint that are re-read on every sync, because the
+    # platform may still revise them (attribution, late conversions, refunds).
+    # Can be overridden per integration with the "late_data_days" config field.
+    LATE_DATA_DAYS = 3
+    # Widest date range fetched per request during a historical backfill,
+    # kept under each API's row/range limits.
+    BACKFILL_CHUNK_DAYS = 31
+    # Whether an already imported row should be updated when the platform
+    # reports a different amount for the same source_id (daily ad spend).
+    UPSERT_CHANGED = False
+    # Client-side pacing for the shared token bucket: (requests/second, burst)
+    RATE_LIMIT = (5, 10)
 
     def __init__(self, config: dict):
         """
@@ -38,6 +130,17 @@ class IntegrationAdapter(ABC):
         self.config = config
         self.bolag = config.get("bolag", "Unithread")
         self.errors: list[str] = []
+        self.late_data_days = self._parse_late_data_days(config.get("late_data_days"))
+        # Last complete day covered by the latest successful sync (YYYY-MM-DD)
+        self.synced_through: str | None = None
+
+    def _parse_late_data_days(self, value) -> int:
+        if value is None or str(value).strip() == "":
+            return self.LATE_DATA_DAYS
+        try:
+            return max(0, int(value))
+        except (TypeError, ValueError):
+            return self.LATE_DATA_DAYS
 
     @abstractmethod
     def test_connection(self) -> dict:
@@ -45,9 +148,10 @@ class IntegrationAdapter(ABC):
         ...
 
     @abstractmethod
-    def sync_data(self, since_date: str | None = None) -> dict:
+    def sync_data(self, since_date: str | None = None, until_date: str | None = None) -> dict:
         """
-        Pull data from the external API since the given date.
+        Pull data from the external API since the given date (up to and
+        including until_date, default today).
         Returns {
             "expenses": [{"datum", "kategori", "beskrivning", "belopp", "moms_sats"}],
             "revenue":  [{"datum", "kategori", "beskrivning", "belopp", "kund"}],
@@ -56,13 +160,94 @@ class IntegrationAdapter(ABC):
         """
         ...
 
+    def iter_records(self, since_date: str | None = None, until_date: str | None = None):
+        """
+        Yield ("expenses" | "revenue", record) pairs, page by page.
+        Adapters that paginate override this so a long backfill never holds
+        all records in memory; the default falls back to sync_data().
+        """
+        result = self.sync_data(since_date, until_date)
+        for kind in ("expenses", "revenue"):
+            for rec in result.get(kind, []):
+                yield kind, rec
+
+    def _collect(self, records) -> dict:
+        """Build a sync_data() style result from iter_records() output."""
+        result = {"expenses": [], "revenue": []}
+        for kind, rec in records:
+            result[kind].append(rec)
+        return result
+
+    # --- Incremental sync checkpoints ---
+
+    def since_from_checkpoint(self, checkpoint: dict | None) -> str | None:
+        """
+        Return the since_date to resume from, or None when there is no checkpoint.
+        The late-data window is re-read so revised days are picked up again.
+        """
+        day = (checkpoint or {}).get("last_complete_day")
+        if not day:
+            return None
+        try:
+            last = date.fromisoformat(str(day)[:10])
+        except ValueError:
+            return None
+        return (last + timedelta(days=1 - self.late_data_days)).isoformat()
+
+    def _incremental_kwargs(self, checkpoint: dict | None) -> dict:
+        """Keyword arguments for sync_data()/iter_records() resuming from checkpoint."""
+        return {"since_date": self.since_from_checkpoint(checkpoint)}
+
+    def sync_incremental(self, checkpoint: dict | None = None) -> dict:
+        """Sync everything after the checkpoint (default window when there is none)."""
+        return self.sync_data(**self._incremental_kwargs(checkpoint))
+
+    def iter_incremental(self, checkpoint: dict | None = None):
+        """Streaming variant of sync_incremental()."""
+        return self.iter_records(**self._incremental_kwargs(checkpoint))
+
+    def next_checkpoint(self, checkpoint: dict | None = None) -> dict:
+        """
+        Return the checkpoint to store after a sync.
+        A sync with errors never advances the checkpoint, so nothing is skipped.
+        """
+        checkpoint = dict(checkpoint or {})
+        if self.errors or not self.synced_through:
+            return checkpoint
+        if self.synced_through > str(checkpoint.get("last_complete_day", "")):
+            checkpoint["last_complete_day"] = self.synced_through
+        return checkpoint
+
+    def _mark_synced(self, end_date: str | None = None):
+        """Record the last complete day fetched (today is never complete)."""
+        last = date.today() - timedelta(days=1)
+        if end_date:
+            last = min(last, date.fromisoformat(end_date[:10]))
+        self.synced_through = last.isoformat()
+
+    def _rate_limit_key(self) -> str:
+        """Scope of the platform's rate limit (one bucket per key per process)."""
+        return self.PLATFORM
+
+    def _observe_rate_limit(self, resp, bucket):
+        """Adjust the bucket from rate-limit response headers, for platforms that send them."""
+
     def _request(self, method, url, **kwargs):
-        """HTTP request with retry logic and error handling."""
+        """HTTP request paced by the platform's shared rate limiter, with retry logic."""
         timeout = kwargs.pop("timeout", 30)
+        bucket = rate_limiter.bucket(self._rate_limit_key(), *self.RATE_LIMIT)
         for attempt in range(3):
+            bucket.acquire()
             try:
-                resp = requests.request(method, url, timeout=timeout, **kwargs)
-                if resp.status_code in (429, 500, 502, 503, 504):
+                resp = http.request(method, url, timeout=timeout, **kwargs)
+                self._observe_rate_limit(resp, bucket)
+                if resp.status_code == 429:
+                    # Every thread on this bucket waits, not just this request
+                    metrics.incr("integration_rate_limited", label=bucket.name)
+                    wait = retry_after(resp)
+                    bucket.pause(2 ** attempt if wait is None else wait)
+                    continue
+                if resp.status_code in (500, 502, 503, 504):
                     time.sleep(2 ** attempt)
                     continue
                 resp.raise_for_status()
@@ -97,6 +282,10 @@ class ShopifyAdapter(IntegrationAdapter):
         {"key": "shop_domain", "label": "Butikens domän (ex: min-butik.myshopify.com)", "type": "text"},
         {"key": "access_token", "label": "Admin API Access Token", "type": "password"},
     ]
+    # Orders are resumed by updated_at, which already catches late edits
+    LATE_DATA_DAYS = 0
+    # REST Admin API leaky bucket: 40 calls, leaking 2/s (per store)
+    RATE_LIMIT = (2, 40)
 
     def __init__(self, config):
         super().__init__(config)
@@ -109,6 +298,40 @@ class ShopifyAdapter(IntegrationAdapter):
             "X-Shopify-Access-Token": self.token,
             "Content-Type": "application/json",
         }
+        # High-water marks seen during the latest sync
+        self.last_updated_at = ""
+        self.last_order_id = 0
+
+    def _rate_limit_key(self):
+        return f"shopify:{self.shop}"
+
+    def _observe_rate_limit(self, resp, bucket):
+        call_limit = parse_shopify_call_limit(resp.headers.get("X-Shopify-Shop-Api-Call-Limit"))
+        if call_limit:
+            used, limit = call_limit
+            bucket.sync_remaining(limit - used, limit)
+
+    def _incremental_kwargs(self, checkpoint):
+        """Resume from the last seen order updated_at (minus the late-data window)."""
+        updated_at = (checkpoint or {}).get("updated_at")
+        if not updated_at:
+            return super()._incremental_kwargs(checkpoint)
+        try:
+            resume = datetime.fromisoformat(str(updated_at).replace("Z", "+00:00"))
+        except ValueError:
+            return super()._incremental_kwargs(checkpoint)
+        resume -= timedelta(days=self.late_data_days)
+        return {"updated_at_min": resume.isoformat()}
+
+    def next_checkpoint(self, checkpoint=None):
+        checkpoint = super().next_checkpoint(checkpoint)
+        if self.errors:
+            return checkpoint
+        if self.last_updated_at and self.last_updated_at > str(checkpoint.get("updated_at", "")):
+            checkpoint["updated_at"] = self.last_updated_at
+        if self.last_order_id > int(checkpoint.get("last_order_id") or 0):
+            checkpoint["last_order_id"] = self.last_order_id
+        return checkpoint
 
     def test_connection(self):
         try:
@@ -118,69 +341,103 @@ class ShopifyAdapter(IntegrationAdapter):
         except Exception as e:
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
-        if not since_date:
+    def sync_data(self, since_date=None, until_date=None, updated_at_min=None):
+        """
+        Pull paid orders created since since_date, or — when resuming from a
+        checkpoint — every paid order updated since updated_at_min.
+        """
+        result = self._collect(self.iter_records(since_date, until_date, updated_at_min=updated_at_min))
+        result["raw_data"] = {"orders_count": len(result["revenue"])}
+        return result
+
+    def iter_records(self, since_date=None, until_date=None, updated_at_min=None):
+        """Yield one revenue record per paid order, following Shopify's cursor pagination."""
+        if updated_at_min:
+            since_date = updated_at_min[:10]
+        elif not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
 
-        expenses = []
-        revenue = []
+        order_count = 0
+        total_revenue = 0.0
 
         try:
             # Fetch paid orders
             params = {
                 "status": "any",
                 "financial_status": "paid",
-                "created_at_min": f"{since_date}T00:00:00Z",
                 "limit": 250,
-                "fields": "id,name,created_at,total_price,subtotal_price,total_tax,"
+                "fields": "id,name,created_at,updated_at,total_price,subtotal_price,total_tax,"
                           "total_discounts,financial_status,currency,line_items,"
                           "customer,total_shipping_price_set",
             }
-            resp = self._request("GET", f"{self.base_url}/orders.json",
-                                 headers=self.headers, params=params)
-            orders = resp.json().get("orders", [])
-
-            for order in orders:
-                order_date = order.get("created_at", "")[:10]
-                order_name = order.get("name", f"#{order.get('id', '?')}")
-                total = float(order.get("total_price", 0))
-                customer = order.get("customer", {})
-                customer_name = ""
-                if customer:
-                    first = customer.get("first_name", "")
-                    last = customer.get("last_name", "")
-                    customer_name = f"{first} {last}".strip()
-
-                # Revenue entry per order
-                revenue.append({
-                    "datum": order_date,
-                    "kategori": "Produktförsäljning",
-                    "beskrivning": f"Shopify order {order_name}",
-                    "belopp": total,
-                    "kund": customer_name or "Shopify-kund",
-                    "source": "shopify",
-                    "source_id": str(order.get("id", "")),
-                })
+            if updated_at_min:
+                params["updated_at_min"] = updated_at_min
+            else:
+                params["created_at_min"] = f"{since_date}T00:00:00Z"
+            if until_date:
+                params["created_at_max"] = f"{until_date}T23:59:59Z"
+            url = f"{self.base_url}/orders.json"
+
+            while url:
+                resp = self._request("GET", url, headers=self.headers, params=params)
+                for order in resp.json().get("orders", []):
+                    rec = self._order_to_revenue(order)
+                    order_count += 1
+                    total_revenue += rec["belopp"]
+                    yield "revenue", rec
+                # Next page URL already carries page_info + limit; filters must not be
+                # resent, but fields is allowed and keeps later pages as small
+                url = resp.links.get("next", {}).get("url")
+                params = {"fields": params["fields"]}
 
             # Estimate Shopify payment processing fees (~2.4% + 0.25 SEK)
-            total_revenue = sum(r["belopp"] for r in revenue)
             if total_revenue > 0:
-                fee_estimate = round(total_revenue * 0.024 + len(revenue) * 0.25, 2)
-                expenses.append({
-                    "datum": date.today().isoformat(),
+                fee_estimate = round(total_revenue * 0.024 + order_count * 0.25, 2)
+                yield "expenses", {
+                    "datum": until_date or date.today().isoformat(),
                     "kategori": "Bank & Avgifter",
-                    "beskrivning": f"Shopify transaktionsavgifter ({len(revenue)} ordrar, {since_date} →)",
+                    "beskrivning": f"Shopify transaktionsavgifter ({order_count} ordrar, {since_date} →)",
                     "belopp": fee_estimate,
                     "moms_sats": 0,
                     "source": "shopify",
                     "source_id": f"fees_{since_date}",
-                })
+                }
+
+            self._mark_synced(until_date)
 
         except Exception as e:
             logger.error(f"Shopify sync error: {e}")
             self.errors.append(str(e)[:200])
 
-        return {"expenses": expenses, "revenue": revenue, "raw_data": {"orders_count": len(revenue)}}
+    def _order_to_revenue(self, order):
+        """Map a Shopify order to a revenue record and track the high-water marks."""
+        updated_at = order.get("updated_at") or ""
+        if updated_at > self.last_updated_at:
+            self.last_updated_at = updated_at
+        order_id = order.get("id")
+        if isinstance(order_id, int) and order_id > self.last_order_id:
+            self.last_order_id = order_id
+
+        order_date = order.get("created_at", "")[:10]
+        order_name = order.get("name", f"#{order.get('id', '?')}")
+        total = float(order.get("total_price", 0))
+        customer = order.get("customer", {})
+        customer_name = ""
+        if customer:
+            first = customer.get("first_name", "")
+            last = customer.get("last_name", "")
+            customer_name = f"{first} {last}".strip()
+
+        # Revenue entry per order
+        return {
+            "datum": order_date,
+            "kategori": "Produktförsäljning",
+            "beskrivning": f"Shopify order {order_name}",
+            "belopp": total,
+            "kund": customer_name or "Shopify-kund",
+            "source": "shopify",
+            "source_id": str(order.get("id", "")),
+        }
 
 
 # ---------------------------------------------------------------------------
@@ -197,6 +454,8 @@ class GelatoAdapter(IntegrationAdapter):
     ]
 
     BASE_URL = "https://order.gelatoapis.com/v4"
+    # Production and shipping costs can still be adjusted a day or two later
+    LATE_DATA_DAYS = 2
 
     def __init__(self, config):
         super().__init__(config)
@@ -215,47 +474,74 @@ class GelatoAdapter(IntegrationAdapter):
         except Exception as e:
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
+    PAGE_SIZE = 100
+
+    def sync_data(self, since_date=None, until_date=None):
+        result = self._collect(self.iter_records(since_date, until_date))
+        result["raw_data"] = {"orders_count": len(result["expenses"])}
+        return result
+
+    def iter_records(self, since_date=None, until_date=None):
+        """
+        Yield one expense per Gelato order in the window, paging by offset.
+        The window is passed as created-date filters, so a backfill chunk
+        reads only its own orders instead of every newer one first.
+        """
         if not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
 
-        expenses = []
         try:
-            params = {"limit": 100, "offset": 0}
-            resp = self._request("GET", f"{self.BASE_URL}/orders",
-                                 headers=self.headers, params=params)
-            data = resp.json()
-            orders = data.get("orders", [])
-
-            for order in orders:
-                created = order.get("createdAt", "")[:10]
-                if created < since_date:
-                    continue
+            offset = 0
+            while True:
+                params = {"limit": self.PAGE_SIZE, "offset": offset,
+                          "startDate": f"{since_date}T00:00:00Z"}
+                if until_date:
+                    params["endDate"] = f"{until_date}T23:59:59Z"
+                resp = self._request("GET", f"{self.BASE_URL}/orders",
+                                     headers=self.headers, params=params)
+                data = resp.json()
+                orders = data.get("orders", [])
+
+                reached_start = False
+                for order in orders:
+                    created = order.get("createdAt", "")[:10]
+                    if created < since_date:
+                        reached_start = True
+                        continue
+                    if until_date and created > until_date:
+                        continue
 
-                order_id = order.get("id", "?")
-                # Financial summary
-                financial = order.get("financialSummary", {})
-                production_cost = float(financial.get("productionCost", {}).get("amount", 0))
-                shipping_cost = float(financial.get("shippingCost", {}).get("amount", 0))
-                total_cost = production_cost + shipping_cost
-
-                if total_cost > 0:
-                    expenses.append({
-                        "datum": created,
-                        "kategori": "Design & Produktion",
-                        "beskrivning": f"Gelato order {order_id[:12]} (prod: {production_cost}, frakt: {shipping_cost})",
-                        "belopp": total_cost,
-                        "moms_sats": 0,
-                        "source": "gelato",
-                        "source_id": str(order_id),
-                    })
+                    order_id = order.get("id", "?")
+                    # Financial summary
+                    financial = order.get("financialSummary", {})
+                    production_cost = float(financial.get("productionCost", {}).get("amount", 0))
+                    shipping_cost = float(financial.get("shippingCost", {}).get("amount", 0))
+                    total_cost = production_cost + shipping_cost
+
+                    if total_cost > 0:
+                        yield "expenses", {
+                            "datum": created,
+                            "kategori": "Design & Produktion",
+                            "beskrivning": f"Gelato order {order_id[:12]} (prod: {production_cost}, frakt: {shipping_cost})",
+                            "belopp": total_cost,
+                            "moms_sats": 0,
+                            "source": "gelato",
+                            "source_id": str(order_id),
+                        }
+
+                # Orders are listed newest first: stop at a short page or at
+                # the first order older than the window (in case the filters
+                # are not applied).
+                if len(orders) < self.PAGE_SIZE or reached_start:
+                    break
+                offset += self.PAGE_SIZE
+
+            self._mark_synced(until_date)
 
         except Exception as e:
             logger.error(f"Gelato sync error: {e}")
             self.errors.append(str(e)[:200])
 
-        return {"expenses": expenses, "revenue": [], "raw_data": {"orders_count": len(expenses)}}
-
 
 # ---------------------------------------------------------------------------
 # TikTok Ads
@@ -266,12 +552,16 @@ class TikTokAdsAdapter(IntegrationAdapter):
     DISPLAY_NAME = "TikTok Ads"
     ICON = "🎵"
     DESCRIPTION = "Hämtar annonskostnader, visningar och klick från TikTok Ads."
+    UPSERT_CHANGED = True
     REQUIRED_FIELDS = [
         {"key": "access_token", "label": "Access Token", "type": "password"},
         {"key": "advertiser_id", "label": "Advertiser ID", "type": "text"},
     ]
 
     BASE_URL = "https://business-api.tiktok.com/open_api/v1.3"
+    # Daily reports (stat_time_day) accept at most 30 days per request
+    BACKFILL_CHUNK_DAYS = 30
+    RATE_LIMIT = (10, 10)
 
     def __init__(self, config):
         super().__init__(config)
@@ -296,12 +586,20 @@ class TikTokAdsAdapter(IntegrationAdapter):
         except Exception as e:
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
+    def sync_data(self, since_date=None, until_date=None):
+        result = self._collect(self.iter_records(since_date, until_date))
+        result["raw_data"] = {"days": len(result["expenses"])}
+        return result
+
+    def iter_records(self, since_date=None, until_date=None):
+        """
+        Yield one expense per day with spend. Report rows are per campaign and
+        day, so all pages are aggregated per day (memory grows with days only).
+        """
         if not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
-        end_date = date.today().isoformat()
+        end_date = until_date or date.today().isoformat()
 
-        expenses = []
         try:
             body = {
                 "advertiser_id": self.adv_id,
@@ -313,17 +611,20 @@ class TikTokAdsAdapter(IntegrationAdapter):
                 "start_date": since_date,
                 "end_date": end_date,
                 "page_size": 500,
+                "page": 1,
             }
-            resp = self._request("POST", f"{self.BASE_URL}/report/integrated/get/",
-                                 headers=self.headers, json=body)
-            data = resp.json()
-
-            if data.get("code") == 0:
-                rows = data.get("data", {}).get("list", [])
-                # Aggregate by day
-                daily_spend = {}
-                daily_metrics = {}
-                for row in rows:
+            # Aggregate by day
+            daily_spend = {}
+            daily_metrics = {}
+            while True:
+                resp = self._request("POST", f"{self.BASE_URL}/report/integrated/get/",
+                                     headers=self.headers, json=body)
+                data = resp.json()
+                if data.get("code") != 0:
+                    self.errors.append(data.get("message", "TikTok API error")[:200])
+                    return
+
+                for row in data.get("data", {}).get("list", []):
                     dims = row.get("dimensions", {})
                     metrics = row.get("metrics", {})
                     day = dims.get("stat_time_day", "")[:10]
@@ -337,26 +638,30 @@ class TikTokAdsAdapter(IntegrationAdapter):
                     daily_metrics[day]["impressions"] += impr
                     daily_metrics[day]["clicks"] += clicks
 
-                for day, spend in sorted(daily_spend.items()):
-                    if spend <= 0:
-                        continue
-                    m = daily_metrics.get(day, {})
-                    expenses.append({
-                        "datum": day,
-                        "kategori": "Marknadsföring",
-                        "beskrivning": f"TikTok Ads ({m.get('impressions', 0)} visn, {m.get('clicks', 0)} klick)",
-                        "belopp": round(spend, 2),
-                        "moms_sats": 0,
-                        "source": "tiktok_ads",
-                        "source_id": f"tiktok_{day}",
-                    })
+                page_info = data.get("data", {}).get("page_info", {})
+                if body["page"] >= int(page_info.get("total_page") or 1):
+                    break
+                body["page"] += 1
+
+            for day, spend in sorted(daily_spend.items()):
+                if spend <= 0:
+                    continue
+                m = daily_metrics.get(day, {})
+                yield "expenses", {
+                    "datum": day,
+                    "kategori": "Marknadsföring",
+                    "beskrivning": f"TikTok Ads ({m.get('impressions', 0)} visn, {m.get('clicks', 0)} klick)",
+                    "belopp": round(spend, 2),
+                    "moms_sats": 0,
+                    "source": "tiktok_ads",
+                    "source_id": f"tiktok_{day}",
+                }
+            self._mark_synced(end_date)
 
         except Exception as e:
             logger.error(f"TikTok Ads sync error: {e}")
             self.errors.append(str(e)[:200])
 
-        return {"expenses": expenses, "revenue": [], "raw_data": {"days": len(expenses)}}
-
 
 # ---------------------------------------------------------------------------
 # Meta Ads (Facebook / Instagram)
@@ -367,6 +672,7 @@ class MetaAdsAdapter(IntegrationAdapter):
     DISPLAY_NAME = "Meta Ads"
     ICON = "📘"
     DESCRIPTION = "Hämtar annonskostnader från Facebook & Instagram Ads."
+    UPSERT_CHANGED = True
     REQUIRED_FIELDS = [
         {"key": "access_token", "label": "Facebook Access Token (långlivad)", "type": "password"},
         {"key": "ad_account_id", "label": "Ad Account ID (act_XXXXXXX)", "type": "text"},
@@ -381,6 +687,14 @@ class MetaAdsAdapter(IntegrationAdapter):
         if not self.ad_account.startswith("act_"):
             self.ad_account = f"act_{self.ad_account}"
 
+    def _observe_rate_limit(self, resp, bucket):
+        """Pace by the quota use Meta reports; stop entirely while access is blocked."""
+        pct, regain = parse_meta_usage(resp.headers)
+        if pct is not None:
+            bucket.set_utilization(pct)
+        if regain:
+            bucket.pause(regain)
+
     def test_connection(self):
         try:
             resp = self._request("GET", f"{self.BASE_URL}/{self.ad_account}",
@@ -392,12 +706,17 @@ class MetaAdsAdapter(IntegrationAdapter):
         except Exception as e:
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
+    def sync_data(self, since_date=None, until_date=None):
+        result = self._collect(self.iter_records(since_date, until_date))
+        result["raw_data"] = {"days": len(result["expenses"])}
+        return result
+
+    def iter_records(self, since_date=None, until_date=None):
+        """Yield one expense per day with spend, following the Graph API paging cursor."""
         if not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
-        end_date = date.today().isoformat()
+        end_date = until_date or date.today().isoformat()
 
-        expenses = []
         try:
             params = {
                 "access_token": self.token,
@@ -407,34 +726,40 @@ class MetaAdsAdapter(IntegrationAdapter):
                 "time_increment": 1,  # daily breakdown
                 "limit": 500,
             }
-            resp = self._request("GET", f"{self.BASE_URL}/{self.ad_account}/insights", params=params)
-            data = resp.json()
+            url = f"{self.BASE_URL}/{self.ad_account}/insights"
+            while url:
+                resp = self._request("GET", url, params=params)
+                data = resp.json()
 
-            for row in data.get("data", []):
-                day = row.get("date_start", "")[:10]
-                spend = float(row.get("spend", 0))
-                impressions = int(row.get("impressions", 0))
-                clicks = int(row.get("clicks", 0))
+                for row in data.get("data", []):
+                    day = row.get("date_start", "")[:10]
+                    spend = float(row.get("spend", 0))
+                    impressions = int(row.get("impressions", 0))
+                    clicks = int(row.get("clicks", 0))
 
-                if spend <= 0:
-                    continue
+                    if spend <= 0:
+                        continue
 
-                expenses.append({
-                    "datum": day,
-                    "kategori": "Marknadsföring",
-                    "beskrivning": f"Meta Ads ({impressions} visn, {clicks} klick)",
-                    "belopp": round(spend, 2),
-                    "moms_sats": 0,
-                    "source": "meta_ads",
-                    "source_id": f"meta_{day}",
-                })
+                    yield "expenses", {
+                        "datum": day,
+                        "kategori": "Marknadsföring",
+                        "beskrivning": f"Meta Ads ({impressions} visn, {clicks} klick)",
+                        "belopp": round(spend, 2),
+                        "moms_sats": 0,
+                        "source": "meta_ads",
+                        "source_id": f"meta_{day}",
+                    }
+
+                # paging.next is a complete URL including the access token
+                url = data.get("paging", {}).get("next")
+                params = None
+
+            self._mark_synced(end_date)
 
         except Exception as e:
             logger.error(f"Meta Ads sync error: {e}")
             self.errors.append(str(e)[:200])
 
-        return {"expenses": expenses, "revenue": [], "raw_data": {"days": len(expenses)}}
-
 
 # ---------------------------------------------------------------------------
 # Snapchat Ads
@@ -445,6 +770,7 @@ class SnapchatAdsAdapter(IntegrationAdapter):
     DISPLAY_NAME = "Snapchat Ads"
     ICON = "👻"
     DESCRIPTION = "Hämtar annonskostnader från Snapchat Ads Manager."
+    UPSERT_CHANGED = True
     REQUIRED_FIELDS = [
         {"key": "access_token", "label": "Snapchat OAuth Access Token", "type": "password"},
         {"key": "ad_account_id", "label": "Ad Account ID", "type": "text"},
@@ -474,10 +800,10 @@ class SnapchatAdsAdapter(IntegrationAdapter):
         except Exception as e:
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
+    def sync_data(self, since_date=None, until_date=None):
         if not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
-        end_date = date.today().isoformat()
+        end_date = until_date or date.today().isoformat()
 
         expenses = []
         try:
@@ -530,8 +856,13 @@ class SnapchatAdsAdapter(IntegrationAdapter):
                                 "source": "snapchat_ads",
                                 "source_id": f"snap_{camp_id}_{day}",
                             })
-                except Exception:
-                    continue  # Skip individual campaign errors
+                except Exception as e:
+                    # Skip individual campaign errors, but keep the checkpoint
+                    # from moving past days we could not read
+                    self.errors.append(f"Kampanj {camp_id}: {str(e)[:150]}")
+                    continue
+
+            self._mark_synced(end_date)
 
         except Exception as e:
             logger.error(f"Snapchat Ads sync error: {e}")
@@ -549,6 +880,7 @@ class GoogleAdsAdapter(IntegrationAdapter):
     DISPLAY_NAME = "Google Ads"
     ICON = "📊"
     DESCRIPTION = "Hämtar annonskostnader, visningar och klick från Google Ads."
+    UPSERT_CHANGED = True
     REQUIRED_FIELDS = [
         {"key": "developer_token", "label": "Developer Token", "type": "password"},
         {"key": "client_id", "label": "OAuth Client ID", "type": "text"},
@@ -567,21 +899,29 @@ class GoogleAdsAdapter(IntegrationAdapter):
         self.client_secret = config.get("client_secret", "")
         self.refresh_token = config.get("refresh_token", "")
         self.customer_id = config.get("customer_id", "").replace("-", "")
-        self._access_token = None
+        self._token_key = TokenCache.make_key(self.PLATFORM, self.client_id, self.refresh_token)
 
     def _get_access_token(self):
+        """Access token for the refresh token, cached until shortly before it expires."""
+        return token_cache.get(self._token_key, self._fetch_access_token)
+
+    def _fetch_access_token(self):
         """Exchange refresh token for access token."""
-        if self._access_token:
-            return self._access_token
-        resp = requests.post(self.TOKEN_URL, data={
+        resp = http.post(self.TOKEN_URL, data={
             "grant_type": "refresh_token",
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "refresh_token": self.refresh_token,
         }, timeout=15)
         resp.raise_for_status()
-        self._access_token = resp.json().get("access_token")
-        return self._access_token
+        payload = resp.json()
+        return payload.get("access_token"), payload.get("expires_in", TokenCache.DEFAULT_EXPIRES_IN)
+
+    def _drop_token_if_rejected(self, exc):
+        """Forget a cached token the Ads API answered 401 to (revoked early)."""
+        response = getattr(exc, "response", None)
+        if response is not None and response.status_code == 401:
+            token_cache.invalidate(self._token_key)
 
     def test_connection(self):
         try:
@@ -606,12 +946,13 @@ class GoogleAdsAdapter(IntegrationAdapter):
                 return {"ok": True, "message": f"Ansluten till Google Ads — {name}"}
             return {"ok": True, "message": "Ansluten till Google Ads"}
         except Exception as e:
+            self._drop_token_if_rejected(e)
             return {"ok": False, "message": f"Kunde inte ansluta: {str(e)[:150]}"}
 
-    def sync_data(self, since_date=None):
+    def sync_data(self, since_date=None, until_date=None):
         if not since_date:
             since_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
-        end_date = date.today().isoformat()
+        end_date = until_date or date.today().isoformat()
 
         expenses = []
         try:
@@ -674,7 +1015,10 @@ class GoogleAdsAdapter(IntegrationAdapter):
                     "source_id": f"gads_{day}",
                 })
 
+            self._mark_synced(end_date)
+
         except Exception as e:
+            self._drop_token_if_rejected(e)
             logger.error(f"Google Ads sync error: {e}")
             self.errors.append(str(e)[:200])
 
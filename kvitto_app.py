@@ -1,5 +1,8 @@
 import streamlit as st
+import os
 import json
+import threading
+from contextlib import contextmanager
 import pandas as pd
 from pathlib import Path
 from datetime import datetime, date, timedelta
@@ -12,6 +15,12 @@ import calendar
 import plotly.express as px
 import plotly.graph_objects as go
 import auth
+from drive_queue import drive_queue
+
+try:
+    import fcntl
+except ImportError:  # Windows: bara låset inom processen
+    fcntl = None
 
 # --- AUTHENTICATION ---
 if not auth.check_login():
@@ -38,59 +47,122 @@ COMPANY_FILES_DIR.mkdir(exist_ok=True)
 # Verksamheter
 BUSINESSES = ["Unithread", "Merchoteket"]
 
+# Bilagor laddas upp till Google Drive av en bakgrundskö (drive_queue.py)
+DRIVE_TARGET = "kvitto_app"
 
-def load_data() -> Dict:
-    """Laddar användare och kvitton från JSON-fil"""
-    if DATA_FILE.exists():
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
+# Datafilerna läses och skrivs av skripttråden, uppladdningskön och andra sessioner
+DATA_LOCK_FILE = Path(__file__).parent / "kvitto_data.lock"
+_data_thread_lock = threading.Lock()
+_data_lock_state = threading.local()
+
+
+@contextmanager
+def data_lock():
+    """Ensamrätt till JSON-datafilerna (mellan trådar och processer). Får nästlas i samma tråd."""
+    if getattr(_data_lock_state, "held", False):
+        yield
+        return
+    with _data_thread_lock:
+        with open(DATA_LOCK_FILE, 'a') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            _data_lock_state.held = True
+            try:
+                yield
+            finally:
+                _data_lock_state.held = False
+
+
+def read_json(path: Path, default):
+    """Läser en JSON-datafil (default om den saknas)"""
+    with data_lock():
+        if not path.exists():
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
-    return {}
 
 
-def save_data(data: Dict) -> None:
-    """Sparar användare och kvitton till JSON-fil"""
+def write_json(path: Path, data) -> None:
+    """Skriver en JSON-datafil atomärt (läsare ser aldrig en halvskriven fil). Fel kastas vidare."""
+    with data_lock():
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+
+def receipt_records(data: Dict) -> List[Dict]:
+    return [k for u in data.values() if isinstance(u, dict) for k in u.get("kvitton", [])]
+
+
+def revenue_records(revenue_data: Dict) -> List[Dict]:
+    return revenue_data.get("intakter", [])
+
+
+def calendar_records(calendar_data: Dict) -> List[Dict]:
+    return calendar_data.get("händelser", [])
+
+
+def company_expense_records(company_expenses: Dict) -> List[Dict]:
+    return [u for b in BUSINESSES for u in company_expenses.get(b, {}).get("utgifter", [])]
+
+
+def fill_drive_links(records: List[Dict]) -> None:
+    """Sätter url på poster vars bilaga laddats upp sedan datan lästes (så länken inte skrivs över)"""
+    waiting = [r for r in records if r.get("bild") and not r.get("url")]
+    if not waiting:
+        return
+    links = drive_queue.links(DRIVE_TARGET, [r["bild"] for r in waiting])
+    for record in waiting:
+        if record["bild"] in links:
+            record["url"] = links[record["bild"]]
+
+
+def save_json(path: Path, data: Dict, records) -> None:
+    """Sparar en datafil från skripttråden (fel visas i appen)"""
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        fill_drive_links(records(data))
+        write_json(path, data)
     except Exception as e:
         st.error(f"Kunde inte spara: {e}")
 
 
+def load_data() -> Dict:
+    """Laddar användare och kvitton från JSON-fil"""
+    return read_json(DATA_FILE, {})
+
+
+def save_data(data: Dict) -> None:
+    """Sparar användare och kvitton till JSON-fil"""
+    save_json(DATA_FILE, data, receipt_records)
+
+
 def load_revenue_data() -> Dict:
     """Laddar intäkter från JSON-fil"""
-    if REVENUE_FILE.exists():
-        with open(REVENUE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"intakter": [], "total": 0, "kategorier": ["Kundfaktura", "Försäljning", "Konsultarvode", "Övrigt"]}
+    return read_json(REVENUE_FILE, {"intakter": [], "total": 0,
+                                    "kategorier": ["Kundfaktura", "Försäljning", "Konsultarvode", "Övrigt"]})
 
 
 def save_revenue_data(revenue_data: Dict) -> None:
     """Sparar intäkter till JSON-fil"""
-    try:
-        with open(REVENUE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(revenue_data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        st.error(f"Kunde inte spara: {e}")
+    save_json(REVENUE_FILE, revenue_data, revenue_records)
 
 
 def load_calendar_data() -> Dict:
     """Laddar kalenderhändelser från JSON-fil"""
-    if CALENDAR_FILE.exists():
-        with open(CALENDAR_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {
+    return read_json(CALENDAR_FILE, {
         "händelser": [],
         "kategorier": ["Bokföring", "Skatt", "Möte", "Deadline", "Betalning", "Övrigt"]
-    }
+    })
 
 
 def save_calendar_data(calendar_data: Dict) -> None:
     """Sparar kalenderhändelser till JSON-fil"""
-    try:
-        with open(CALENDAR_FILE, 'w', encoding='utf-8') as f:
-            json.dump(calendar_data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        st.error(f"Kunde inte spara: {e}")
+    save_json(CALENDAR_FILE, calendar_data, calendar_records)
 
 
 def load_budget_data() -> Dict:
@@ -497,19 +569,36 @@ def save_file(uploaded_file, identifier: str, timestamp: str, folder: Path) -> t
     with open(filepath, 'wb') as f:
         f.write(uploaded_file.getbuffer())
 
-    # Ladda upp till Google Drive via db_handler
-    drive_link = None
+    # Laddas upp till Google Drive i bakgrunden; länken skrivs in i posten (url) när den är klar
     try:
-        from db_handler import db
-        # Vi öppnar den sparade lokala filen för att ladda upp den, 
-        # vilket är säkrare än att återanvända uploaded_file-buffern
-        with open(filepath, 'rb') as f:
-             drive_link = db.upload_file(f, filename)
+        drive_queue.enqueue(DRIVE_TARGET, filename, filepath)
     except Exception as e:
         # Om det misslyckas, logga bara felet men låt den lokala sparningen bestå
-        print(f"Cloud upload failed: {e}")
-
-    return filename, file_extension, drive_link
+        print(f"Could not queue cloud upload: {e}")
+
+    return filename, file_extension, None
+
+
+def record_drive_link(ref: str, filename: str, link: str) -> bool:
+    """Skriver in Drive-länken i posten som har filen som bilaga (anropas av uppladdningskön).
+    Läsning och skrivning sker under datalåset; skrivfel kastas så att kön försöker igen"""
+    stores = [
+        (DATA_FILE, receipt_records),
+        (REVENUE_FILE, revenue_records),
+        (CALENDAR_FILE, calendar_records),
+        (COMPANY_EXPENSES_FILE, company_expense_records),
+    ]
+    for path, records in stores:
+        with data_lock():
+            data = read_json(path, None)
+            if data is None:
+                continue
+            for record in records(data):
+                if record.get("bild") == filename:
+                    record["url"] = link
+                    write_json(path, data)
+                    return True
+    return False
 
 
 def load_image(filename: str, folder: Path = IMAGES_DIR):
@@ -522,18 +611,20 @@ def load_image(filename: str, folder: Path = IMAGES_DIR):
     return None
 
 
-def pdf_to_images(pdf_path: Path) -> List[Image.Image]:
-    """Konverterar PDF till bilder (en per sida)"""
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _render_pdf_pages(pdf_path: str, mtime: float) -> List[bytes]:
+    """PDF-sidor som PNG (2× zoom). Cachas per fil och ändringstid, så en omkörning renderar inte om."""
+    doc = fitz.open(pdf_path)
     try:
-        doc = fitz.open(pdf_path)
-        images = []
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
+        return [page.get_pixmap(matrix=fitz.Matrix(2, 2)).tobytes("png") for page in doc]
+    finally:
         doc.close()
-        return images
+
+
+def pdf_to_images(pdf_path: Path) -> List[bytes]:
+    """Konverterar PDF till bilder (en PNG per sida)"""
+    try:
+        return _render_pdf_pages(str(pdf_path), pdf_path.stat().st_mtime)
     except Exception as e:
         st.error(f"Kunde inte läsa PDF: {e}")
         return []
@@ -840,10 +931,7 @@ def delete_user(data: Dict, username: str) -> bool:
 
 def load_company_expenses() -> Dict:
     """Laddar företagsutgifter från JSON-fil"""
-    if COMPANY_EXPENSES_FILE.exists():
-        with open(COMPANY_EXPENSES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {
+    return read_json(COMPANY_EXPENSES_FILE, {
         "Unithread": {"utgifter": [], "total": 0},
         "Merchoteket": {"utgifter": [], "total": 0},
         "kategorier": [
@@ -860,16 +948,12 @@ def load_company_expenses() -> Dict:
             "Bank & Avgifter",
             "Övrigt"
         ]
-    }
+    })
 
 
 def save_company_expenses(company_expenses: Dict) -> None:
     """Sparar företagsutgifter till JSON-fil"""
-    try:
-        with open(COMPANY_EXPENSES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(company_expenses, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        st.error(f"Kunde inte spara: {e}")
+    save_json(COMPANY_EXPENSES_FILE, company_expenses, company_expense_records)
 
 
 def load_company_budget() -> Dict:
@@ -1019,6 +1103,10 @@ def delete_revenue(revenue_data: Dict, index: int) -> None:
 # Huvudapp
 st.set_page_config(page_title="Ekonomihantering", page_icon="💼", layout="wide")
 
+# Starta Drive-uppladdningarna i bakgrunden (en gång per process)
+drive_queue.register(DRIVE_TARGET, record_drive_link)
+drive_queue.start()
+
 data = load_data()
 revenue_data = load_revenue_data()
 calendar_data = load_calendar_data()
@@ -17,6 +17,7 @@ import time
 import uuid
 import auth
 from db_handler import db  # Importera vår nya databashanterare
+from drive_queue import drive_queue
 
 # --- AUTHENTICATION ---
 if not auth.check_login():
@@ -556,6 +557,9 @@ RECEIPTS_FILE = DATA_DIR / "kvitton.json"
 RECEIPT_IMAGES_DIR = FILES_DIR / "kvitton"
 RECEIPT_IMAGES_DIR.mkdir(exist_ok=True)
 
+# Kvittobilder laddas upp till Google Drive av en bakgrundskö (drive_queue.py)
+DRIVE_TARGET = "main_receipts"
+
 # Kalender
 CALENDAR_FILE = DATA_DIR / "kalender.json"
 
@@ -1070,7 +1074,10 @@ def save_receipts(data: Dict) -> None:
 
                 # Fixa files (serialize till JSON-sträng för Sheets)
                 if "files" in r_copy and isinstance(r_copy["files"], list):
-                    r_copy["files"] = json.dumps(r_copy["files"])
+                    # Bilagor som laddats upp sedan kvittona lästes: behåll Drive-länken
+                    links = drive_queue.links(
+                        DRIVE_TARGET, [f for f in r_copy["files"] if not str(f).startswith("http")])
+                    r_copy["files"] = json.dumps([links.get(f, f) for f in r_copy["files"]])
 
                 # Append ALLTID, oavsett om files ändrades eller ej
                 clean_receipts.append(r_copy)
@@ -1126,7 +1133,8 @@ def save_calendar(data: Dict) -> None:
 
 
 def save_receipt_image(uploaded_file, receipt_id: str) -> str:
-    """Laddar upp kvittobild till Google Drive och returnerar länk"""
+    """Sparar kvittobilden lokalt och köar den för Google Drive. Returnerar filnamnet,
+    som byts mot Drive-länken i kvittot när uppladdningen är klar (se record_receipt_link)"""
     if uploaded_file is None:
         return None
 
@@ -1136,24 +1144,46 @@ def save_receipt_image(uploaded_file, receipt_id: str) -> str:
         file_extension = "jpg"
 
     filename = f"{receipt_id}.{file_extension}"
+    filepath = RECEIPT_IMAGES_DIR / filename
 
     try:
-        # Använd db_handler för att ladda upp
-        # Vi behöver konvertera uploaded_file till en BytesIO eller liknande som db.upload_file gillar
-        # Streamlit's uploaded_file beter sig som en fil, så det borde funka direkt.
-        file_link = db.upload_file(uploaded_file, filename)
-
-        # Vi returnerar länken istället för filnamnet, eller både och?
-        # Appen förväntar sig nog ett filnamn för att visa det lokalt, men nu är vi i molnet.
-        # Vi sparar länken i kvittot senare.
-        # För bakåtkompatibilitet returnerar vi filnamnet, men vi måste ändra hur bilden visas.
-        # Låt oss returnera hela länken.
-        return file_link
-
+        with open(filepath, 'wb') as f:
+            f.write(uploaded_file.getbuffer())
     except Exception as e:
-        st.error(f"Kunde inte ladda upp bild: {e}")
+        st.error(f"Kunde inte spara bild: {e}")
         return None
 
+    try:
+        drive_queue.enqueue(DRIVE_TARGET, filename, filepath)
+    except Exception as e:
+        # Filen finns kvar lokalt och visas därifrån
+        st.warning(f"Kunde inte köa uppladdning till molnet (sparad lokalt): {e}")
+    return filename
+
+
+def record_receipt_link(ref: str, filename: str, link: str) -> bool:
+    """Byter filnamnet mot Drive-länken i kvittot som har filen som bilaga (anropas av uppladdningskön).
+    Skriver bara kvittots files-cell: fliken skrivs aldrig om från bakgrundstråden"""
+    if not db.replace_in_column("receipts", "files", json.dumps(filename), json.dumps(link)):
+        return False
+    load_receipts.clear()
+    return True
+
+
+def display_receipt_files(file_list):
+    """Visar kvittots bilagor: Drive-länkar, eller lokala filer som väntar på uppladdning"""
+    if isinstance(file_list, str):
+        file_list = [file_list]
+    for i, link in enumerate(file_list):
+        if str(link).startswith("http"):
+            st.markdown(f"📄 [Öppna bilaga {i+1}]({link})")
+        elif drive_queue.status(DRIVE_TARGET, link) == "failed":
+            st.caption(f"⚠️ Bilaga {i+1} kunde inte laddas upp till Drive (sparad lokalt)")
+            display_receipt_image(link)
+        else:
+            st.caption(f"⏳ Bilaga {i+1} laddas upp till Drive...")
+            display_receipt_image(link)
+
 
 def find_duplicate_expenses(expenses: Dict) -> List[Dict]:
     """Hittar potentiella dubbletter i utgifter"""
@@ -1220,6 +1250,20 @@ def remove_revenue_by_index(revenue: Dict, index: int) -> None:
         revenue["total"] = sum(i["belopp"] for i in revenue["intakter"])
 
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _pdf_page_count(pdf_path: str, mtime: float) -> int:
+    """Antal sidor i en PDF (cachad per fil och ändringstid)"""
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def _render_pdf_page(pdf_path: str, mtime: float, page_num: int) -> bytes:
+    """En PDF-sida som PNG i 2x zoom, renderad en gång per fil och ändringstid i stället för vid varje omkörning"""
+    with fitz.open(pdf_path) as doc:
+        return doc[page_num].get_pixmap(matrix=fitz.Matrix(2, 2)).tobytes("png")
+
+
 def display_receipt_image(filename: str):
     """Visar kvittobild eller PDF"""
     if not filename:
@@ -1235,32 +1279,24 @@ def display_receipt_image(filename: str):
     if file_extension == 'pdf':
         # Hantera PDF
         try:
-            pdf_document = fitz.open(filepath)
+            mtime = filepath.stat().st_mtime
+            page_count = _pdf_page_count(str(filepath), mtime)
 
             # Visa första sidan
-            page = pdf_document[0]
-            # 2x zoom för bättre kvalitet
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-            img_data = pix.tobytes("png")
-
-            st.image(img_data, caption="Kvitto (PDF)",
+            st.image(_render_pdf_page(str(filepath), mtime, 0), caption="Kvitto (PDF)",
                      use_container_width=True)
 
             # Om fler än 1 sida
-            if len(pdf_document) > 1:
+            if page_count > 1:
                 st.info(
-                    f"📄 PDF:en innehåller {len(pdf_document)} sidor (visar sida 1)")
+                    f"📄 PDF:en innehåller {page_count} sidor (visar sida 1)")
 
                 # Option att visa alla sidor
                 if st.checkbox("Visa alla sidor", key=f"show_all_{filename}"):
-                    for page_num in range(1, len(pdf_document)):
-                        page = pdf_document[page_num]
-                        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                        img_data = pix.tobytes("png")
+                    for page_num in range(1, page_count):
                         st.image(
-                            img_data, caption=f"Sida {page_num + 1}", use_container_width=True)
-
-            pdf_document.close()
+                            _render_pdf_page(str(filepath), mtime, page_num),
+                            caption=f"Sida {page_num + 1}", use_container_width=True)
 
             # Nedladdningsknapp för PDF
             with open(filepath, 'rb') as f:
@@ -1689,6 +1725,10 @@ def archive_chat_group(group_id: str) -> None:
 st.set_page_config(page_title="Företagsekonomi AI",
                    page_icon="🏢", layout="wide")
 
+# Starta Drive-uppladdningarna i bakgrunden (en gång per process)
+drive_queue.register(DRIVE_TARGET, record_receipt_link)
+drive_queue.start()
+
 # Hantera URL-parametrar för navigering
 # if "selected_day" in st.query_params:
 #     st.session_state.selected_day = st.query_params["selected_day"]
@@ -2912,13 +2952,7 @@ elif main_menu == "📄 Kvittoredovisning":
                             f"**Kategori:** {receipt.get('kategori', 'Okänd')}")
                         if receipt.get("files"):
                             st.write(f"📎 {len(receipt.get('files'))} bilagor")
-                            file_list = receipt.get("files")
-                            if isinstance(file_list, list):
-                                for i, link in enumerate(file_list):
-                                    st.markdown(
-                                        f"📄 [Öppna bilaga {i+1}]({link})")
-                            elif isinstance(file_list, str):
-                                st.markdown(f"📄 [Öppna bilaga]({file_list})")
+                            display_receipt_files(receipt.get("files"))
 
                     with col2:
                         c1, c2 = st.columns(2)
@@ -3027,13 +3061,7 @@ elif main_menu == "📄 Kvittoredovisning":
 
                     with cols[1]:
                         if receipt.get("files"):
-                            file_list = receipt.get("files")
-                            if isinstance(file_list, list):
-                                for i, link in enumerate(file_list):
-                                    st.markdown(
-                                        f"📄 [Öppna bilaga {i+1}]({link})")
-                            elif isinstance(file_list, str):
-                                st.markdown(f"📄 [Öppna bilaga]({file_list})")
+                            display_receipt_files(receipt.get("files"))
                         else:
                             st.caption("Inga bilagor")
 
@@ -0,0 +1,56 @@
+"""
+Unithread App — In-process metrics.
+
+A small thread-safe registry of counters and timings, shared by the
+integration adapters, the Sheets layer and background jobs. Read through
+GET /api/admin/metrics. Values live in memory and reset on restart.
+"""
+
+import threading
+
+
+class Metrics:
+    """Counters and timings keyed by name and an optional label."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, label) -> value
+        self._timings = {}   # (name, label) -> {"count", "sum", "max"}
+
+    def incr(self, name, value=1, label=""):
+        with self._lock:
+            key = (name, label)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, label=""):
+        """Record one duration (seconds)."""
+        with self._lock:
+            entry = self._timings.setdefault((name, label), {"count": 0, "sum": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["sum"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def snapshot(self):
+        """{"counters": {name: {label: value}}, "timings": {name: {label: {count, sum, max, avg}}}}"""
+        with self._lock:
+            counters = {}
+            for (name, label), value in self._counters.items():
+                counters.setdefault(name, {})[label] = value
+            timings = {}
+            for (name, label), entry in self._timings.items():
+                timings.setdefault(name, {})[label] = {
+                    "count": entry["count"],
+                    "sum": round(entry["sum"], 4),
+                    "max": round(entry["max"], 4),
+                    "avg": round(entry["sum"] / entry["count"], 4) if entry["count"] else 0.0,
+                }
+        return {"counters": counters, "timings": timings}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+# Singleton
+metrics = Metrics()
@@ -1,5 +1,7 @@
 import json
 import math
+import asyncio
+import argparse
 import pandas as pd
 import numpy as np
 from pathlib import Path
@@ -59,8 +61,38 @@ def _manual_clean(data):
     return data
 
 
-def migrate():
+def upload(uploads, concurrent=False):
+    """Write the prepared sheets one after another, or concurrently via the async Sheets client."""
+    if not concurrent:
+        for sheet_name, rows in uploads.items():
+            print(f"   📤 Laddar upp {len(rows)} rader till fliken '{sheet_name}'...")
+            try:
+                db.save_data(sheet_name, rows)
+                print(f"   ✅ Klar med {sheet_name}!")
+            except Exception as e:
+                print(f"   ❌ Fel vid {sheet_name}: {e}")
+        return
+
+    from async_sheets import AsyncSheetsDB
+
+    async def run():
+        async with AsyncSheetsDB(db.creds, db.sheet.id) as adb:
+            return await asyncio.gather(
+                *(adb.asave_data(name, rows) for name, rows in uploads.items()),
+                return_exceptions=True,
+            )
+
+    print(f"   📤 Laddar upp {len(uploads)} flikar parallellt...")
+    for (sheet_name, rows), result in zip(uploads.items(), asyncio.run(run())):
+        if isinstance(result, Exception):
+            print(f"   ❌ Fel vid {sheet_name}: {result}")
+        else:
+            print(f"   ✅ Klar med {sheet_name} ({len(rows)} rader)!")
+
+
+def migrate(concurrent=False):
     print("🚀 Startar migrering till Google Sheets...")
+    uploads = {}
 
     # --- UTGIFTER ---
     try:
@@ -86,10 +118,8 @@ def migrate():
         print(f"   📊 Totalt antal rader att ladda upp: {len(rows)}")
 
         if rows:
-            print(
-                f"   📤 Laddar upp {len(rows)} rader till fliken 'utgifter'...")
-            db.save_data("utgifter", rows)
-            print("   ✅ Klar med utgifter!")
+            uploads["utgifter"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'utgifter'")
         else:
             print("   ⚠️ Inga utgifter hittades att ladda upp.")
     except Exception as e:
@@ -110,10 +140,8 @@ def migrate():
             rows = clean_data(rows)
 
         if rows:
-            print(
-                f"   📤 Laddar upp {len(rows)} rader till fliken 'intakter'...")
-            db.save_data("intakter", rows)
-            print("   ✅ Klar med intakter!")
+            uploads["intakter"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'intakter'")
         else:
             print("   ⚠️ Inga intäkter hittades.")
     except Exception as e:
@@ -130,9 +158,8 @@ def migrate():
             rows = data["users"]
 
         if rows:
-            print(f"   📤 Laddar upp {len(rows)} rader till fliken 'users'...")
-            db.save_data("users", rows)
-            print("   ✅ Klar med users!")
+            uploads["users"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'users'")
         else:
             print("   ⚠️ Inga användare hittades.")
     except Exception as e:
@@ -155,10 +182,8 @@ def migrate():
                 rows.append(user_row)
 
         if rows:
-            print(
-                f"   📤 Laddar upp {len(rows)} rader till fliken 'system_users'...")
-            db.save_data("system_users", rows)
-            print("   ✅ Klar med system_users!")
+            uploads["system_users"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'system_users'")
         else:
             print("   ⚠️ Inga system-användare hittades.")
     except Exception as e:
@@ -171,10 +196,8 @@ def migrate():
             data = json.load(f)
 
         if isinstance(data, list) and len(data) > 0:
-            print(
-                f"   📤 Laddar upp {len(data)} rader till fliken 'aktivitetslogg'...")
-            db.save_data("aktivitetslogg", data)
-            print("   ✅ Klar med aktivitetslogg!")
+            uploads["aktivitetslogg"] = data
+            print(f"   📦 {len(data)} rader förberedda för fliken 'aktivitetslogg'")
         else:
             print("   ⚠️ Inga aktiviteter hittades.")
     except Exception as e:
@@ -192,10 +215,8 @@ def migrate():
 
         if rows:
             rows = clean_data(rows)
-            print(
-                f"   📤 Laddar upp {len(rows)} rader till fliken 'receipts'...")
-            db.save_data("receipts", rows)
-            print("   ✅ Klar med receipts!")
+            uploads["receipts"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'receipts'")
         else:
             print("   ⚠️ Inga kvitton hittades.")
     except Exception as e:
@@ -218,9 +239,8 @@ def migrate():
                 rows.append(row)
 
         if rows:
-            print(f"   📤 Laddar upp {len(rows)} rader till fliken 'mal'...")
-            db.save_data("mal", rows)
-            print("   ✅ Klar med mal!")
+            uploads["mal"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'mal'")
         else:
             print("   ⚠️ Inga mål hittades.")
     except Exception as e:
@@ -249,17 +269,20 @@ def migrate():
                         rows.append(row)
 
         if rows:
-            print(
-                f"   📤 Laddar upp {len(rows)} rader till fliken 'bokforing'...")
-            db.save_data("bokforing", rows)
-            print("   ✅ Klar med bokforing!")
+            uploads["bokforing"] = rows
+            print(f"   📦 {len(rows)} rader förberedda för fliken 'bokforing'")
         else:
             print("   ⚠️ Ingen bokföring hittades.")
     except Exception as e:
         print(f"   ❌ Fel vid bokforing: {e}")
 
+    upload(uploads, concurrent=concurrent)
+
     print("\n🎉 Migrering klar! VIKTIGT: Titta på FLIKARNA längst ner i Google Sheet!")
 
 
 if __name__ == "__main__":
-    migrate()
+    parser = argparse.ArgumentParser(description="Migrera lokala JSON-filer till Google Sheets.")
+    parser.add_argument("--async", dest="concurrent", action="store_true",
+                        help="Ladda upp flikarna parallellt (kräver httpx)")
+    migrate(concurrent=parser.parse_args().concurrent)
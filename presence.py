@@ -0,0 +1,184 @@
+"""
+Unithread App — Chat presence and typing throttling.
+
+Presence is a per-room member set: one row per (group, Socket.IO sid) in
+a SQLite file shared by the workers, so GET /api/chat/groups/<gid>/presence
+answers for every connection whichever worker holds it. Changes are not
+broadcast one by one; they are collected as per-room diffs (a join and a
+leave within the same window cancel out) and emitted every
+DIFF_INTERVAL seconds as one "presence" event per changed room.
+
+Typing indicators are coalesced: a user's "typing" events in a room are
+broadcast at most once per TYPING_INTERVAL seconds. The counters
+chat_typing_broadcast / chat_typing_coalesced show the saving.
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FILE = Path(os.environ.get(
+    "PRESENCE_FILE", Path(__file__).parent / "foretag_data" / "presence.db"
+))
+TYPING_INTERVAL = 2.0  # seconds; the client shows "skriver..." for 2 s
+DIFF_INTERVAL = 1.0  # seconds between presence broadcasts
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PresenceTracker:
+    """Room member sets (shared via SQLite), pending presence diffs and typing throttle."""
+
+    def __init__(self, path=PRESENCE_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._diffs = {}  # gid -> {user: +1 joined / -1 left}
+        self._typing = {}  # (gid, user) -> last broadcast (monotonic)
+        self._emitter = None
+
+    def _connect(self):
+        """Open the database on first use in this process and drop rows of dead workers."""
+        if self._conn is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS presence (
+                    group_id TEXT NOT NULL,
+                    sid TEXT NOT NULL,
+                    username TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    joined_at REAL NOT NULL,
+                    PRIMARY KEY (group_id, sid)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS presence_sid ON presence (sid)")
+            pids = [r[0] for r in conn.execute("SELECT DISTINCT pid FROM presence")]
+            dead = [(pid,) for pid in pids if pid != os.getpid() and not _pid_alive(pid)]
+            conn.executemany("DELETE FROM presence WHERE pid = ?", dead)
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _present(self, conn, gid, username):
+        return conn.execute("SELECT 1 FROM presence WHERE group_id = ? AND username = ? LIMIT 1",
+                            (gid, username)).fetchone() is not None
+
+    def _note(self, gid, username, change):
+        diff = self._diffs.setdefault(gid, {})
+        diff[username] = diff.get(username, 0) + change
+        if not diff[username]:
+            del diff[username]  # joined and left again within the window
+        if not diff:
+            del self._diffs[gid]
+
+    def join(self, gid, username, sid):
+        """Add a connection to a room. Returns True if the user was not present before."""
+        gid = str(gid)
+        with self._lock:
+            conn = self._connect()
+            was_present = self._present(conn, gid, username)
+            conn.execute("INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)",
+                         (gid, sid, username, os.getpid(), time.time()))
+            conn.commit()
+            if not was_present:
+                self._note(gid, username, +1)
+        return not was_present
+
+    def leave(self, gid, sid):
+        """Remove a connection from a room. Returns True if its user left the room entirely."""
+        return bool(self._remove("group_id = ? AND sid = ?", (str(gid), sid)))
+
+    def disconnect(self, sid):
+        """Remove a connection from every room. Returns the groups its user left entirely."""
+        return self._remove("sid = ?", (sid,))
+
+    def _remove(self, where, args):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(f"SELECT group_id, username FROM presence WHERE {where}", args).fetchall()
+            conn.execute(f"DELETE FROM presence WHERE {where}", args)
+            conn.commit()
+            left = []
+            for gid, username in rows:
+                if not self._present(conn, gid, username):
+                    self._note(gid, username, -1)
+                    left.append(gid)
+        return left
+
+    def members(self, gid):
+        """Users with at least one connection in the room, sorted."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT DISTINCT username FROM presence WHERE group_id = ? ORDER BY username", (str(gid),)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def take_diffs(self):
+        """Pending changes → [{"group_id", "joined", "left"}], and start a new window."""
+        with self._lock:
+            diffs, self._diffs = self._diffs, {}
+        return [
+            {
+                "group_id": gid,
+                "joined": sorted(u for u, c in changes.items() if c > 0),
+                "left": sorted(u for u, c in changes.items() if c < 0),
+            }
+            for gid, changes in diffs.items()
+        ]
+
+    def should_broadcast_typing(self, gid, username):
+        """True at most once per TYPING_INTERVAL for a user in a room."""
+        key = (str(gid), username)
+        now = time.monotonic()
+        with self._lock:
+            last = self._typing.get(key)
+            if last is not None and now - last < TYPING_INTERVAL:
+                metrics.incr("chat_typing_coalesced")
+                return False
+            self._typing[key] = now
+            if len(self._typing) > 10000:
+                cutoff = now - TYPING_INTERVAL
+                self._typing = {k: t for k, t in self._typing.items() if t >= cutoff}
+        metrics.incr("chat_typing_broadcast")
+        return True
+
+    def start_emitter(self, socketio, interval=DIFF_INTERVAL):
+        """Emit batched "presence" diffs from a background task, once per process."""
+        with self._lock:
+            if self._emitter is not None and self._emitter[0] == os.getpid():
+                return
+
+            def run():
+                while True:
+                    socketio.sleep(interval)
+                    try:
+                        for diff in self.take_diffs():
+                            diff["members"] = self.members(diff["group_id"])
+                            socketio.emit("presence", diff, room=f"chat_{diff['group_id']}")
+                    except Exception as e:
+                        logger.warning(f"Presence emitter error: {e}")
+
+            self._emitter = (os.getpid(), socketio.start_background_task(run))
+
+
+# Singleton
+presence = PresenceTracker()
@@ -0,0 +1,330 @@
+"""
+Unithread App — Client-side rate limiting for external API calls.
+
+One token bucket per platform (per store/account where the API limit is
+scoped that way), shared by every adapter instance, thread and backfill
+job in the process. A request takes a token before it is sent, so calls
+are paced below the platform limit instead of running into 429s. Buckets
+adapt to the rate-limit headers the APIs return:
+
+- Shopify: X-Shopify-Shop-Api-Call-Limit ("32/40" = used/bucket size)
+- Meta:    x-business-use-case-usage, x-ad-account-usage, x-app-usage
+           (percent of the quota used, and minutes until access is regained)
+
+Time spent waiting for a token is recorded as the
+integration_throttle_wait_seconds metric.
+
+Google Sheets calls go through sheets_governor instead: one budget sized
+to the Sheets quota, shared by three priority classes (interactive reads
+> interactive writes > background jobs), so a sync burst cannot starve
+users. Code running bulk work wraps it in background_priority().
+"""
+
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from metrics import metrics
+
+# Reported quota use (percent) above which Meta calls are slowed down
+SLOWDOWN_FROM_PCT = 75
+# Slowest pace, as a share of the normal rate, when the quota is nearly used
+MIN_RATE_FACTOR = 0.05
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/second up to `capacity`."""
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            metrics.observe("integration_throttle_wait_seconds", waited, self.name)
+        return waited
+
+    def pause(self, seconds):
+        """Hold every caller for `seconds` (429 with Retry-After, exhausted quota)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + max(0.0, seconds))
+
+    def sync_remaining(self, remaining, capacity=None):
+        """Align with the server's count of calls left before the limit."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if capacity:
+                self.capacity = float(capacity)
+            self.tokens = min(self.tokens, max(0.0, float(remaining)))
+
+    def set_utilization(self, pct):
+        """Slow down linearly once reported quota use passes SLOWDOWN_FROM_PCT."""
+        if pct < SLOWDOWN_FROM_PCT:
+            factor = 1.0
+        else:
+            factor = max(MIN_RATE_FACTOR, (100 - pct) / (100 - SLOWDOWN_FROM_PCT))
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = self.base_rate * factor
+
+    def state(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate": round(self.rate, 3),
+                "capacity": self.capacity,
+                "tokens": round(self.tokens, 2),
+                "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            }
+
+
+class RateLimiter:
+    """Process-wide registry of token buckets."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name, rate, capacity):
+        """Return the bucket for name, creating it with rate/capacity on first use."""
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(name, rate, capacity)
+            return bucket
+
+    def snapshot(self):
+        with self._lock:
+            buckets = list(self._buckets.values())
+        return {b.name: b.state() for b in buckets}
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# ---------------------------------------------------------------------------
+# Header parsing
+# ---------------------------------------------------------------------------
+
+def parse_shopify_call_limit(value):
+    """'32/40' → (32, 40), or None."""
+    try:
+        used, limit = str(value).split("/")
+        return int(used), int(limit)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_meta_usage(headers):
+    """
+    Return (highest percent used, seconds until access is regained) from
+    Meta's usage headers; (None, 0) when none are present.
+    """
+    pct = None
+    regain = 0.0
+
+    def note(value):
+        nonlocal pct
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        pct = value if pct is None else max(pct, value)
+
+    for header in ("x-business-use-case-usage", "x-ad-account-usage", "x-app-usage"):
+        raw = headers.get(header)
+        if not raw:
+            continue
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            continue
+        if header == "x-business-use-case-usage":
+            entries = [e for items in data.values() for e in (items or [])]
+        else:
+            entries = [data]
+        for entry in entries:
+            for key in ("call_count", "total_cputime", "total_time", "acc_id_util_pct"):
+                if key in entry:
+                    note(entry[key])
+            # Minutes for business use cases, seconds for ad accounts
+            if entry.get("estimated_time_to_regain_access"):
+                regain = max(regain, float(entry["estimated_time_to_regain_access"]) * 60)
+            if entry.get("reset_time_duration") and float(entry.get("acc_id_util_pct") or 0) >= 100:
+                regain = max(regain, float(entry["reset_time_duration"]))
+    return pct, regain
+
+
+def retry_after(resp):
+    """Seconds from a Retry-After header (delta or HTTP date), or None."""
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Google Sheets request governor
+# ---------------------------------------------------------------------------
+
+# Sheets allows 60 requests/minute per user (the service account) by default
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get("SHEETS_REQUESTS_PER_MINUTE", 60))
+# Share of the budget background jobs leave untouched for user requests
+BACKGROUND_RESERVE = 0.25
+
+INTERACTIVE_READ, INTERACTIVE_WRITE, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ("interactive_read", "interactive_write", "background")
+
+_background = contextvars.ContextVar("sheets_background", default=False)
+
+
+@contextmanager
+def background_priority():
+    """Run the block's Sheets calls in the background class (syncs, backfills, migrations)."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def current_priority(write=False):
+    """Priority class of a Sheets call made from the current context."""
+    if _background.get():
+        return BACKGROUND
+    return INTERACTIVE_WRITE if write else INTERACTIVE_READ
+
+
+class PriorityGovernor:
+    """
+    Token bucket of `per_minute` requests shared by priority classes. A
+    caller only gets a token when no higher class is waiting, and background
+    callers additionally leave BACKGROUND_RESERVE of the budget untouched.
+    """
+
+    def __init__(self, name, per_minute, background_reserve=BACKGROUND_RESERVE):
+        self.name = name
+        self.per_minute = int(per_minute)
+        self.rate = self.per_minute / 60.0
+        self.capacity = float(self.per_minute)
+        self.tokens = self.capacity
+        self.reserve = self.capacity * background_reserve
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._waiting = [0] * len(PRIORITY_NAMES)
+        self._recent = [deque() for _ in PRIORITY_NAMES]  # grant times, last 60 s
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _record(self, priority, now):
+        recent = self._recent[priority]
+        recent.append(now)
+        while now - recent[0] > 60:
+            recent.popleft()
+
+    def acquire(self, priority):
+        """Block until the class may send one request. Returns the seconds waited."""
+        started = time.monotonic()
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    floor = self.reserve if priority == BACKGROUND else 0.0
+                    if now < self.blocked_until:
+                        delay = self.blocked_until - now
+                    elif any(self._waiting[:priority]):
+                        delay = 1.0 / self.rate  # woken early by notify_all
+                    elif self.tokens >= 1 + floor:
+                        self.tokens -= 1
+                        self._record(priority, now)
+                        break
+                    else:
+                        delay = (1 + floor - self.tokens) / self.rate
+                    self._cond.wait(timeout=delay)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        label = PRIORITY_NAMES[priority]
+        metrics.incr("sheets_requests", label=label)
+        if waited > 0.001:
+            metrics.observe("sheets_wait_seconds", waited, label)
+        return waited
+
+    def pause(self, seconds):
+        """Hold all classes for `seconds` after the API answered 429."""
+        with self._cond:
+            self._refill(time.monotonic())
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + max(0.0, seconds))
+        metrics.incr("sheets_rate_limited", label=self.name)
+
+    def state(self):
+        """Budget usage: quota, tokens left, waiters and requests per class in the last minute."""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            used = {}
+            for priority, recent in enumerate(self._recent):
+                while recent and now - recent[0] > 60:
+                    recent.popleft()
+                used[PRIORITY_NAMES[priority]] = len(recent)
+            return {
+                "per_minute": self.per_minute,
+                "tokens": round(self.tokens, 2),
+                "used_last_minute": used,
+                "waiting": dict(zip(PRIORITY_NAMES, self._waiting)),
+                "blocked_for": round(max(0.0, self.blocked_until - now), 2),
+            }
+
+
+# Singletons
+rate_limiter = RateLimiter()
+sheets_governor = PriorityGovernor("sheets", SHEETS_REQUESTS_PER_MINUTE)
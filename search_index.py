@@ -0,0 +1,306 @@
+"""
+Unithread App — Full-text search index.
+
+An inverted index (term → documents) over chat messages, customers,
+customer notes, quotes, invoices and expenses, kept in a local SQLite
+file shared by the workers. Text is lowercased and folded (å/ä → a,
+ö → o, é → e, ...) so "forsaljning" finds "Försäljning", and every query
+word is a prefix: "sven ab" finds "Anna Svensson, Svensson AB".
+
+Each kind is built from its sheet the first time it is searched (and
+again after REBUILD_INTERVAL, which picks up writes made outside the web
+app); the write routes keep it current in between with put()/remove().
+A search reads only the postings of its query words, so it answers in
+milliseconds however large the sheets are.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+
+from chat_store import chat_store
+
+INDEX_FILE = Path(os.environ.get(
+    "SEARCH_INDEX_FILE", Path(__file__).parent / "foretag_data" / "search_index.db"
+))
+REBUILD_INTERVAL = int(os.environ.get("SEARCH_REBUILD_INTERVAL", 24 * 3600))  # seconds
+SNIPPET_LENGTH = 160
+MAX_TERM_LENGTH = 40
+EXACT_BONUS = 2.0  # a whole-word match ranks above a prefix match
+
+_WORD = re.compile(r"\w+")
+
+
+def fold(text):
+    """Lowercase and strip diacritics: "Åsa Öberg" → "asa oberg"."""
+    decomposed = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Folded words of a text."""
+    return [t[:MAX_TERM_LENGTH] for t in _WORD.findall(fold(text))]
+
+
+def _items_text(items):
+    if isinstance(items, str):
+        try:
+            items = json.loads(items)
+        except Exception:
+            return items
+    if not isinstance(items, list):
+        return ""
+    return " ".join(str(it.get("description", "")) for it in items if isinstance(it, dict))
+
+
+# kind → (row → {"title", "ref", "ts", "fields": [(text, weight)]})
+def _customer(r):
+    return {"title": r.get("name") or r.get("company", ""), "ref": "",
+            "ts": r.get("updated") or r.get("created", ""),
+            "fields": [(r.get("name"), 3), (r.get("company"), 2), (r.get("email"), 2),
+                       (r.get("phone"), 1), (r.get("notes"), 1)]}
+
+
+def _note(r):
+    return {"title": str(r.get("text", ""))[:80], "ref": r.get("customer_id", ""),
+            "ts": r.get("created", ""), "fields": [(r.get("text"), 1), (r.get("author"), 1)]}
+
+
+def _document(r):
+    return {"title": f"{r.get('id', '')} — {r.get('title', '')}", "ref": r.get("customer_id", ""),
+            "ts": r.get("created", ""),
+            "fields": [(r.get("id"), 3), (r.get("customer_name"), 2), (r.get("title"), 2),
+                       (r.get("description"), 1), (_items_text(r.get("items")), 1)]}
+
+
+def _expense(r):
+    return {"title": r.get("beskrivning") or r.get("leverantor", ""), "ref": r.get("bolag", ""),
+            "ts": r.get("datum", ""),
+            "fields": [(r.get("beskrivning"), 2), (r.get("leverantor"), 2), (r.get("kategori"), 1)]}
+
+
+def _chat(r):
+    return {"title": r.get("sender", ""), "ref": r.get("group_id", ""), "ts": r.get("timestamp", ""),
+            "fields": [(r.get("content"), 2), (r.get("sender"), 1)]}
+
+
+KINDS = {
+    "customers": _customer,
+    "customer_notes": _note,
+    "quotes": _document,
+    "invoices": _document,
+    "expenses": _expense,
+    "chat": _chat,
+}
+
+
+def _load_rows(db, kind):
+    return chat_store.all_messages(db) if kind == "chat" else db.load_data(kind)
+
+
+class SearchIndex:
+    """Inverted index over the searchable sheets, backed by SQLite."""
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    kind TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    title TEXT,
+                    snippet TEXT,
+                    ref TEXT,
+                    ts TEXT,
+                    PRIMARY KEY (kind, doc_id)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    weight REAL NOT NULL,
+                    PRIMARY KEY (term, kind, doc_id)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (kind, doc_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS built (
+                    kind TEXT PRIMARY KEY,
+                    built_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _write(self, conn, kind, row):
+        doc_id = str(row.get("id", ""))
+        if not doc_id:
+            return
+        doc = KINDS[kind](row)
+        weights = {}
+        texts = []
+        for text, weight in doc["fields"]:
+            if not text:
+                continue
+            texts.append(str(text))
+            for term in tokenize(text):
+                weights[term] = max(weights.get(term, 0), weight)
+        conn.execute("DELETE FROM postings WHERE kind = ? AND doc_id = ?", (kind, doc_id))
+        conn.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                     (kind, doc_id, str(doc["title"]), " · ".join(texts)[:SNIPPET_LENGTH],
+                      str(doc["ref"] or ""), str(doc["ts"] or "")))
+        conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                         [(term, kind, doc_id, w) for term, w in weights.items()])
+
+    def put(self, kind, row):
+        """Index (or re-index) one row of a kind."""
+        self.put_many(kind, [row])
+
+    def put_many(self, kind, rows):
+        """Index rows in one transaction. Rows of sheets that are not searched are ignored."""
+        if kind not in KINDS or not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            for row in rows:
+                self._write(conn, kind, row)
+            conn.commit()
+
+    def remove(self, kind, doc_id):
+        """Drop a deleted row from the index."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM postings WHERE kind = ? AND doc_id = ?", (kind, str(doc_id)))
+            conn.execute("DELETE FROM docs WHERE kind = ? AND doc_id = ?", (kind, str(doc_id)))
+            conn.commit()
+
+    def remove_ref(self, kind, ref):
+        """Drop every document of a kind that belongs to ref (e.g. a deleted chat group)."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("""
+                DELETE FROM postings WHERE kind = ? AND doc_id IN
+                    (SELECT doc_id FROM docs WHERE kind = ? AND ref = ?)
+            """, (kind, kind, str(ref)))
+            conn.execute("DELETE FROM docs WHERE kind = ? AND ref = ?", (kind, str(ref)))
+            conn.commit()
+
+    def ensure_built(self, db, kinds=None):
+        """(Re)build the kinds whose index is missing or older than REBUILD_INTERVAL."""
+        for kind in kinds or KINDS:
+            with self._lock:
+                row = self._connect().execute("SELECT built_at FROM built WHERE kind = ?", (kind,)).fetchone()
+            if row and time.time() - row[0] < REBUILD_INTERVAL:
+                continue
+            self.rebuild(db, kind)
+
+    def rebuild(self, db, kind):
+        """Replace a kind's documents with the current contents of its sheet."""
+        rows = _load_rows(db, kind)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM postings WHERE kind = ?", (kind,))
+            conn.execute("DELETE FROM docs WHERE kind = ?", (kind,))
+            for row in rows:
+                self._write(conn, kind, row)
+            conn.execute("INSERT OR REPLACE INTO built VALUES (?, ?)", (kind, time.time()))
+            conn.commit()
+
+    def _match(self, conn, term, kinds):
+        """{(kind, doc_id): weight} of documents with a word starting with term."""
+        marks = ",".join("?" * len(kinds))
+        rows = conn.execute(f"""
+            SELECT term, kind, doc_id, weight FROM postings
+            WHERE term >= ? AND term < ? AND kind IN ({marks})
+        """, (term, term + "\U0010ffff", *kinds)).fetchall()
+        found = {}
+        for word, kind, doc_id, weight in rows:
+            score = weight * (EXACT_BONUS if word == term else 1.0)
+            key = (kind, doc_id)
+            if score > found.get(key, 0):
+                found[key] = score
+        return found
+
+    def scores(self, query, kinds=None):
+        """{(kind, doc_id): score} of the documents containing every query word."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        kinds = [k for k in (kinds or KINDS) if k in KINDS]
+        if not terms or not kinds:
+            return {}
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] or 1
+            result = None
+            for term in terms:
+                found = self._match(conn, term, kinds)
+                idf = math.log(1 + total / (1 + len(found)))
+                if result is None:
+                    result = {key: w * idf for key, w in found.items()}
+                else:
+                    result = {key: s + found[key] * idf for key, s in result.items() if key in found}
+                if not result:
+                    return {}
+        return result
+
+    def ids(self, kind, query):
+        """Ids of the documents of one kind that match the query."""
+        return {doc_id for _, doc_id in self.scores(query, [kind])}
+
+    def search(self, query, kinds=None, limit=20, allow=None):
+        """
+        Best matches first (newest first among equal scores):
+        [{"kind", "id", "title", "snippet", "ref", "timestamp", "score"}].
+        allow(kind, ref) → bool hides documents the caller may not see.
+        """
+        scores = self.scores(query, kinds)
+        if not scores:
+            return []
+        hits = []
+        keys = list(scores)
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(keys), 400):
+                chunk = keys[i:i + 400]
+                where = " OR ".join("(kind = ? AND doc_id = ?)" for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT kind, doc_id, title, snippet, ref, ts FROM docs WHERE {where}",
+                    [v for key in chunk for v in key],
+                ).fetchall()
+                for kind, doc_id, title, snippet, ref, ts in rows:
+                    if allow is None or allow(kind, ref):
+                        hits.append({"kind": kind, "id": doc_id, "title": title, "snippet": snippet,
+                                     "ref": ref, "timestamp": ts,
+                                     "score": round(scores[(kind, doc_id)], 3)})
+        hits.sort(key=lambda h: h["timestamp"], reverse=True)
+        hits.sort(key=lambda h: h["score"], reverse=True)
+        return hits[:limit]
+
+    def reset(self):
+        """Forget everything; the next ensure_built() reloads from the sheets."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM docs")
+            conn.execute("DELETE FROM built")
+            conn.commit()
+
+
+# Singleton
+search_index = SearchIndex()
@@ -0,0 +1,142 @@
+"""
+Unithread App — Login sessions for the Streamlit app.
+
+One SQLite row per session token, so validating a token is a primary-key
+lookup and logging in or out inserts or deletes a single row instead of
+rewriting the whole `sessions` sheet. The file uses WAL mode and can be
+shared by several processes on the same disk. Expired tokens are never
+accepted; a background sweeper deletes them every SWEEP_INTERVAL seconds.
+Sessions still in the old sheet are imported once, the first time a
+store file is used.
+"""
+
+import os
+import uuid
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SESSION_FILE = Path(os.environ.get(
+    "SESSION_STORE_FILE", Path(__file__).parent / "foretag_data" / "sessions.db"
+))
+SESSION_TTL = 30 * 24 * 3600  # 30 days
+SWEEP_INTERVAL = int(os.environ.get("SESSION_SWEEP_INTERVAL", 3600))  # seconds
+
+
+class SessionStore:
+    """token → (username, expires) table backed by SQLite."""
+
+    def __init__(self, path=SESSION_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    token TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS imported (
+                    source TEXT PRIMARY KEY,
+                    imported_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def create(self, username, ttl=SESSION_TTL):
+        """Start a session for username and return its token."""
+        token = str(uuid.uuid4())
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO sessions VALUES (?, ?, ?)", (token, username, time.time() + ttl))
+            conn.commit()
+        return token
+
+    def validate(self, token):
+        """Username for a live token, or None."""
+        if not token:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT username FROM sessions WHERE token = ? AND expires > ?",
+                (str(token), time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, token):
+        """End a session (logout)."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM sessions WHERE token = ?", (str(token),))
+            conn.commit()
+
+    def sweep(self):
+        """Delete expired sessions. Returns how many were removed."""
+        with self._lock:
+            conn = self._connect()
+            removed = conn.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+            conn.commit()
+        return removed
+
+    def import_sheet(self, db, sheet_name="sessions"):
+        """Copy still-valid sessions from the old sheet, once per store file."""
+        with self._lock:
+            if self._connect().execute("SELECT 1 FROM imported WHERE source = ?", (sheet_name,)).fetchone():
+                return 0
+        now = time.time()
+        rows = []
+        for row in db.load_data(sheet_name):
+            try:
+                expires = float(row.get("expires", 0))
+            except (TypeError, ValueError):
+                continue
+            if row.get("token") and row.get("username") and expires > now:
+                rows.append((str(row["token"]), row["username"], expires))
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO imported VALUES (?, ?)", (sheet_name, now))
+            conn.commit()
+        return len(rows)
+
+    def start_sweeper(self, interval=None, stop=None):
+        """Run sweep() every `interval` seconds from a daemon thread (once per process)."""
+        interval = interval or SWEEP_INTERVAL
+        stop = stop or threading.Event()
+        with self._lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return self._sweeper
+
+            def run():
+                while not stop.wait(interval):
+                    try:
+                        removed = self.sweep()
+                        if removed:
+                            logger.info(f"Removed {removed} expired sessions")
+                    except sqlite3.Error as e:
+                        logger.warning(f"Session sweep failed: {e}")
+
+            self._sweeper = threading.Thread(target=run, name="session-sweeper", daemon=True)
+            self._sweeper.start()
+            return self._sweeper
+
+
+# Singleton
+session_store = SessionStore()
@@ -0,0 +1,141 @@
+"""
+Unithread App — Shared read-only snapshot of the most used sheets.
+
+With `gunicorn --preload` (see gunicorn.conf.py) the master loads the
+commonly used sheets once before forking, so every worker starts with a
+warm cache instead of paying for Sheets round trips on its first requests.
+The same data is written to a snapshot file that all workers read through
+a memory map; one worker (holding a file lock) rewrites it every
+REFRESH_INTERVAL seconds. GoogleSheetsDB.load_data uses a snapshot entry
+on a cache miss when it is no older than its own cache TTL and newer than
+the worker's last write to that sheet.
+"""
+
+import os
+import json
+import mmap
+import time
+import logging
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows dev machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = Path(os.environ.get(
+    "SHEETS_SNAPSHOT_FILE", Path(__file__).parent / "foretag_data" / "sheets_snapshot.json"
+))
+WARM_SHEETS = ("users", "expenses", "revenue", "budget")
+REFRESH_INTERVAL = int(os.environ.get("SHEETS_SNAPSHOT_REFRESH", 30))  # seconds
+
+
+def write_snapshot(db, sheets=WARM_SHEETS, path=None):
+    """Load sheets fresh from Sheets and atomically replace the snapshot file."""
+    path = Path(path or SNAPSHOT_FILE)
+    data = {"built_at": time.time(), "sheets": {}}
+    for name in sheets:
+        data["sheets"][name] = db.load_data(name, fresh=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, default=str)
+    os.replace(tmp, path)
+    return data["built_at"]
+
+
+class SnapshotReader:
+    """Memory-mapped view of the snapshot file, re-read only when the file is replaced."""
+
+    def __init__(self, path=None):
+        self.path = Path(path or SNAPSHOT_FILE)
+        self._version = None
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if version != self._version:
+                self._data = None
+                if stat.st_size:
+                    try:
+                        with open(self.path, "rb") as f, \
+                                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            self._data = json.loads(mm[:])
+                    except (OSError, ValueError) as e:
+                        logger.warning(f"Unreadable sheets snapshot {self.path}: {e}")
+                self._version = version
+            return self._data
+
+    def get(self, sheet_name, max_age, newer_than=0.0):
+        """
+        Return (rows, built_at) for sheet_name if the snapshot has it, is at
+        most max_age seconds old and was built after newer_than; else None.
+        """
+        data = self._current()
+        if not data or sheet_name not in data.get("sheets", {}):
+            return None
+        built_at = float(data.get("built_at", 0))
+        if built_at <= newer_than or time.time() - built_at > max_age:
+            return None
+        return data["sheets"][sheet_name], built_at
+
+
+def warm_up(db, sheets=WARM_SHEETS):
+    """Load the warm sheets into this process's cache and publish the snapshot (gunicorn master)."""
+    started = time.time()
+    try:
+        write_snapshot(db, sheets)
+    except Exception as e:
+        # Workers fall back to loading from Sheets on demand
+        logger.error(f"Sheets warm-up failed: {e}")
+        return False
+    logger.info(f"Sheets warm-up: {', '.join(sheets)} in {time.time() - started:.2f}s")
+    return True
+
+
+def start_refresher(db, sheets=WARM_SHEETS, interval=None, path=None, stop=None):
+    """
+    Keep the snapshot current from a daemon thread. Every worker starts one;
+    only the worker holding the lock file refreshes, the others stand by.
+    Set the `stop` event to end the thread.
+    """
+    interval = interval or REFRESH_INTERVAL
+    path = Path(path or SNAPSHOT_FILE)
+    lock_path = path.with_name(path.name + ".lock")
+    stop = stop or threading.Event()
+
+    def run():
+        lock_file = None
+        while not stop.wait(interval):
+            if fcntl is not None and lock_file is None:
+                lock_path.parent.mkdir(parents=True, exist_ok=True)
+                handle = open(lock_path, "a")
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    lock_file = handle  # held while this refresher runs
+                except OSError:
+                    handle.close()
+                    continue
+            try:
+                write_snapshot(db, sheets, path)
+            except Exception as e:
+                logger.warning(f"Sheets snapshot refresh failed: {e}")
+        if lock_file is not None:
+            lock_file.close()
+
+    thread = threading.Thread(target=run, name="sheets-snapshot", daemon=True)
+    thread.start()
+    return thread
+
+
+# Singleton
+snapshot_reader = SnapshotReader()
@@ -0,0 +1,145 @@
+"""
+Unithread App — Socket.IO fan-out between worker processes.
+
+Each gunicorn worker only knows the Socket.IO clients connected to it, so
+an emit (a new chat message) has to be relayed to the other workers. The
+relay is chosen with SOCKETIO_MESSAGE_QUEUE:
+
+- unset                     single process, no relay
+- sqlite / sqlite:///path   SQLiteManager below: a table in a local SQLite
+                            file that every worker on the machine polls
+                            every POLL_INTERVAL seconds; no extra service
+- redis://, amqp://, kafka://, zmq+tcp://...
+                            Flask-SocketIO's own queue managers
+
+gunicorn.conf.py selects the SQLite queue when running several workers.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+from socketio import PubSubManager
+
+logger = logging.getLogger(__name__)
+
+QUEUE_FILE = Path(os.environ.get(
+    "SOCKETIO_QUEUE_FILE", Path(__file__).parent / "foretag_data" / "socketio_queue.db"
+))
+POLL_INTERVAL = 0.05  # seconds between checks for messages from other workers
+RETENTION = 60  # seconds a relayed message is kept before it is pruned
+
+
+class SQLiteManager(PubSubManager):
+    """Socket.IO client manager that relays messages through a shared SQLite table."""
+
+    name = "sqlite"
+
+    def __init__(self, path=QUEUE_FILE, channel="flask-socketio", write_only=False,
+                 logger=None, json=None, poll_interval=POLL_INTERVAL, retention=RETENTION):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._conn = None
+        self._pid = None
+        self._published = 0
+        self._lock = threading.Lock()
+
+    @property
+    def host_id(self):
+        # Workers forked from a preloaded master must not share the master's
+        # id, or each would drop the others' messages as its own
+        if self._host_pid != os.getpid():
+            self._host_id = uuid.uuid4().hex
+            self._host_pid = os.getpid()
+        return self._host_id
+
+    @host_id.setter
+    def host_id(self, value):
+        self._host_id = value
+        self._host_pid = os.getpid()
+
+    def _connect(self):
+        """Open the queue on first use in this process (the master's handle is not reused after fork)."""
+        if self._conn is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, id)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _publish(self, data):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO messages (channel, created, payload) VALUES (?, ?, ?)",
+                         (self.channel, now, self.json.dumps(data)))
+            self._published += 1
+            if self._published % 100 == 0:
+                conn.execute("DELETE FROM messages WHERE created < ?", (now - self.retention,))
+            conn.commit()
+
+    def _sleep(self, seconds):
+        if self.server is not None:
+            self.server.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _last_id(self):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT MAX(id) FROM messages WHERE channel = ?", (self.channel,)).fetchone()
+        return row[0] or 0
+
+    def _poll(self, after):
+        """(id, payload) rows published after message id `after`."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, payload FROM messages WHERE channel = ? AND id > ? ORDER BY id",
+                (self.channel, after),
+            ).fetchall()
+
+    def _listen(self):
+        # Only messages published from now on; older ones were for clients of the past
+        last = self._last_id()
+        while True:
+            try:
+                rows = self._poll(last)
+            except sqlite3.Error as e:
+                logger.warning(f"Socket.IO queue read failed: {e}")
+                rows = []
+            for message_id, payload in rows:
+                last = message_id
+                yield payload
+            if not rows:
+                self._sleep(self.poll_interval)
+
+
+def queue_options(url=None):
+    """SocketIO() keyword arguments for the queue named by url (default: SOCKETIO_MESSAGE_QUEUE)."""
+    if url is None:
+        url = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+    url = url.strip()
+    if not url:
+        return {}
+    if url == "sqlite" or url.startswith("sqlite://"):
+        path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else ""
+        return {"client_manager": SQLiteManager(path or QUEUE_FILE)}
+    return {"message_queue": url}
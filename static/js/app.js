@@ -13,6 +13,9 @@ const state = {
     constants: null,
     chatGroupId: null,
     chatPollTimer: null,
+    chatMessages: [],
+    chatHasOlder: false,
+    chatUnread: {},
     calYear: new Date().getFullYear(),
     calMonth: new Date().getMonth() + 1,
     selectedProjectId: null,
@@ -44,6 +47,48 @@ async function apiForm(url, formData) {
     return res.json();
 }
 
+// Files above this size are sent in resumable chunks (/api/uploads)
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+
+/** Upload a file in chunks, resuming after network errors; returns the upload id. */
+async function uploadChunked(file, target) {
+    const start = await api('/api/uploads', {
+        method: 'POST',
+        body: JSON.stringify({ filename: file.name, size: file.size, target }),
+    });
+    if (!start || !start.ok) throw new Error((start && start.error) || 'Uppladdning misslyckades');
+    const { id, chunk_size: chunkSize } = start.upload;
+    let offset = 0, failures = 0;
+    while (offset < file.size) {
+        try {
+            const res = await fetch(`/api/uploads/${id}?offset=${offset}`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/octet-stream', 'X-CSRFToken': getCsrfToken() },
+                body: file.slice(offset, offset + chunkSize),
+            });
+            const data = await res.json();
+            if (res.ok || res.status === 409) { offset = data.offset; failures = 0; continue; }
+            throw new Error(data.error);
+        } catch (err) {
+            if (++failures > 5) throw err;
+            await new Promise(r => setTimeout(r, 1000 * failures));
+            const status = await api(`/api/uploads/${id}`);  // resume where the server stands
+            if (status && status.ok) offset = status.upload.offset;
+        }
+    }
+    const done = await api(`/api/uploads/${id}/complete`, { method: 'POST', body: '{}' });
+    if (!done || !done.ok) throw new Error((done && done.error) || 'Uppladdning misslyckades');
+    return id;
+}
+
+/** Add files to a form: small ones inline, large ones as ids of chunked uploads. */
+async function appendFiles(formData, files, target) {
+    for (const f of files) {
+        if (f.size > CHUNKED_UPLOAD_THRESHOLD) formData.append('uploads', await uploadChunked(f, target));
+        else formData.append('files', f);
+    }
+}
+
 // ---------------------------------------------------------------------------
 // Utilities
 // ---------------------------------------------------------------------------
@@ -134,6 +179,9 @@ function closeModal() {
 async function init() {
     state.constants = await api('/api/constants');
     renderPage();
+    // Unread badges are pushed to every page, not only the chat
+    initSocket();
+    refreshChatUnread();
 }
 
 function renderPage() {
@@ -744,7 +792,7 @@ function receiptThumbnails(files) {
     if (!files.length) return '<span class="text-muted text-sm">—</span>';
     return files.map(f => {
         if (isImage(f)) {
-            return `<img src="/uploads/${f}" class="receipt-thumb" onclick="event.stopPropagation();openLightbox('/uploads/${f}')" title="Klicka för att förstora" alt="Kvitto">`;
+            return `<img src="/uploads/${f}/thumb?w=160" loading="lazy" class="receipt-thumb" onerror="this.onerror=null;this.src='/uploads/${f}'" onclick="event.stopPropagation();openLightbox('/uploads/${f}')" title="Klicka för att förstora" alt="Kvitto">`;
         }
         return `<a href="/uploads/${f}" target="_blank" class="receipt-file-badge" onclick="event.stopPropagation()" title="${f}">PDF</a>`;
     }).join('');
@@ -788,9 +836,9 @@ function openReceiptDetail(r) {
     const imagePreview = files.length
         ? `<div class="receipt-preview-grid">${files.map(f => {
             if (isImage(f)) {
-                return `<div class="receipt-preview-item"><img src="/uploads/${f}" class="receipt-preview-img" onclick="openLightbox('/uploads/${f}')" title="Klicka för fullskärm"></div>`;
+                return `<div class="receipt-preview-item"><img src="/uploads/${f}/thumb?w=640" class="receipt-preview-img" onerror="this.onerror=null;this.src='/uploads/${f}'" onclick="openLightbox('/uploads/${f}')" title="Klicka för fullskärm"></div>`;
             }
-            return `<div class="receipt-preview-item"><a href="/uploads/${f}" target="_blank" class="receipt-pdf-link"><svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" width="32" height="32"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"/><polyline points="14 2 14 8 20 8"/></svg><span>Öppna PDF</span></a></div>`;
+            return `<div class="receipt-preview-item"><a href="/uploads/${f}" target="_blank" class="receipt-pdf-link"><img src="/uploads/${f}/thumb?w=640" class="receipt-preview-img" onerror="this.nextElementSibling.style.display='';this.remove()" alt="PDF"><svg style="display:none" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" width="32" height="32"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"/><polyline points="14 2 14 8 20 8"/></svg><span>Öppna PDF</span></a></div>`;
         }).join('')}</div>`
         : '<p class="text-muted text-sm">Ingen fil bifogad</p>';
 
@@ -860,8 +908,12 @@ async function submitReceipt(e) {
     fd.append('kategori', el('recKat').value);
     fd.append('beskrivning', el('recBesk').value);
     fd.append('belopp', el('recBelopp').value);
-    const files = el('recFiles').files;
-    for (let i = 0; i < files.length; i++) fd.append('files', files[i]);
+    try {
+        await appendFiles(fd, el('recFiles').files, 'receipts');
+    } catch (err) {
+        toast(err.message, 'error');
+        return;
+    }
     await apiForm('/api/receipts', fd);
     closeModal();
     toast('Kvitto uppladdat', 'success');
@@ -1103,13 +1155,19 @@ function initSocket() {
     if (socket) return;
     socket = io({ transports: ['websocket', 'polling'] });
     socket.on('new_message', (msg) => {
-        if (msg.group_id === state.chatGroupId) {
-            appendChatMessage(msg);
-        } else {
-            // Show badge for other groups
-            const badge = el('chatBadge');
-            if (badge) { badge.style.display = 'inline'; badge.textContent = '!'; }
+        if (msg.group_id === state.chatGroupId) appendChatMessage(msg);
+    });
+    socket.on('unread', (data) => {
+        if (data.unread && isChatOpen(data.group_id)) {
+            markChatRead(data.group_id);  // already on screen
+            return;
         }
+        state.chatUnread[data.group_id] = data.unread;
+        updateChatBadge();
+        updateChatGroupItem(data.group_id, data.unread, data.last_message);
+    });
+    socket.on('presence', (diff) => {
+        if (diff.group_id === state.chatGroupId) renderChatPresence(diff.members);
     });
     socket.on('user_typing', (data) => {
         if (data.group_id === state.chatGroupId) {
@@ -1118,6 +1176,49 @@ function initSocket() {
     });
 }
 
+function isChatOpen(gid) {
+    return state.page === 'chat' && state.chatGroupId === gid && !document.hidden;
+}
+
+function updateChatBadge() {
+    const badge = el('chatBadge');
+    if (!badge) return;
+    const total = Object.values(state.chatUnread).reduce((sum, n) => sum + (n || 0), 0);
+    badge.textContent = total > 99 ? '99+' : total;
+    badge.style.display = total ? 'inline' : 'none';
+}
+
+function chatPreview(g) {
+    const m = g.last_message;
+    if (m && m.content) return `${m.sender === state.user ? 'Du' : escHtml(m.sender)}: ${escHtml(m.content)}`;
+    return Array.isArray(g.members) ? g.members.length + ' medlemmar' : '';
+}
+
+function updateChatGroupItem(gid, unread, lastMessage) {
+    const item = document.querySelector(`.chat-group-item[data-gid="${CSS.escape(gid)}"]`);
+    if (!item) return;
+    const badge = item.querySelector('.badge');
+    badge.textContent = unread;
+    badge.style.display = unread ? 'inline' : 'none';
+    if (lastMessage) item.querySelector('.group-preview').innerHTML = chatPreview({ last_message: lastMessage });
+}
+
+async function refreshChatUnread() {
+    const groups = await api('/api/chat/groups');
+    if (!Array.isArray(groups)) return;
+    state.chatUnread = {};
+    groups.forEach(g => { state.chatUnread[String(g.id)] = g.unread || 0; });
+    updateChatBadge();
+    return groups;
+}
+
+async function markChatRead(gid) {
+    state.chatUnread[gid] = 0;
+    updateChatBadge();
+    updateChatGroupItem(gid, 0);
+    await api(`/api/chat/groups/${gid}/read`, { method: 'POST' });
+}
+
 function showTypingIndicator(user) {
     let ti = el('typingIndicator');
     if (!ti) return;
@@ -1149,7 +1250,7 @@ async function renderChat() {
 }
 
 async function loadChatGroups() {
-    const groups = await api('/api/chat/groups');
+    const groups = await refreshChatUnread();
     if (!groups || !groups.length) {
         el('chatGroupList').innerHTML = '<div class="card-body text-muted text-sm">Inga grupper ännu</div>';
         return;
@@ -1157,12 +1258,12 @@ async function loadChatGroups() {
     el('chatGroupList').innerHTML = groups.map(g => {
         const canDelete = state.role === 'admin' || g.created_by === state.user;
         return `
-        <div class="chat-group-item${state.chatGroupId === g.id ? ' active' : ''}" onclick="selectChatGroup('${escHtml(g.id)}', '${escHtml(g.name).replace(/'/g, "\\'")}')">
+        <div class="chat-group-item${state.chatGroupId === g.id ? ' active' : ''}" data-gid="${escHtml(g.id)}" onclick="selectChatGroup('${escHtml(g.id)}', '${escHtml(g.name).replace(/'/g, "\\'")}')">
             <div style="display:flex;justify-content:space-between;align-items:center">
-                <div class="group-name">${escHtml(g.name)}</div>
+                <div class="group-name">${escHtml(g.name)} <span class="badge" style="display:${g.unread ? 'inline' : 'none'}">${g.unread || 0}</span></div>
                 ${canDelete ? `<button class="btn btn-ghost btn-xs" onclick="event.stopPropagation();deleteChatGroup('${escHtml(g.id)}','${escHtml(g.name).replace(/'/g, "\\'")}')" title="Ta bort grupp">✕</button>` : ''}
             </div>
-            <div class="group-preview">${Array.isArray(g.members) ? g.members.length + ' medlemmar' : ''}</div>
+            <div class="group-preview">${chatPreview(g)}</div>
         </div>`;
     }).join('');
 }
@@ -1176,10 +1277,15 @@ async function selectChatGroup(gid, name) {
     if (state.chatPollTimer) { clearInterval(state.chatPollTimer); state.chatPollTimer = null; }
 
     state.chatGroupId = gid;
-    loadChatGroups(); // Refresh active state
+    state.chatMessages = [];
+    state.chatHasOlder = false;
+    markChatRead(gid).then(loadChatGroups); // Clear its badge and refresh active state
 
     el('chatMain').innerHTML = `
-        <div style="padding:16px;border-bottom:1px solid var(--border);font-weight:700">${name}</div>
+        <div style="padding:16px;border-bottom:1px solid var(--border)">
+            <span style="font-weight:700">${name}</span>
+            <span id="chatPresence" class="text-muted text-sm" style="margin-left:8px"></span>
+        </div>
         <div class="chat-messages" id="chatMessages"><div class="spinner"></div></div>
         <div id="typingIndicator" class="typing-indicator" style="display:none"></div>
         <div class="chat-input-bar">
@@ -1194,37 +1300,93 @@ async function selectChatGroup(gid, name) {
     // Join WebSocket room
     if (socket) socket.emit('join_chat', { group_id: gid });
 
-    // Load existing messages
+    // Load existing messages and who is here
     loadChatMessages();
+    loadChatPresence();
 
     // Fallback poll every 30s (in case socket disconnects)
     state.chatPollTimer = setInterval(loadChatMessages, 30000);
 }
 
+let _lastTypingEmit = 0;
+
 function emitTyping() {
-    if (socket && state.chatGroupId) {
+    // The server broadcasts at most one typing event per 2 s anyway
+    const now = Date.now();
+    if (socket && state.chatGroupId && now - _lastTypingEmit > 1500) {
+        _lastTypingEmit = now;
         socket.emit('typing', { group_id: state.chatGroupId });
     }
 }
 
-async function loadChatMessages() {
-    if (!state.chatGroupId) return;
-    const msgs = await api(`/api/chat/groups/${state.chatGroupId}/messages`);
+function renderChatPresence(members) {
+    const p = el('chatPresence');
+    if (!p) return;
+    const others = (members || []).filter(u => u !== state.user);
+    p.textContent = others.length ? `Online: ${others.join(', ')}` : '';
+}
+
+async function loadChatPresence() {
+    const gid = state.chatGroupId;
+    if (!gid) return;
+    const data = await api(`/api/chat/groups/${gid}/presence`);
+    if (data && gid === state.chatGroupId) renderChatPresence(data.members);
+}
+
+const CHAT_PAGE_SIZE = 50;
+
+function chatMessageHtml(m) {
+    return `
+        <div class="chat-msg ${m.sender === state.user ? 'own' : 'other'}">
+            ${m.sender !== state.user ? `<div class="msg-sender">${escHtml(m.sender)}</div>` : ''}
+            <div>${escHtml(m.content)}</div>
+            <div class="msg-time">${m.timestamp ? escHtml(m.timestamp.slice(11, 16)) : ''}</div>
+        </div>`;
+}
+
+/** Merge a page into the loaded messages (by id), oldest first */
+function mergeChatMessages(page) {
+    const seen = new Set(state.chatMessages.map(m => m.id));
+    const merged = state.chatMessages.concat(page.filter(m => !seen.has(m.id)));
+    merged.sort((a, b) => String(a.timestamp || '').localeCompare(String(b.timestamp || '')));
+    state.chatMessages = merged;
+}
+
+function renderChatMessages(keepScroll = false) {
     const container = el('chatMessages');
     if (!container) return;
-    if (!msgs || !msgs.length) {
+    if (!state.chatMessages.length) {
         container.innerHTML = '<div class="chat-empty">Inga meddelanden ännu. Säg hej! 👋</div>';
         return;
     }
     const wasAtBottom = container.scrollTop + container.clientHeight >= container.scrollHeight - 50;
-    container.innerHTML = msgs.map(m => `
-        <div class="chat-msg ${m.sender === state.user ? 'own' : 'other'}">
-            ${m.sender !== state.user ? `<div class="msg-sender">${escHtml(m.sender)}</div>` : ''}
-            <div>${escHtml(m.content)}</div>
-            <div class="msg-time">${m.timestamp ? escHtml(m.timestamp.slice(11, 16)) : ''}</div>
-        </div>
-    `).join('');
-    if (wasAtBottom) container.scrollTop = container.scrollHeight;
+    const fromBottom = container.scrollHeight - container.scrollTop;
+    container.innerHTML = (state.chatHasOlder
+        ? '<div class="text-center" style="padding:8px"><button class="btn btn-ghost btn-xs" onclick="loadOlderChatMessages()">Visa äldre meddelanden</button></div>'
+        : '') + state.chatMessages.map(chatMessageHtml).join('');
+    if (keepScroll) container.scrollTop = container.scrollHeight - fromBottom;
+    else if (wasAtBottom) container.scrollTop = container.scrollHeight;
+}
+
+async function loadChatMessages() {
+    const gid = state.chatGroupId;
+    if (!gid) return;
+    const msgs = await api(`/api/chat/groups/${gid}/messages?limit=${CHAT_PAGE_SIZE}`);
+    if (!msgs || gid !== state.chatGroupId) return;
+    if (!state.chatMessages.length) state.chatHasOlder = msgs.length === CHAT_PAGE_SIZE;
+    mergeChatMessages(msgs);
+    renderChatMessages();
+}
+
+async function loadOlderChatMessages() {
+    const gid = state.chatGroupId;
+    if (!gid || !state.chatMessages.length) return;
+    const before = encodeURIComponent(state.chatMessages[0].id || '');
+    const msgs = await api(`/api/chat/groups/${gid}/messages?before=${before}&limit=${CHAT_PAGE_SIZE}`);
+    if (!msgs || gid !== state.chatGroupId) return;
+    state.chatHasOlder = msgs.length === CHAT_PAGE_SIZE;
+    mergeChatMessages(msgs);
+    renderChatMessages(true);
 }
 
 function appendChatMessage(msg) {
@@ -1233,6 +1395,8 @@ function appendChatMessage(msg) {
     // Remove empty state if present
     const emptyEl = container.querySelector('.chat-empty');
     if (emptyEl) emptyEl.remove();
+    if (state.chatMessages.some(m => m.id === msg.id)) return;
+    state.chatMessages.push(msg);
     const wasAtBottom = container.scrollTop + container.clientHeight >= container.scrollHeight - 50;
     const div = document.createElement('div');
     div.className = `chat-msg ${msg.sender === state.user ? 'own' : 'other'}`;
@@ -2810,7 +2974,9 @@ async function loadProjectFiles(pid) {
         ${(files || []).length ? `<div class="card">
             ${files.map(f => `
                 <div class="activity-item" style="padding:12px 16px">
-                    <div style="font-size:1.2rem">📄</div>
+                    ${isImage(f.filename) || /\.pdf$/i.test(f.filename)
+                        ? `<img src="/api/projects/files/${escHtml(f.filename)}/thumb?w=160" loading="lazy" alt="" style="width:40px;height:40px;object-fit:cover;border-radius:4px" onerror="this.outerHTML='<div style=&quot;font-size:1.2rem&quot;>📄</div>'">`
+                        : '<div style="font-size:1.2rem">📄</div>'}
                     <div class="flex-1">
                         <a href="/api/projects/files/${escHtml(f.filename)}" target="_blank" style="font-weight:600;color:var(--primary)">${escHtml(f.original_name || f.filename)}</a>
                         <div class="text-muted text-sm">Uppladdad av ${escHtml(f.uploaded_by)} · ${escHtml(f.uploaded_at || '')}</div>
@@ -2838,7 +3004,12 @@ async function submitProjectFile(e, pid) {
     const fileInput = el('projFileInput');
     if (!fileInput.files.length) return;
     const formData = new FormData();
-    for (const f of fileInput.files) formData.append('files', f);
+    try {
+        await appendFiles(formData, fileInput.files, 'projects');
+    } catch (err) {
+        toast(err.message, 'error');
+        return;
+    }
     const res = await fetch(`/api/projects/${pid}/files`, { method: 'POST', body: formData });
     const data = await res.json();
     closeModal();
@@ -2947,6 +3118,7 @@ document.addEventListener('visibilitychange', () => {
     if (document.hidden) {
         if (state.chatPollTimer) { clearInterval(state.chatPollTimer); state.chatPollTimer = null; }
     } else if (state.page === 'chat' && state.chatGroupId) {
+        if (state.chatUnread[state.chatGroupId]) markChatRead(state.chatGroupId);
         loadChatMessages();
         state.chatPollTimer = setInterval(loadChatMessages, 30000);
     }
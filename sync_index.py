@@ -0,0 +1,135 @@
+"""
+Unithread App — Persistent dedup index for integration imports.
+
+Maps (sheet, bolag, source, source_id) → row id so an imported row can be checked
+with a single indexed lookup instead of loading the whole expenses/revenue
+sheet on every sync. Source ids are only unique per business (day-level
+ids such as meta_2025-03-10 repeat for every bolag on a platform), so the
+business is part of the key. The index lives in a local SQLite file and is rebuilt
+from the sheet once if the file is missing (e.g. on a fresh server disk).
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+INDEX_FILE = Path(os.environ.get(
+    "SYNC_INDEX_FILE", Path(__file__).parent / "foretag_data" / "sync_index.db"
+))
+
+
+class SourceIndex:
+    """(sheet, bolag, source, source_id) → (row id, belopp) lookup table backed by SQLite."""
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = Path(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open the database on first use (no disk access at import time)."""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            columns = [r[1] for r in conn.execute("PRAGMA table_info(source_rows)")]
+            if columns and "bolag" not in columns:
+                # Index written before it was keyed by business: rebuild it from the sheets
+                conn.execute("DROP TABLE source_rows")
+                conn.execute("DROP TABLE IF EXISTS built_sheets")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS source_rows (
+                    sheet TEXT NOT NULL,
+                    bolag TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    row_id TEXT NOT NULL,
+                    belopp REAL,
+                    PRIMARY KEY (sheet, bolag, source, source_id)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS source_rows_row ON source_rows (sheet, row_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS built_sheets (
+                    sheet TEXT PRIMARY KEY,
+                    built_at TEXT NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def ensure_built(self, db, sheet_name):
+        """Seed the index from the sheet the first time it is used for sheet_name."""
+        with self._lock:
+            conn = self._connect()
+            if conn.execute("SELECT 1 FROM built_sheets WHERE sheet = ?", (sheet_name,)).fetchone():
+                return
+        rows = db.load_data(sheet_name)
+        entries = [
+            (sheet_name, str(r.get("bolag", "")), str(r.get("source", "")), str(r.get("source_id")),
+             str(r.get("id", "")), _to_float(r.get("belopp")))
+            for r in rows if r.get("source_id")
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO source_rows VALUES (?, ?, ?, ?, ?, ?)", entries)
+            conn.execute("INSERT OR REPLACE INTO built_sheets VALUES (?, ?)",
+                         (sheet_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.commit()
+
+    def lookup(self, sheet_name, bolag, source, source_id):
+        """Return {"row_id", "belopp"} for a row imported for bolag, or None."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT row_id, belopp FROM source_rows"
+                " WHERE sheet = ? AND bolag = ? AND source = ? AND source_id = ?",
+                (sheet_name, str(bolag), str(source), str(source_id)),
+            ).fetchone()
+        if not row:
+            return None
+        return {"row_id": row[0], "belopp": row[1]}
+
+    def add(self, sheet_name, bolag, source, source_id, row_id, belopp=None):
+        """Record (or update) the row an imported source_id was written to."""
+        self.add_many(sheet_name, [(bolag, source, source_id, row_id, belopp)])
+
+    def add_many(self, sheet_name, entries):
+        """Record many (bolag, source, source_id, row_id, belopp) tuples in one transaction."""
+        rows = [(sheet_name, str(bolag), str(src), str(sid), str(rid), _to_float(amount))
+                for bolag, src, sid, rid, amount in entries]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO source_rows VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+
+    def forget_row(self, sheet_name, row_id):
+        """Drop index entries for a deleted row so the source can be re-imported."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM source_rows WHERE sheet = ? AND row_id = ?",
+                         (sheet_name, str(row_id)))
+            conn.commit()
+
+    def reset(self):
+        """Forget everything; the next ensure_built() reloads from the sheets."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM source_rows")
+            conn.execute("DELETE FROM built_sheets")
+            conn.commit()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Singleton
+source_index = SourceIndex()
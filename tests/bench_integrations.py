@@ -0,0 +1,88 @@
+"""
+Offline throughput benchmark for the integration adapters.
+
+Runs every adapter's iter_records() against the FakeAPI transport and
+reports records/second, API calls per sync and time spent waiting on the
+rate limiter, so changes to pagination, connection pooling, retries or
+concurrency can be compared without live credentials.
+
+Usage (from the repository root):
+    python -m tests.bench_integrations
+    python -m tests.bench_integrations --pages 20 --page-size 250 --latency 0.05
+    python -m tests.bench_integrations --platform shopify --error-rate 0.1 --json
+    python -m tests.bench_integrations --unthrottled   # raw throughput, no pacing
+"""
+
+import json
+import time
+import argparse
+
+from integrations import ADAPTERS, create_adapter, token_cache
+from metrics import metrics
+from ratelimit import rate_limiter
+from tests.fake_api import FakeAPI, FAKE_CONFIGS
+
+
+def run_platform(platform, repeat=1, unthrottled=False, **fake_options):
+    """Run `repeat` syncs of one adapter and return the averaged measurements."""
+    records = calls = errors = injected = 0
+    elapsed = 0.0
+    metrics.reset()
+    for _ in range(repeat):
+        token_cache.clear()
+        rate_limiter.reset()
+        fake = FakeAPI(**fake_options)
+        with fake.installed():
+            adapter = create_adapter(platform, FAKE_CONFIGS[platform])
+            if unthrottled:
+                rate_limiter.bucket(adapter._rate_limit_key(), 1e9, 1e9)
+            started = time.perf_counter()
+            records += sum(1 for _ in adapter.iter_records())
+            elapsed += time.perf_counter() - started
+        calls += fake.calls[platform]
+        injected += fake.errors[platform]
+        errors += len(adapter.errors)
+    waits = metrics.snapshot()["timings"].get("integration_throttle_wait_seconds", {})
+    throttled = sum(t["sum"] for label, t in waits.items() if label.split(":")[0] == platform)
+    return {
+        "platform": platform,
+        "records": records // repeat,
+        "calls_per_sync": round(calls / repeat, 1),
+        "injected_errors": round(injected / repeat, 1),
+        "adapter_errors": round(errors / repeat, 1),
+        "seconds": round(elapsed / repeat, 4),
+        "throttle_wait_s": round(throttled / repeat, 4),
+        "records_per_s": round(records / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark integration adapters against fake APIs.")
+    parser.add_argument("--platform", choices=sorted(ADAPTERS), action="append",
+                        help="Adapter to run (repeatable, default: all)")
+    parser.add_argument("--pages", type=int, default=5, help="Pages per listing")
+    parser.add_argument("--page-size", type=int, default=100, help="Records per page")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per fake request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered 429/503")
+    parser.add_argument("--repeat", type=int, default=3, help="Syncs per adapter (averaged)")
+    parser.add_argument("--unthrottled", action="store_true", help="Disable client-side rate limiting")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = [
+        run_platform(platform, repeat=max(1, args.repeat), unthrottled=args.unthrottled, pages=args.pages,
+                     page_size=args.page_size, latency=args.latency, error_rate=args.error_rate)
+        for platform in (args.platform or list(ADAPTERS))
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'plattform':<14}{'poster':>8}{'anrop':>8}{'fel':>6}{'sek':>10}{'väntan':>10}{'poster/s':>12}")
+    for r in results:
+        print(f"{r['platform']:<14}{r['records']:>8}{r['calls_per_sync']:>8}{r['injected_errors']:>6}"
+              f"{r['seconds']:>10}{r['throttle_wait_s']:>10}{r['records_per_s']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Offline benchmark for /api/login under concurrent attempts.
+
+Seeds an in-memory users sheet (with the same cache behaviour as
+GoogleSheetsDB: one list object until a write, plus simulated Sheets
+latency on a cache miss or write) and fires logins at the Flask app from
+several threads. Reports logins/second and latency percentiles, so the
+user index, the bcrypt pool size (PASSWORD_WORKERS) and the bcrypt cost
+can be compared without touching the real spreadsheet.
+
+Usage (from the repository root):
+    python -m tests.bench_login
+    python -m tests.bench_login --users 500 --threads 16 --attempts 400
+    python -m tests.bench_login --rounds 12 --wrong-share 0.3 --json
+"""
+
+import sys
+import json
+import time
+import types
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class BenchDB:
+    """In-memory stand-in for GoogleSheetsDB with its caching semantics."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._data = {}
+        self._cached = {}
+        self.reads = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def _sheets_call(self, write):
+        with self._lock:
+            if write:
+                self.writes += 1
+            else:
+                self.reads += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def load_data(self, sheet_name, fresh=False):
+        if not fresh and sheet_name in self._cached:
+            return self._cached[sheet_name]
+        self._sheets_call(write=False)
+        rows = [dict(r) for r in self._data.get(sheet_name, [])]
+        self._cached[sheet_name] = rows
+        return rows
+
+    def _written(self, sheet_name):
+        self._sheets_call(write=True)
+        self._cached.pop(sheet_name, None)
+
+    def save_data(self, sheet_name, data_list):
+        self._data[sheet_name] = [dict(r) for r in data_list]
+        self._written(sheet_name)
+
+    def append_row(self, sheet_name, row_dict):
+        self._data.setdefault(sheet_name, []).append(dict(row_dict))
+        self._written(sheet_name)
+
+    def update_row(self, sheet_name, field, value, updates):
+        for row in self._data.get(sheet_name, []):
+            if str(row.get(field, "")) == str(value):
+                row.update(updates)
+                self._written(sheet_name)
+                return True
+        return False
+
+    def delete_row(self, sheet_name, field, value):
+        rows = self._data.get(sheet_name, [])
+        for i, row in enumerate(rows):
+            if str(row.get(field, "")) == str(value):
+                del rows[i]
+                self._written(sheet_name)
+                return True
+        return False
+
+
+def seed_users(db, count, rounds):
+    """count users sharing one password hash (hashing each would dominate setup)."""
+    pw_hash = bcrypt.hashpw(b"BenchPass123", bcrypt.gensalt(rounds)).decode("utf-8")
+    db.save_data("users", [
+        {"username": f"user{i}", "password_hash": pw_hash, "role": "user", "permissions": "[]"}
+        for i in range(count)
+    ])
+    db.reads = db.writes = 0
+
+
+def run(users=200, threads=8, attempts=200, rounds=10, latency=0.05, wrong_share=0.0, seed=1):
+    db = BenchDB(latency=latency)
+    module = types.ModuleType("google_sheets")
+    module.db = db
+    sys.modules["google_sheets"] = module
+    from app import app
+    app.config["TESTING"] = True  # also turns off the per-IP login limit
+    seed_users(db, users, rounds)
+
+    rng = random.Random(seed)
+    plan = [
+        (f"user{rng.randrange(users)}", "fel" if rng.random() < wrong_share else "BenchPass123")
+        for _ in range(attempts)
+    ]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def attempt(item):
+        nonlocal failures
+        username, password = item
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        res = client.post("/api/login", json={"username": username, "password": password})
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            failures += res.status_code != 200
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(attempt, plan))
+    total = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+
+    return {
+        "users": users,
+        "threads": threads,
+        "attempts": attempts,
+        "bcrypt_rounds": rounds,
+        "failed": failures,
+        "seconds": round(total, 3),
+        "logins_per_s": round(attempts / total, 1) if total else 0.0,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "max_ms": round(latencies[-1] * 1000, 1),
+        "sheet_reads": db.reads,
+        "sheet_writes": db.writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent logins against an in-memory users sheet.")
+    parser.add_argument("--users", type=int, default=200, help="Rows in the users sheet")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--attempts", type=int, default=200, help="Total login attempts")
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost of the seeded hashes")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per simulated Sheets call")
+    parser.add_argument("--wrong-share", type=float, default=0.0, help="Share of attempts with a wrong password")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    result = run(users=args.users, threads=args.threads, attempts=args.attempts, rounds=args.rounds,
+                 latency=args.latency, wrong_share=args.wrong_share)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        print(f"{key:<16}{value:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Fake integration APIs for tests and benchmarks.
+
+FakeAPI is a requests transport adapter that answers the Shopify, Gelato,
+TikTok, Meta, Snapchat and Google Ads endpoints used by integrations.py
+from the recorded responses in tests/fixtures/integrations. It is mounted
+on the adapters' shared session (integrations.http), so adapters run their
+real pagination and retry code without network access or credentials.
+
+    with FakeAPI(pages=5, page_size=100, latency=0.02, error_rate=0.1).installed():
+        records = list(create_adapter("shopify", config).iter_records())
+"""
+
+import json
+import random
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, timedelta
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "integrations"
+
+# Credentials accepted by the fake endpoints, one config per platform
+FAKE_CONFIGS = {
+    "shopify": {"shop_domain": "fake-shop", "access_token": "shpat_fake"},
+    "gelato": {"api_key": "gelato_fake"},
+    "tiktok_ads": {"access_token": "tt_fake", "advertiser_id": "7000000000000"},
+    "meta_ads": {"access_token": "meta_fake", "ad_account_id": "1234567890"},
+    "snapchat_ads": {"access_token": "snap_fake", "ad_account_id": "8adc3db7"},
+    "google_ads": {"developer_token": "dev_fake", "client_id": "cid_fake",
+                   "client_secret": "secret_fake", "refresh_token": "rt_fake",
+                   "customer_id": "123-456-7890"},
+}
+
+HOSTS = {
+    "fake-shop.myshopify.com": "shopify",
+    "order.gelatoapis.com": "gelato",
+    "business-api.tiktok.com": "tiktok_ads",
+    "graph.facebook.com": "meta_ads",
+    "adsapi.snapchat.com": "snapchat_ads",
+    "oauth2.googleapis.com": "google_ads",
+    "googleads.googleapis.com": "google_ads",
+}
+
+
+def load_fixture(platform):
+    with open(FIXTURES_DIR / f"{platform}.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _copy(obj):
+    return json.loads(json.dumps(obj))
+
+
+class FakeAPI(BaseAdapter):
+    """
+    Transport adapter serving paginated fake API responses.
+
+    pages:       pages (Snapchat: campaigns, Google Ads: stream batches) per listing
+    page_size:   records per page (Gelato pages by the client's own limit)
+    latency:     seconds slept per request
+    error_rate:  share of requests answered with one of error_statuses
+    fail_first:  answer the first n requests with error_statuses[0]
+    retry_after: Retry-After header sent with injected errors (None: no header)
+    """
+
+    def __init__(self, pages=3, page_size=50, latency=0.0, error_rate=0.0,
+                 error_statuses=(429, 503), fail_first=0, retry_after="0", seed=0):
+        super().__init__()
+        self.pages = pages
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.fixtures = {platform: load_fixture(platform) for platform in set(HOSTS.values())}
+        self.calls = Counter()   # platform -> requests received
+        self.errors = Counter()  # platform -> injected error responses
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._served = 0
+
+    # -- requests.adapters.BaseAdapter ------------------------------------
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        parts = urlsplit(request.url)
+        platform = HOSTS.get(parts.hostname)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._served += 1
+            if platform:
+                self.calls[platform] += 1
+            if self._served <= self.fail_first:
+                status = self.error_statuses[0]
+            elif self.error_rate and self._random.random() < self.error_rate:
+                status = self._random.choice(self.error_statuses)
+            else:
+                status = None
+            if status and platform:
+                self.errors[platform] += 1
+        if status:
+            headers = {} if self.retry_after is None else {"Retry-After": str(self.retry_after)}
+            return self._response(request, status, {"error": "injected"}, headers)
+        if not platform:
+            return self._response(request, 404, {"error": f"unknown host {parts.hostname}"})
+
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        body = json.loads(request.body) if request.body and request.method == "POST" \
+            and request.headers.get("Content-Type", "").startswith("application/json") else {}
+        handler = getattr(self, f"_{platform}")
+        result = handler(request, parts.path, query, body)
+        if result is None:
+            return self._response(request, 404, {"error": f"no fake for {parts.path}"})
+        payload, headers = result if isinstance(result, tuple) else (result, {})
+        return self._response(request, 200, payload, headers)
+
+    def close(self):
+        pass
+
+    # -- helpers ----------------------------------------------------------
+
+    @contextmanager
+    def installed(self, session=None):
+        """Mount on the integrations session for the duration of the block."""
+        if session is None:
+            from integrations import http as session
+        saved = dict(session.adapters)
+        session.mount("https://", self)
+        try:
+            yield self
+        finally:
+            session.adapters.clear()
+            session.adapters.update(saved)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    @staticmethod
+    def _response(request, status, payload, headers=None):
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = json.dumps(payload).encode("utf-8")
+        resp.headers = CaseInsensitiveDict({"Content-Type": "application/json", **(headers or {})})
+        resp.encoding = "utf-8"
+        resp.url = request.url
+        resp.request = request
+        resp.reason = "OK" if status == 200 else "Error"
+        return resp
+
+    @staticmethod
+    def _day(n):
+        """Distinct recent days, newest first, all inside the default 30-day window."""
+        return (date.today() - timedelta(days=n % 28)).isoformat()
+
+    # -- platforms --------------------------------------------------------
+
+    def _shopify(self, request, path, query, body):
+        fx = self.fixtures["shopify"]
+        if path.endswith("/shop.json"):
+            return fx["shop"]
+        if not path.endswith("/orders.json"):
+            return None
+        page = int(query.get("page_info", 0) or 0)
+        orders = []
+        for i in range(self.page_size):
+            n = page * self.page_size + i
+            order = _copy(fx["order"])
+            order["id"] = 450789469 + n
+            order["name"] = f"#{1001 + n}"
+            order["created_at"] = f"{date.today().isoformat()}T10:15:32+01:00"
+            order["updated_at"] = f"{date.today().isoformat()}T10:20:05+01:00"
+            orders.append(order)
+        headers = {"X-Shopify-Shop-Api-Call-Limit": "1/40"}
+        if page + 1 < self.pages:
+            next_url = f"https://{urlsplit(request.url).hostname}{path}?" + \
+                urlencode({"limit": query.get("limit", 250), "page_info": page + 1})
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return {"orders": orders}, headers
+
+    def _gelato(self, request, path, query, body):
+        if not path.endswith("/orders"):
+            return None
+        limit = int(query.get("limit", 100))
+        offset = int(query.get("offset", 0))
+        if offset >= self.pages * limit:
+            return {"orders": []}
+        orders = []
+        for i in range(limit):
+            order = _copy(self.fixtures["gelato"]["order"])
+            order["id"] = f"{offset + i:08d}-6628-4538-a9c2-fbf9892deb85"
+            order["createdAt"] = f"{date.today().isoformat()}T09:00:00+0000"
+            orders.append(order)
+        return {"orders": orders}
+
+    def _tiktok_ads(self, request, path, query, body):
+        fx = self.fixtures["tiktok_ads"]
+        if path.endswith("/advertiser/info/"):
+            return fx["advertiser_info"]
+        if not path.endswith("/report/integrated/get/"):
+            return None
+        page = int(body.get("page", 1))
+        rows = []
+        for i in range(self.page_size):
+            row = _copy(fx["report_row"])
+            row["dimensions"]["campaign_id"] = str(1790000000000001 + page * 1000 + i)
+            row["dimensions"]["stat_time_day"] = f"{self._day(i)} 00:00:00"
+            rows.append(row)
+        return {"code": 0, "message": "OK", "data": {
+            "list": rows,
+            "page_info": {"page": page, "page_size": self.page_size,
+                          "total_number": self.pages * self.page_size, "total_page": self.pages},
+        }}
+
+    def _meta_ads(self, request, path, query, body):
+        fx = self.fixtures["meta_ads"]
+        if not path.endswith("/insights"):
+            return fx["account"]
+        page = int(query.get("after", 0) or 0)
+        rows = []
+        for i in range(self.page_size):
+            row = _copy(fx["insight_row"])
+            row["date_start"] = row["date_stop"] = self._day(page * self.page_size + i)
+            rows.append(row)
+        payload = {"data": rows, "paging": {"cursors": {"after": str(page + 1)}}}
+        usage = {"1234567890": [{"type": "ads_insights", "call_count": 2, "total_cputime": 1,
+                                 "total_time": 1, "estimated_time_to_regain_access": 0}]}
+        headers = {"x-business-use-case-usage": json.dumps(usage)}
+        if page + 1 < self.pages:
+            payload["paging"]["next"] = f"https://graph.facebook.com{path}?" + urlencode(
+                {"access_token": query.get("access_token", ""), "after": page + 1})
+        return payload, headers
+
+    def _snapchat_ads(self, request, path, query, body):
+        fx = self.fixtures["snapchat_ads"]
+        if path.endswith("/campaigns"):
+            campaigns = []
+            for c in range(self.pages):
+                camp = _copy(fx["campaign"])
+                camp["id"] = f"{c:08d}-048b-4447-95d1-eb47b1bc8fa0"
+                campaigns.append({"sub_request_status": "SUCCESS", "campaign": camp})
+            return {"request_status": "SUCCESS", "campaigns": campaigns}
+        if path.endswith("/stats"):
+            series = []
+            for i in range(self.page_size):
+                point = _copy(fx["timeseries_point"])
+                point["start_time"] = f"{self._day(i)}T00:00:00.000-00:00"
+                series.append(point)
+            return {"request_status": "SUCCESS", "timeseries_stats": [
+                {"sub_request_status": "SUCCESS", "timeseries_stat": {"timeseries": series}}
+            ]}
+        if "/adaccounts/" in path:
+            return fx["adaccount"]
+        return None
+
+    def _google_ads(self, request, path, query, body):
+        fx = self.fixtures["google_ads"]
+        if path == "/token":
+            return fx["token"]
+        if not path.endswith("googleAds:searchStream"):
+            return None
+        if "FROM customer" in body.get("query", ""):
+            return fx["customer"]
+        batches = []
+        for b in range(self.pages):
+            results = []
+            for i in range(self.page_size):
+                row = _copy(fx["search_row"])
+                row["segments"]["date"] = self._day(b * self.page_size + i)
+                results.append(row)
+            batches.append({"results": results})
+        return batches
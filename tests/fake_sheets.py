@@ -0,0 +1,111 @@
+"""
+In-memory fake of the Google Sheets REST API v4 for async_sheets tests.
+
+FakeSheets keeps each worksheet as a list of rows (lists of cell values)
+and answers the endpoints AsyncSheetsDB uses through an httpx
+MockTransport, so no network or credentials are needed:
+
+    fake = FakeSheets(latency=0.01)
+    adb = AsyncSheetsDB(None, "sheet-id", transport=fake.transport)
+"""
+
+import re
+import json
+import asyncio
+from urllib.parse import unquote
+
+import httpx
+
+PATH = re.compile(r"^/v4/spreadsheets/(?P<id>[^/:]+)(?P<rest>.*)$")
+
+
+def _parse_range(encoded):
+    """"'name'!1:1" → ("name", "1:1")."""
+    text = unquote(encoded)
+    match = re.match(r"^'((?:[^']|'')*)'(?:!(.*))?$", text)
+    if not match:
+        return text, None
+    return match.group(1).replace("''", "'"), match.group(2)
+
+
+class FakeSheets:
+    """Spreadsheet state plus request counters, served via httpx.MockTransport."""
+
+    def __init__(self, latency=0.0, fail_first=0, fail_status=429):
+        self.sheets = {}  # title -> list of rows
+        self.latency = latency
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+
+    @property
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    def records(self, title):
+        """Worksheet contents as dicts, for assertions."""
+        rows = self.sheets.get(title) or []
+        if not rows:
+            return []
+        headers = rows[0]
+        return [{h: (r[i] if i < len(r) else "") for i, h in enumerate(headers)} for r in rows[1:]]
+
+    async def handle(self, request):
+        self.requests += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.requests <= self.fail_first:
+                return httpx.Response(self.fail_status, json={"error": {"code": self.fail_status}})
+            return self._route(request)
+        finally:
+            self.inflight -= 1
+
+    def _route(self, request):
+        match = PATH.match(request.url.raw_path.decode().split("?")[0])
+        if not match:
+            return httpx.Response(404, json={"error": "not found"})
+        rest = match.group("rest")
+        body = json.loads(request.content) if request.content else {}
+
+        if rest == "" and request.method == "GET":
+            return httpx.Response(200, json={"sheets": [
+                {"properties": {"title": title}} for title in self.sheets]})
+
+        if rest == ":batchUpdate":
+            for req in body.get("requests", []):
+                title = req["addSheet"]["properties"]["title"]
+                if title in self.sheets:
+                    return httpx.Response(400, json={"error": f"sheet {title} exists"})
+                self.sheets[title] = []
+            return httpx.Response(200, json={"replies": [{}]})
+
+        if not rest.startswith("/values/"):
+            return httpx.Response(404, json={"error": "not found"})
+        target = rest[len("/values/"):]
+        action = None
+        if target.endswith((":clear", ":append")):
+            target, action = target.rsplit(":", 1)
+        title, cells = _parse_range(target)
+        if title not in self.sheets:
+            return httpx.Response(400, json={"error": f"Unable to parse range: {title}"})
+        rows = self.sheets[title]
+
+        if request.method == "GET":
+            values = rows[:1] if cells == "1:1" else rows
+            return httpx.Response(200, json={"range": title, "values": values} if values else {"range": title})
+        if action == "clear":
+            self.sheets[title] = []
+            return httpx.Response(200, json={"clearedRange": title})
+        if action == "append":
+            rows.extend(body.get("values", []))
+            return httpx.Response(200, json={"updates": {"updatedRows": len(body.get("values", []))}})
+        if request.method == "PUT":
+            values = body.get("values", [])
+            rows[:len(values)] = values
+            return httpx.Response(200, json={"updatedRows": len(values)})
+        return httpx.Response(405, json={"error": "method not allowed"})
@@ -23,7 +23,7 @@ class MockDB:
     def __init__(self):
         self._data = {}
 
-    def load_data(self, sheet_name):
+    def load_data(self, sheet_name, fresh=False):
         return list(self._data.get(sheet_name, []))
 
     def save_data(self, sheet_name, data_list):
@@ -34,6 +34,9 @@ class MockDB:
             self._data[sheet_name] = []
         self._data[sheet_name].append(dict(row_dict))
 
+    def append_rows(self, sheet_name, rows):
+        self._data.setdefault(sheet_name, []).extend(dict(r) for r in rows)
+
     def delete_rows_by_field(self, sheet_name, field, value):
         data = self.load_data(sheet_name)
         filtered = [row for row in data if str(row.get(field, "")) != str(value)]
@@ -46,6 +49,34 @@ class MockDB:
                 row.update(updates)
         self.save_data(sheet_name, data)
 
+    def update_row(self, sheet_name, field, value, updates):
+        for row in self._data.get(sheet_name, []):
+            if str(row.get(field, "")) == str(value):
+                row.update(updates)
+                return True
+        return False
+
+    def update_rows(self, sheet_name, field, updates):
+        matched = set()
+        for value, upd in updates.items():
+            if self.update_row(sheet_name, field, value, upd):
+                matched.add(str(value))
+        return matched
+
+    def delete_row(self, sheet_name, field, value):
+        rows = self._data.get(sheet_name, [])
+        for i, row in enumerate(rows):
+            if str(row.get(field, "")) == str(value):
+                del rows[i]
+                return True
+        return False
+
+    def drop_sheet(self, sheet_name):
+        return self._data.pop(sheet_name, None) is not None
+
+    def ensure_sheet(self, sheet_name, headers):
+        self._data.setdefault(sheet_name, [])
+
     def clear_cache(self):
         pass
 
@@ -82,6 +113,68 @@ def reset_db():
     yield
 
 
+@pytest.fixture(autouse=True)
+def reset_chat_store(tmp_path, monkeypatch):
+    """Fresh chat tails, journal and unread counters per test; tests flush the journal themselves."""
+    from chat_store import chat_store
+    from chat_outbox import ChatOutbox
+    from chat_unread import unread_tracker
+    chat_store.clear()
+    monkeypatch.setattr(chat_store, "outbox", ChatOutbox(tmp_path / "chat_outbox.db"))
+    monkeypatch.setattr(unread_tracker, "path", tmp_path / "chat_unread.db")
+    monkeypatch.setattr(unread_tracker, "_conn", None)
+    monkeypatch.setattr(chat_store, "start_flusher", lambda *args, **kwargs: None)
+    monkeypatch.setattr("chat_store.MIGRATION_LOCK_FILE", tmp_path / "chat_migration.lock")
+    yield chat_store
+
+
+@pytest.fixture(autouse=True)
+def isolated_sync_index(tmp_path, monkeypatch):
+    """Keep the integration dedup index in a temp dir for each test."""
+    from sync_index import source_index
+    monkeypatch.setattr(source_index, "path", tmp_path / "sync_index.db")
+    monkeypatch.setattr(source_index, "_conn", None)
+    yield source_index
+
+
+@pytest.fixture(autouse=True)
+def isolated_search_index(tmp_path, monkeypatch):
+    """Keep the full-text search index in a temp dir for each test."""
+    from search_index import search_index
+    monkeypatch.setattr(search_index, "path", tmp_path / "search_index.db")
+    monkeypatch.setattr(search_index, "_conn", None)
+    yield search_index
+
+
+@pytest.fixture(autouse=True)
+def isolated_blob_store(tmp_path, monkeypatch):
+    """Keep upload reference counts in a temp dir for each test."""
+    from blob_store import blob_store
+    monkeypatch.setattr(blob_store, "path", tmp_path / "blobs.db")
+    monkeypatch.setattr(blob_store, "_conn", None)
+    yield blob_store
+
+
+@pytest.fixture(autouse=True)
+def isolated_upload_sessions(tmp_path, monkeypatch):
+    """Keep chunked upload state and partial files in a temp dir for each test."""
+    from chunked_upload import upload_sessions
+    monkeypatch.setattr(upload_sessions, "path", tmp_path / "uploads.db")
+    monkeypatch.setattr(upload_sessions, "partial_dir", tmp_path / "partial")
+    monkeypatch.setattr(upload_sessions, "_conn", None)
+    monkeypatch.setattr(upload_sessions, "_hashers", {})
+    yield upload_sessions
+
+
+@pytest.fixture(autouse=True)
+def isolated_backfill_store(tmp_path, monkeypatch):
+    """Keep backfill job progress in a temp dir for each test."""
+    from backfill import backfill_store
+    monkeypatch.setattr(backfill_store, "path", tmp_path / "backfill.db")
+    monkeypatch.setattr(backfill_store, "_conn", None)
+    yield backfill_store
+
+
 @pytest.fixture
 def client():
     """Flask test client."""
@@ -570,6 +663,167 @@ class TestChat:
         assert msgs[0]["content"] == "Hej allihopa!"
         assert msgs[0]["sender"] == "TestAdmin"
 
+    def _group_with_history(self, client, count):
+        gid = client.post("/api/chat/groups", json={"name": "Historik"}).get_json()["group"]["id"]
+        mock_db.save_data(f"chat_{gid}", [
+            {"id": str(i), "group_id": gid, "sender": "TestAdmin", "content": f"m{i}",
+             "timestamp": f"2026-01-01 10:{i // 60:02d}:{i % 60:02d}"}
+            for i in range(count)
+        ])
+        return gid
+
+    def test_messages_paginate_backwards(self, logged_in_admin):
+        gid = self._group_with_history(logged_in_admin, 120)
+        page = logged_in_admin.get(f"/api/chat/groups/{gid}/messages?limit=50").get_json()
+        assert [m["content"] for m in page] == [f"m{i}" for i in range(70, 120)]
+        older = logged_in_admin.get(
+            f"/api/chat/groups/{gid}/messages?before={page[0]['id']}&limit=50").get_json()
+        assert [m["content"] for m in older] == [f"m{i}" for i in range(20, 70)]
+        oldest = logged_in_admin.get(
+            f"/api/chat/groups/{gid}/messages?before={older[0]['id']}&limit=50").get_json()
+        assert len(oldest) == 20
+
+    def test_paging_inside_a_same_second_burst(self, logged_in_admin):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Skur"}).get_json()["group"]["id"]
+        mock_db.save_data(f"chat_{gid}", [
+            {"id": f"s{i}", "group_id": gid, "sender": "TestAdmin", "content": f"m{i}",
+             "timestamp": "2026-01-01 10:00:00"}
+            for i in range(10)
+        ])
+        page = logged_in_admin.get(f"/api/chat/groups/{gid}/messages?limit=4").get_json()
+        older = logged_in_admin.get(
+            f"/api/chat/groups/{gid}/messages?before={page[0]['id']}&limit=4").get_json()
+        assert [m["content"] for m in older + page] == [f"m{i}" for i in range(2, 10)]
+
+    def test_tail_cache_serves_recent_messages(self, logged_in_admin):
+        gid = self._group_with_history(logged_in_admin, 10)
+        logged_in_admin.get(f"/api/chat/groups/{gid}/messages")
+        logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "ny"})
+        with patch.object(mock_db, "load_data", wraps=mock_db.load_data) as load:
+            msgs = logged_in_admin.get(f"/api/chat/groups/{gid}/messages").get_json()
+        assert msgs[-1]["content"] == "ny"
+        assert not any(c.args[0] == f"chat_{gid}" for c in load.call_args_list)
+
+    def test_legacy_group_messages_moved_to_partition(self, logged_in_admin):
+        mock_db.save_data("chat_groups", [{"id": "gammal", "name": "Gammal", "created_by": "TestAdmin",
+                                           "members": '["TestAdmin"]'}])
+        mock_db.save_data("chat_messages", [
+            {"id": "b", "group_id": "gammal", "content": "andra", "timestamp": "2025-01-02 10:00:00"},
+            {"id": "x", "group_id": "annan", "content": "annan", "timestamp": "2025-01-01 09:00:00"},
+            {"id": "a", "group_id": "gammal", "content": "första", "timestamp": "2025-01-01 10:00:00"},
+        ])
+        msgs = logged_in_admin.get("/api/chat/groups/gammal/messages").get_json()
+        assert [m["content"] for m in msgs] == ["första", "andra"]
+        assert [m["id"] for m in mock_db.load_data("chat_messages")] == ["x"]
+        assert mock_db.load_data("chat_groups")[0]["partitioned"] is True
+
+    def test_interrupted_migration_not_duplicated(self, logged_in_admin):
+        mock_db.save_data("chat_groups", [{"id": "gammal", "name": "Gammal", "created_by": "TestAdmin",
+                                           "members": '["TestAdmin"]'}])
+        rows = [{"id": "a", "group_id": "gammal", "content": "första", "timestamp": "2025-01-01 10:00:00"},
+                {"id": "b", "group_id": "gammal", "content": "andra", "timestamp": "2025-01-02 10:00:00"}]
+        mock_db.save_data("chat_messages", rows)
+        mock_db.save_data("chat_gammal", rows[:1])  # copied by a worker that died before finishing
+        logged_in_admin.get("/api/chat/groups/gammal/messages")
+        assert [m["id"] for m in mock_db.load_data("chat_gammal")] == ["a", "b"]
+
+    def test_partition_created_with_small_grid(self, logged_in_admin):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Ny"}).get_json()["group"]["id"]
+        with patch.object(mock_db, "ensure_sheet", wraps=mock_db.ensure_sheet) as ensure:
+            logged_in_admin.get(f"/api/chat/groups/{gid}/messages")
+            logged_in_admin.get(f"/api/chat/groups/{gid}/messages?before=2099-01-01")
+        ensure.assert_called_once_with(f"chat_{gid}", ("id", "group_id", "sender", "content", "timestamp"))
+
+    def test_invalid_limit_rejected(self, logged_in_admin):
+        res = logged_in_admin.get("/api/chat/groups/abc/messages?limit=många")
+        assert res.status_code == 400
+
+    def test_send_broadcasts_without_waiting_for_sheets(self, logged_in_admin, reset_chat_store):
+        import app as app_module
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Snabb"}).get_json()["group"]["id"]
+        with patch.object(mock_db, "append_rows") as append_rows, \
+                patch.object(mock_db, "append_row") as append_row, \
+                patch.object(app_module.socketio, "emit") as emit:
+            logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "direkt"})
+        assert not append_rows.called and not append_row.called
+        assert emit.call_args.args[0] == "new_message"
+        # Readable before it reaches Sheets
+        msgs = logged_in_admin.get(f"/api/chat/groups/{gid}/messages").get_json()
+        assert [m["content"] for m in msgs] == ["direkt"]
+        assert reset_chat_store.outbox.count() == 1
+
+    def test_flush_writes_one_batch_per_group(self, logged_in_admin, reset_chat_store):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Batch"}).get_json()["group"]["id"]
+        for i in range(3):
+            logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": f"m{i}"})
+        with patch.object(mock_db, "append_rows", wraps=mock_db.append_rows) as append_rows:
+            assert reset_chat_store.flush(mock_db) == 3
+        assert append_rows.call_count == 1
+        assert reset_chat_store.outbox.count() == 0
+        reset_chat_store.clear()
+        msgs = logged_in_admin.get(f"/api/chat/groups/{gid}/messages").get_json()
+        assert [m["content"] for m in msgs] == ["m0", "m1", "m2"]
+
+    def test_journal_replayed_after_restart(self, logged_in_admin, reset_chat_store):
+        from chat_store import ChatStore
+        from chat_outbox import ChatOutbox
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Krasch"}).get_json()["group"]["id"]
+        logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "överlevde"})
+        restarted = ChatStore(ChatOutbox(reset_chat_store.outbox.path))
+        assert restarted.flush(mock_db) == 1
+        assert [m["content"] for m in mock_db.load_data(f"chat_{gid}")] == ["överlevde"]
+
+    def test_failed_flush_keeps_messages_journaled(self, logged_in_admin, reset_chat_store):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Fel"}).get_json()["group"]["id"]
+        logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "igen"})
+        with patch.object(mock_db, "append_rows", side_effect=RuntimeError("503")):
+            with pytest.raises(RuntimeError):
+                reset_chat_store.flush(mock_db)
+        assert reset_chat_store.outbox.count() == 1
+        assert reset_chat_store.flush(mock_db) == 1
+
+    def test_flush_rechecks_group_missing_from_stale_cache(self, logged_in_admin, reset_chat_store):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Ny"}).get_json()["group"]["id"]
+        logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "inte borta"})
+        load = mock_db.load_data
+
+        def stale(sheet_name, fresh=False):
+            # Another worker's cache from before the group was created
+            return [] if sheet_name == "chat_groups" and not fresh else load(sheet_name, fresh)
+
+        with patch.object(mock_db, "load_data", side_effect=stale):
+            assert reset_chat_store.flush(mock_db) == 1
+        assert [m["content"] for m in mock_db.load_data(f"chat_{gid}")] == ["inte borta"]
+
+    def test_flusher_thread_writes_journal(self, logged_in_admin, reset_chat_store):
+        import time
+        import threading
+        from chat_store import ChatStore
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Tråd"}).get_json()["group"]["id"]
+        logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "bakgrund"})
+        store, stop = ChatStore(reset_chat_store.outbox), threading.Event()
+        thread = store.start_flusher(mock_db, interval=0.01, stop=stop)
+        deadline = time.time() + 2
+        while store.outbox.count() and time.time() < deadline:
+            time.sleep(0.01)
+        stop.set()
+        thread.join(timeout=1)
+        assert mock_db.load_data(f"chat_{gid}")[0]["content"] == "bakgrund"
+
+    def test_flusher_started_by_first_request(self, client, reset_chat_store, monkeypatch):
+        start = MagicMock()
+        monkeypatch.setattr(reset_chat_store, "start_flusher", start)
+        client.get("/api/me")
+        start.assert_called_with(mock_db)
+
+    def test_duplicate_write_shown_once(self, logged_in_admin, reset_chat_store):
+        gid = logged_in_admin.post("/api/chat/groups", json={"name": "Dubbel"}).get_json()["group"]["id"]
+        msg = logged_in_admin.post(f"/api/chat/groups/{gid}/messages", json={"content": "en gång"}).get_json()["message"]
+        mock_db.append_row(f"chat_{gid}", msg)  # written, but the journal row was not yet removed
+        reset_chat_store.clear()
+        msgs = logged_in_admin.get(f"/api/chat/groups/{gid}/messages").get_json()
+        assert len(msgs) == 1
+
 
 # =====================================================================
 # Customer/CRM API tests
@@ -983,6 +1237,1583 @@ class TestIntegrationAdapters:
         })
         assert adapter.customer_id == "1234567890"
 
+    def _google_ads(self, refresh_token="rt"):
+        from integrations import GoogleAdsAdapter
+        return GoogleAdsAdapter({
+            "developer_token": "x", "client_id": "cid",
+            "client_secret": "x", "refresh_token": refresh_token,
+            "customer_id": "1234567890"
+        })
+
+    def test_google_ads_token_cached_across_instances(self):
+        from integrations import token_cache
+        token_cache.clear()
+        resp = MagicMock()
+        resp.json.return_value = {"access_token": "tok1", "expires_in": 3599}
+        with patch("integrations.http.post", return_value=resp) as post:
+            assert self._google_ads()._get_access_token() == "tok1"
+            assert self._google_ads()._get_access_token() == "tok1"
+            assert self._google_ads("other")._get_access_token() == "tok1"
+        assert post.call_count == 2
+        token_cache.clear()
+
+    def test_token_cache_refreshes_before_expiry(self):
+        from integrations import TokenCache
+        cache = TokenCache()
+        tokens = iter([("a", 30), ("b", 3600)])
+        fetch = MagicMock(side_effect=lambda: next(tokens))
+        # expires_in is inside the refresh margin, so the next call refreshes
+        assert cache.get("k", fetch) == "a"
+        assert cache.get("k", fetch) == "b"
+        assert cache.get("k", fetch) == "b"
+        assert fetch.call_count == 2
+
+    def test_token_cache_single_refresh_under_concurrency(self):
+        import threading
+        import time as _time
+        from integrations import TokenCache
+        cache = TokenCache()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            _time.sleep(0.05)
+            return "tok", 3600
+
+        threads = [threading.Thread(target=cache.get, args=("k", fetch)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1
+
+    def test_google_ads_401_invalidates_token(self):
+        import requests
+        from integrations import token_cache
+        token_cache.clear()
+        adapter = self._google_ads()
+        token_cache.get(adapter._token_key, lambda: ("stale", 3600))
+        err = requests.HTTPError(response=MagicMock(status_code=401))
+        adapter._drop_token_if_rejected(err)
+        assert token_cache._fresh(adapter._token_key) is None
+
+
+# =====================================================================
+# Adapters against the fake API harness (tests/fake_api.py)
+# =====================================================================
+
+class TestFakeApiHarness:
+    @pytest.fixture(autouse=True)
+    def no_backoff(self):
+        from integrations import token_cache
+        from ratelimit import rate_limiter
+        token_cache.clear()
+        rate_limiter.reset()
+        with patch("integrations.time.sleep"):
+            yield
+        token_cache.clear()
+
+    @pytest.mark.parametrize("platform,records,calls", [
+        ("shopify", 31, 3),        # 3 pages of orders + estimated fee row
+        ("gelato", 300, 4),        # pages by its own limit of 100, then an empty page
+        ("tiktok_ads", 10, 3),     # aggregated per day
+        ("meta_ads", 30, 3),
+        ("snapchat_ads", 30, 4),   # campaign list + stats per campaign
+        ("google_ads", 28, 2),     # token + one search stream, aggregated per day
+    ])
+    def test_adapter_pages_through_fake_api(self, platform, records, calls):
+        from integrations import create_adapter
+        from tests.fake_api import FakeAPI, FAKE_CONFIGS
+        fake = FakeAPI(pages=3, page_size=10)
+        with fake.installed():
+            adapter = create_adapter(platform, FAKE_CONFIGS[platform])
+            assert sum(1 for _ in adapter.iter_records()) == records
+        assert adapter.errors == []
+        assert fake.calls[platform] == calls
+
+    def test_transient_errors_are_retried(self):
+        from integrations import create_adapter
+        from tests.fake_api import FakeAPI, FAKE_CONFIGS
+        fake = FakeAPI(pages=2, page_size=5, fail_first=2, error_statuses=(503,))
+        with fake.installed():
+            adapter = create_adapter("meta_ads", FAKE_CONFIGS["meta_ads"])
+            assert len(list(adapter.iter_records())) == 10
+        assert adapter.errors == []
+        assert fake.calls["meta_ads"] == 4
+
+    def test_persistent_rate_limit_reported(self):
+        from integrations import create_adapter
+        from tests.fake_api import FakeAPI, FAKE_CONFIGS
+        fake = FakeAPI(error_rate=1.0, error_statuses=(429,))
+        with fake.installed():
+            adapter = create_adapter("gelato", FAKE_CONFIGS["gelato"])
+            assert list(adapter.iter_records()) == []
+        assert adapter.errors
+        assert adapter.synced_through is None
+
+    def test_uninstall_restores_transport(self):
+        from integrations import http
+        from tests.fake_api import FakeAPI
+        before = http.get_adapter("https://example.com")
+        with FakeAPI().installed() as fake:
+            assert http.get_adapter("https://example.com") is fake
+        assert http.get_adapter("https://example.com") is before
+
+
+# =====================================================================
+# Integration rate limiting tests
+# =====================================================================
+
+class TestRateLimiting:
+    @pytest.fixture(autouse=True)
+    def fresh_limiters(self):
+        from metrics import metrics
+        from ratelimit import rate_limiter
+        rate_limiter.reset()
+        metrics.reset()
+        yield
+        rate_limiter.reset()
+
+    def test_bucket_paces_after_burst(self):
+        from ratelimit import TokenBucket
+        bucket = TokenBucket("test", rate=1000, capacity=2)
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0
+        with patch("ratelimit.time.sleep") as sleep:
+            bucket.acquire()
+        assert sleep.called
+        assert sleep.call_args[0][0] == pytest.approx(0.001, abs=0.001)
+
+    def test_throttle_wait_is_recorded(self):
+        from metrics import metrics
+        from ratelimit import TokenBucket
+        bucket = TokenBucket("shopify:test", rate=200, capacity=1)
+        bucket.acquire()
+        waited = bucket.acquire()
+        assert waited > 0
+        timing = metrics.snapshot()["timings"]["integration_throttle_wait_seconds"]["shopify:test"]
+        assert timing["count"] == 1
+
+    def test_shopify_call_limit_header_syncs_bucket(self):
+        from ratelimit import rate_limiter
+        from tests.fake_api import FakeAPI, FAKE_CONFIGS
+        from integrations import create_adapter
+        fake = FakeAPI(pages=1, page_size=1)
+        with fake.installed():
+            adapter = create_adapter("shopify", FAKE_CONFIGS["shopify"])
+            list(adapter.iter_records())
+        state = rate_limiter.snapshot()["shopify:fake-shop.myshopify.com"]
+        assert state["capacity"] == 40
+        assert state["tokens"] <= 39.5
+
+    def test_meta_usage_slows_and_blocks(self):
+        from ratelimit import TokenBucket, parse_meta_usage
+        headers = {"x-business-use-case-usage": json.dumps({"123": [{
+            "type": "ads_insights", "call_count": 95, "total_cputime": 20,
+            "total_time": 30, "estimated_time_to_regain_access": 2}]})}
+        pct, regain = parse_meta_usage(headers)
+        assert pct == 95
+        assert regain == 120
+        bucket = TokenBucket("meta_ads", rate=10, capacity=10)
+        bucket.set_utilization(pct)
+        assert bucket.rate == pytest.approx(2.0)
+        bucket.pause(regain)
+        assert bucket.state()["blocked_for"] > 100
+
+    def test_429_pauses_shared_bucket(self):
+        from metrics import metrics
+        from ratelimit import rate_limiter
+        from tests.fake_api import FakeAPI, FAKE_CONFIGS
+        from integrations import create_adapter
+        fake = FakeAPI(pages=1, fail_first=1, error_statuses=(429,), retry_after="0.05")
+        with fake.installed():
+            adapter = create_adapter("gelato", FAKE_CONFIGS["gelato"])
+            assert len(list(adapter.iter_records())) == 100
+        assert metrics.snapshot()["counters"]["integration_rate_limited"]["gelato"] == 1
+        waits = metrics.snapshot()["timings"]["integration_throttle_wait_seconds"]["gelato"]
+        assert waits["sum"] >= 0.04
+        assert "gelato" in rate_limiter.snapshot()
+
+    def test_metrics_endpoint_admin_only(self, client, logged_in_user):
+        res = client.get("/api/admin/metrics")
+        assert res.status_code == 403
+
+    def test_metrics_endpoint(self, logged_in_admin):
+        from metrics import metrics
+        metrics.observe("integration_throttle_wait_seconds", 0.5, "meta_ads")
+        data = logged_in_admin.get("/api/admin/metrics").get_json()
+        assert data["timings"]["integration_throttle_wait_seconds"]["meta_ads"]["sum"] == 0.5
+        assert "rate_limits" in data
+        assert data["sheets_budget"]["per_minute"] > 0
+
+
+# =====================================================================
+# Sheets request governor tests
+# =====================================================================
+
+class TestSheetsGovernor:
+    def test_interactive_read_served_before_waiting_background(self):
+        import threading
+        import time as _time
+        from ratelimit import PriorityGovernor, INTERACTIVE_READ, BACKGROUND
+        gov = PriorityGovernor("test", 600, background_reserve=0)
+        gov.tokens = 0
+        order = []
+        bg = threading.Thread(target=lambda: (gov.acquire(BACKGROUND), order.append("bg")))
+        fg = threading.Thread(target=lambda: (gov.acquire(INTERACTIVE_READ), order.append("read")))
+        bg.start()
+        _time.sleep(0.02)
+        fg.start()
+        bg.join(2)
+        fg.join(2)
+        assert order == ["read", "bg"]
+
+    def test_background_leaves_reserve_for_users(self):
+        import threading
+        from ratelimit import PriorityGovernor, INTERACTIVE_WRITE, BACKGROUND
+        gov = PriorityGovernor("test", 60)
+        gov.tokens = 5  # below the 25% reserve (15)
+        assert gov.acquire(INTERACTIVE_WRITE) < 0.05
+        bg = threading.Thread(target=gov.acquire, args=(BACKGROUND,))
+        bg.start()
+        bg.join(0.2)
+        assert bg.is_alive()
+        assert gov.state()["waiting"]["background"] == 1
+        with gov._cond:
+            gov.tokens = gov.capacity
+            gov._cond.notify_all()
+        bg.join(2)
+        assert not bg.is_alive()
+        assert gov.state()["used_last_minute"] == {
+            "interactive_read": 0, "interactive_write": 1, "background": 1}
+
+    def test_pause_blocks_all_classes(self):
+        from ratelimit import PriorityGovernor
+        gov = PriorityGovernor("test", 60)
+        gov.pause(30)
+        state = gov.state()
+        assert state["tokens"] < 1
+        assert state["blocked_for"] > 25
+
+    def test_ingestion_runs_as_background(self):
+        from ingestion import ingest_sync_result
+        from ratelimit import current_priority, BACKGROUND, INTERACTIVE_WRITE
+        seen = []
+        original = mock_db.append_rows
+
+        def spy(sheet, rows):
+            seen.append(current_priority(write=True))
+            return original(sheet, rows)
+
+        with patch.object(mock_db, "append_rows", side_effect=spy):
+            ingest_sync_result(mock_db, {"expenses": [{"datum": "2025-03-10", "belopp": 10,
+                                                       "source_id": "x"}]}, "gelato", "Unithread")
+        assert seen == [BACKGROUND]
+        assert current_priority(write=True) == INTERACTIVE_WRITE
+
+
+# =====================================================================
+# Async Sheets client tests (httpx optional; tests/fake_sheets.py)
+# =====================================================================
+
+class TestAsyncSheets:
+    @pytest.fixture(autouse=True)
+    def requires_httpx(self):
+        pytest.importorskip("httpx")
+        from ratelimit import PriorityGovernor
+        # Own budget, so these requests don't drain the process-wide one
+        with patch("async_sheets.sheets_governor", PriorityGovernor("test", 6000)):
+            yield
+
+    def _client(self, **kwargs):
+        from async_sheets import AsyncSheetsDB
+        from tests.fake_sheets import FakeSheets
+        fake = FakeSheets(**{k: kwargs.pop(k) for k in ("latency", "fail_first") if k in kwargs})
+        return fake, AsyncSheetsDB(None, "test-sheet", transport=fake.transport, **kwargs)
+
+    def test_save_and_load_roundtrip(self):
+        fake, adb = self._client()
+        adb.save_data("users", [{"username": "Anna", "permissions": ["create_chat"]},
+                                {"username": "Erik", "role": None}])
+        assert fake.sheets["users"][0] == ["username", "permissions", "role"]
+        assert adb.load_data("users") == [
+            {"username": "Anna", "permissions": '["create_chat"]', "role": ""},
+            {"username": "Erik", "permissions": "", "role": ""},
+        ]
+        assert adb.load_data("missing") == []
+
+    def test_load_returns_formatted_values(self):
+        fake, adb = self._client()
+        fake.sheets["expenses"] = [["id", "datum", "belopp", "moms_belopp", "beskrivning"],
+                                   ["7", "2025-03-10", "1250", "12.5", "1 250,00 kr"]]
+        assert adb.load_data("expenses") == [
+            {"id": 7, "datum": "2025-03-10", "belopp": 1250, "moms_belopp": 12.5, "beskrivning": "1 250,00 kr"},
+        ]
+
+    def test_bad_request_not_taken_as_missing_sheet(self):
+        import httpx
+        from async_sheets import AsyncSheetsDB
+        transport = httpx.MockTransport(lambda request: httpx.Response(
+            400, json={"error": {"code": 400, "message": "Invalid value at 'valueRenderOption'"}}))
+        adb = AsyncSheetsDB(None, "test-sheet", transport=transport)
+        with pytest.raises(httpx.HTTPStatusError):
+            adb.load_data("users")
+
+    def test_append_rows_extends_header(self):
+        fake, adb = self._client()
+        adb.save_data("expenses", [{"id": "1", "belopp": 10}])
+        adb.append_rows("expenses", [{"id": "2", "belopp": 20, "source_id": "x"}])
+        assert fake.records("expenses") == [
+            {"id": "1", "belopp": 10, "source_id": ""},
+            {"id": "2", "belopp": 20, "source_id": "x"},
+        ]
+
+    def test_concurrency_cap(self):
+        import asyncio
+        fake, adb = self._client(latency=0.02, max_concurrency=3)
+
+        async def run():
+            async with adb:
+                await adb.asave_many({f"sheet{i}": [{"n": i}] for i in range(8)})
+                return await adb.aload_many([f"sheet{i}" for i in range(8)])
+
+        loaded = asyncio.run(run())
+        assert loaded["sheet5"] == [{"n": 5}]
+        assert 1 < fake.max_inflight <= 3
+
+    def test_rate_limited_request_is_retried(self):
+        fake, adb = self._client(fail_first=1)
+        with patch("async_sheets.sheets_governor") as governor:
+            adb.append_row("todos", {"id": "t1"})
+        governor.pause.assert_called_once()
+        assert fake.records("todos") == [{"id": "t1"}]
+
+
+# =====================================================================
+# Lazy Google Sheets connection tests (real google_sheets module)
+# =====================================================================
+
+@pytest.fixture
+def gs():
+    """The real google_sheets module, loaded under another name (the app uses the mock)."""
+    import importlib.util
+    path = Path(__file__).parent.parent / "google_sheets.py"
+    spec = importlib.util.spec_from_file_location("google_sheets_real", path)
+    module = importlib.util.module_from_spec(spec)
+    with patch("gspread.authorize") as authorize:
+        spec.loader.exec_module(module)
+        assert not authorize.called
+    return module
+
+
+class TestLazySheetsDB:
+    def test_import_does_no_network_io(self, gs):
+        assert gs.db._sheet is None
+        assert gs.db.client is None
+
+    def test_connects_once_on_first_use(self, gs):
+        import threading
+        calls = []
+
+        def fake_authenticate():
+            calls.append(1)
+            gs.db._sheet = MagicMock()
+
+        with patch.object(gs.db, "_authenticate", side_effect=fake_authenticate):
+            threads = [threading.Thread(target=lambda: gs.db.sheet) for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            gs.db.sheet
+        assert len(calls) == 1
+
+    def test_writes_use_write_priority(self, gs):
+        from ratelimit import INTERACTIVE_READ, INTERACTIVE_WRITE
+        ws = MagicMock()
+        ws.row_values.return_value = ["id"]
+        gs.db._sheet = MagicMock()
+        gs.db._sheet.worksheet.return_value = ws
+        with patch.object(gs, "sheets_governor") as governor:
+            gs.db.append_rows("todos", [{"id": "1"}])
+        priorities = [c.args[0] for c in governor.acquire.call_args_list]
+        # worksheet lookup + header read, then the append
+        assert priorities == [INTERACTIVE_READ, INTERACTIVE_READ, INTERACTIVE_WRITE]
+
+    def test_ensure_sheet_creates_minimal_grid(self, gs):
+        ws = MagicMock()
+        gs.db._sheet = MagicMock()
+        gs.db._sheet.worksheet.side_effect = gs.gspread.WorksheetNotFound("chat_g1")
+        gs.db._sheet.add_worksheet.return_value = ws
+        gs.db.ensure_sheet("chat_g1", ("id", "content"))
+        gs.db._sheet.add_worksheet.assert_called_once_with(title="chat_g1", rows=1, cols=2)
+        ws.update.assert_called_once_with([["id", "content"]], "A1", value_input_option="USER_ENTERED")
+
+    def test_initialize_database_only_when_empty(self, gs):
+        db = MagicMock()
+        db.load_data.return_value = [{"username": "Anna"}]
+        assert gs.initialize_database(db) is False
+        db.load_data.return_value = []
+        assert gs.initialize_database(db) is True
+        saved = db.save_data.call_args[0][1]
+        assert saved[0]["role"] == "admin"
+
+
+# =====================================================================
+# Preloaded sheets snapshot tests
+# =====================================================================
+
+class TestSheetsSnapshot:
+    def test_write_and_read_snapshot(self, tmp_path):
+        from snapshot import write_snapshot, SnapshotReader
+        mock_db.save_data("users", [{"username": "Anna"}])
+        path = tmp_path / "snap.json"
+        built_at = write_snapshot(mock_db, ("users", "budget"), path)
+        reader = SnapshotReader(path)
+        assert reader.get("users", max_age=60) == ([{"username": "Anna"}], built_at)
+        assert reader.get("budget", max_age=60) == ([], built_at)
+        assert reader.get("expenses", max_age=60) is None
+        assert reader.get("users", max_age=60, newer_than=built_at + 1) is None
+        with patch("snapshot.time.time", return_value=built_at + 120):
+            assert reader.get("users", max_age=60) is None
+
+    def test_reader_picks_up_replaced_file(self, tmp_path):
+        from snapshot import write_snapshot, SnapshotReader
+        path = tmp_path / "snap.json"
+        write_snapshot(mock_db, ("users",), path)
+        reader = SnapshotReader(path)
+        assert reader.get("users", max_age=60)[0] == []
+        mock_db.save_data("users", [{"username": "Erik"}])
+        write_snapshot(mock_db, ("users",), path)
+        assert reader.get("users", max_age=60)[0] == [{"username": "Erik"}]
+
+    def test_load_data_served_from_snapshot_until_local_write(self, gs, tmp_path):
+        from snapshot import write_snapshot, SnapshotReader
+        mock_db.save_data("budget", [{"bolag": "Unithread", "total": 100}])
+        path = tmp_path / "snap.json"
+        write_snapshot(mock_db, ("budget",), path)
+        gs.snapshot_reader = SnapshotReader(path)
+        gs.db._sheet = MagicMock()
+        assert gs.db.load_data("budget") == [{"bolag": "Unithread", "total": 100}]
+        assert not gs.db._sheet.worksheet.called
+
+        gs.db._invalidate_cache("budget")  # this worker wrote to the sheet
+        gs.db._sheet.worksheet.return_value.get_all_records.return_value = [{"bolag": "Unithread", "total": 200}]
+        with patch.object(gs, "sheets_governor"):
+            assert gs.db.load_data("budget") == [{"bolag": "Unithread", "total": 200}]
+
+    def test_refresher_rewrites_snapshot(self, tmp_path):
+        import threading
+        import time as _time
+        from snapshot import start_refresher, SnapshotReader
+        path = tmp_path / "snap.json"
+        stop = threading.Event()
+        mock_db.save_data("users", [{"username": "Anna"}])
+        thread = start_refresher(mock_db, ("users",), interval=0.02, path=path, stop=stop)
+        deadline = _time.time() + 2
+        while not path.exists() and _time.time() < deadline:
+            _time.sleep(0.01)
+        stop.set()
+        thread.join(1)
+        assert SnapshotReader(path).get("users", max_age=60)[0] == [{"username": "Anna"}]
+
+
+# =====================================================================
+# Login fast path tests (user index, password pool, row-level writes)
+# =====================================================================
+
+class TestLoginFastPath:
+    def test_index_reused_until_users_list_changes(self):
+        import app as app_module
+        users = [{"username": "Anna", "password_hash": "x"}]
+        index = app_module._UserIndex()
+        with patch.object(mock_db, "load_data", return_value=users):
+            assert index.get("Anna") is users[0]
+            users.append({"username": "Bo"})  # same cached list: index not rebuilt
+            assert index.get("Bo") is None
+            index.invalidate()
+            assert index.get("Bo") is users[1]
+
+    def test_login_verifies_in_password_pool(self, client, admin_user):
+        import app as app_module
+        with patch.object(app_module, "_in_password_pool", wraps=app_module._in_password_pool) as pool:
+            res = client.post("/api/login", json=admin_user)
+        assert res.get_json()["ok"] is True
+        assert pool.call_args_list[0].args[0] is app_module._verify_password
+
+    def test_legacy_hash_upgraded_with_row_update(self, client):
+        import hashlib
+        mock_db.save_data("users", [
+            {"username": "Old", "password_hash": hashlib.sha256(b"Legacy123").hexdigest(), "role": "user"},
+            {"username": "Other", "password_hash": "h", "role": "user"},
+        ])
+        with patch.object(mock_db, "save_data") as save:
+            res = client.post("/api/login", json={"username": "Old", "password": "Legacy123"})
+        assert res.get_json()["ok"] is True
+        assert not any(c.args[0] == "users" for c in save.call_args_list)
+        users = mock_db.load_data("users")
+        assert users[0]["password_hash"].startswith("$2b$")
+        assert users[1]["password_hash"] == "h"
+
+    def test_admin_user_writes_are_row_level(self, logged_in_admin, client):
+        with patch.object(mock_db, "save_data", wraps=mock_db.save_data) as save:
+            logged_in_admin.post("/api/admin/users", json={
+                "username": "Rad", "password": "Första123", "role": "user",
+            })
+            logged_in_admin.put("/api/admin/users/Rad", json={"password": "Andra456"})
+        assert not any(c.args[0] == "users" for c in save.call_args_list)
+
+        logged_in_admin.post("/api/logout")
+        res = client.post("/api/login", json={"username": "Rad", "password": "Andra456"})
+        assert res.get_json()["ok"] is True
+
+    def test_deleted_user_cannot_log_in(self, logged_in_admin, client):
+        logged_in_admin.post("/api/admin/users", json={
+            "username": "Tillfällig", "password": "Hemligt123", "role": "user",
+        })
+        logged_in_admin.delete("/api/admin/users/Tillfällig")
+        logged_in_admin.post("/api/logout")
+        res = client.post("/api/login", json={"username": "Tillfällig", "password": "Hemligt123"})
+        assert res.status_code == 401
+
+    def test_delete_removes_duplicated_user_rows(self, logged_in_admin, client):
+        row = {"username": "Dubbel", "password_hash": _hash_password("Hemligt123"), "role": "user"}
+        mock_db.append_rows("users", [row, dict(row)])
+        logged_in_admin.delete("/api/admin/users/Dubbel")
+        assert not [u for u in mock_db.load_data("users") if u["username"] == "Dubbel"]
+        logged_in_admin.post("/api/logout")
+        res = client.post("/api/login", json={"username": "Dubbel", "password": "Hemligt123"})
+        assert res.status_code == 401
+
+    def test_sheets_update_row_writes_changed_cells_only(self, gs):
+        ws = MagicMock()
+        ws.row_values.return_value = ["username", "password_hash", "role"]
+        ws.find.return_value = MagicMock(row=4)
+        gs.db._sheet = MagicMock()
+        gs.db._sheet.worksheet.return_value = ws
+        assert gs.db.update_row("users", "username", "Anna", {"role": "admin"}) is True
+        ws.find.assert_called_once_with("Anna", in_column=1)
+        cells = ws.batch_update.call_args[0][0]
+        assert cells == [{"range": "C4", "values": [["admin"]]}]
+        assert not ws.clear.called
+
+        ws.find.return_value = None
+        assert gs.db.delete_row("users", "username", "Ghost") is False
+        assert not ws.delete_rows.called
+
+    def test_sheets_update_rows_writes_one_batch(self, gs):
+        ws = MagicMock()
+        ws.row_values.return_value = ["id", "belopp", "beskrivning"]
+        ws.col_values.return_value = ["id", "e1", "e2", "e3"]
+        gs.db._sheet = MagicMock()
+        gs.db._sheet.worksheet.return_value = ws
+        matched = gs.db.update_rows("expenses", "id", {"e3": {"belopp": 5}, "e1": {"belopp": 7}, "x": {"belopp": 1}})
+        assert matched == {"e1", "e3"}
+        ws.batch_update.assert_called_once()
+        cells = ws.batch_update.call_args[0][0]
+        assert sorted(c["range"] for c in cells) == ["B2", "B4"]
+        assert not ws.clear.called
+
+
+# =====================================================================
+# Streamlit session store tests
+# =====================================================================
+
+class TestSessionStore:
+    @pytest.fixture
+    def store(self, tmp_path):
+        from session_store import SessionStore
+        return SessionStore(tmp_path / "sessions.db")
+
+    def test_create_validate_delete(self, store):
+        token = store.create("Anna")
+        assert store.validate(token) == "Anna"
+        assert store.validate("okänd") is None
+        store.delete(token)
+        assert store.validate(token) is None
+
+    def test_expired_token_rejected_and_swept(self, store):
+        old = store.create("Anna", ttl=-1)
+        live = store.create("Bo")
+        assert store.validate(old) is None
+        assert store.sweep() == 1
+        assert store.validate(live) == "Bo"
+
+    def test_shared_between_store_instances(self, store):
+        from session_store import SessionStore
+        token = store.create("Anna")
+        assert SessionStore(store.path).validate(token) == "Anna"
+
+    def test_sheet_sessions_imported_once(self, store):
+        import time
+        mock_db.save_data("sessions", [
+            {"token": "t1", "username": "Anna", "expires": time.time() + 60},
+            {"token": "t2", "username": "Bo", "expires": time.time() - 60},
+        ])
+        assert store.import_sheet(mock_db) == 1
+        assert store.validate("t1") == "Anna"
+        assert store.validate("t2") is None
+        with patch.object(mock_db, "load_data") as load:
+            assert store.import_sheet(mock_db) == 0
+        assert not load.called
+
+    def test_sweeper_thread_started_once(self, store):
+        import time
+        import threading
+        stop = threading.Event()
+        first = store.start_sweeper(interval=0.01, stop=stop)
+        assert store.start_sweeper(interval=0.01, stop=stop) is first
+        store.create("Anna", ttl=-1)
+        deadline = time.time() + 2
+        while store._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0] and time.time() < deadline:
+            time.sleep(0.01)
+        stop.set()
+        first.join(timeout=1)
+        assert store._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0
+
+
+# =====================================================================
+# Socket.IO cross-worker queue tests
+# =====================================================================
+
+class TestSocketIOQueue:
+    @pytest.fixture
+    def managers(self, tmp_path):
+        from socketio_queue import SQLiteManager
+        path = tmp_path / "queue.db"
+        return SQLiteManager(path), SQLiteManager(path)
+
+    def test_emit_reaches_other_worker(self, managers):
+        import socketio
+        sender, receiver = managers
+        socketio.Server(client_manager=sender, async_mode="threading")
+        sender.emit("new_message", {"text": "hej"}, room="chat_1")
+        payload = json.loads(receiver._poll(0)[-1][1])
+        assert payload["event"] == "new_message"
+        assert payload["room"] == "chat_1"
+        assert payload["host_id"] != receiver.host_id
+
+    def test_listen_yields_only_new_messages(self, managers):
+        sender, receiver = managers
+        sender._publish({"method": "emit", "n": 1})
+        listener = receiver._listen()
+        with patch.object(receiver, "_sleep", side_effect=lambda s: sender._publish({"method": "emit", "n": 2})):
+            assert json.loads(next(listener))["n"] == 2
+
+    def test_forked_worker_gets_own_host_id(self, managers):
+        manager, _ = managers
+        master_id = manager.host_id
+        with patch("socketio_queue.os.getpid", return_value=-1):
+            assert manager.host_id != master_id
+
+    def test_queue_options(self, tmp_path):
+        from socketio_queue import queue_options, SQLiteManager
+        assert queue_options("") == {}
+        assert queue_options("redis://localhost:6379/0") == {"message_queue": "redis://localhost:6379/0"}
+        manager = queue_options(f"sqlite:///{tmp_path}/q.db")["client_manager"]
+        assert isinstance(manager, SQLiteManager)
+        assert manager.path == tmp_path / "q.db"
+
+
+# =====================================================================
+# Chat presence and typing throttling tests
+# =====================================================================
+
+class TestChatPresence:
+    @pytest.fixture(autouse=True)
+    def tracker(self, tmp_path, monkeypatch):
+        from presence import presence, PresenceTracker
+        fresh = PresenceTracker(tmp_path / "presence.db")
+        for attr in ("path", "_conn", "_pid", "_diffs", "_typing"):
+            monkeypatch.setattr(presence, attr, getattr(fresh, attr))
+        monkeypatch.setattr(presence, "start_emitter", lambda *args, **kwargs: None)
+        return presence
+
+    def _socket(self, flask_client):
+        from app import socketio
+        return socketio.test_client(app, flask_test_client=flask_client)
+
+    def test_typing_broadcast_coalesced(self, logged_in_admin):
+        sender, listener = self._socket(logged_in_admin), self._socket(logged_in_admin)
+        sender.emit("join_chat", {"group_id": "g1"})
+        listener.emit("join_chat", {"group_id": "g1"})
+        listener.get_received()
+        for _ in range(20):
+            sender.emit("typing", {"group_id": "g1"})
+        typing = [m for m in listener.get_received() if m["name"] == "user_typing"]
+        assert len(typing) == 1
+
+    def test_presence_endpoint_follows_connections(self, logged_in_admin):
+        sock = self._socket(logged_in_admin)
+        sock.emit("join_chat", {"group_id": "g2"})
+        res = logged_in_admin.get("/api/chat/groups/g2/presence").get_json()
+        assert res["members"] == ["TestAdmin"]
+        sock.disconnect()
+        assert logged_in_admin.get("/api/chat/groups/g2/presence").get_json()["members"] == []
+
+    def test_diffs_are_batched_and_cancel_out(self, tracker):
+        tracker.join("g3", "Anna", "s1")
+        tracker.join("g3", "Anna", "s2")  # second tab: no change
+        tracker.join("g3", "Bo", "s3")
+        tracker.leave("g3", "s3")  # Bo came and went within the window
+        tracker.join("g4", "Bo", "s4")
+        diffs = {d["group_id"]: d for d in tracker.take_diffs()}
+        assert diffs["g3"] == {"group_id": "g3", "joined": ["Anna"], "left": []}
+        assert diffs["g4"]["joined"] == ["Bo"]
+        assert tracker.take_diffs() == []
+        tracker.disconnect("s1")
+        assert tracker.take_diffs() == []  # Anna still has s2
+        tracker.disconnect("s2")
+        assert tracker.take_diffs() == [{"group_id": "g3", "joined": [], "left": ["Anna"]}]
+
+    def test_rows_of_dead_workers_dropped(self, tracker):
+        from presence import PresenceTracker
+        tracker.join("g5", "Anna", "s1")
+        conn = tracker._connect()
+        conn.execute("UPDATE presence SET pid = ?", (2 ** 22 + 12345,))
+        conn.commit()
+        assert PresenceTracker(tracker.path).members("g5") == []
+
+    def test_emitter_survives_errors(self, tmp_path, monkeypatch):
+        import sqlite3
+        import threading
+        from presence import PresenceTracker
+        tracker = PresenceTracker(tmp_path / "emitter.db")
+        tracker.join("g6", "Anna", "s1")
+        calls = {"n": 0}
+        real_take = tracker.take_diffs
+
+        def flaky_take():
+            calls["n"] += 1
+            if calls["n"] == 1:
+                raise sqlite3.OperationalError("database is locked")
+            return real_take()
+
+        monkeypatch.setattr(tracker, "take_diffs", flaky_take)
+
+        class Stop(BaseException):
+            pass
+
+        class FakeSocketIO:
+            emitted = []
+            sleeps = 0
+
+            def sleep(self, seconds):
+                self.sleeps += 1
+                if self.sleeps > 2:
+                    raise Stop()
+
+            def emit(self, event, data, room=None):
+                self.emitted.append((event, data, room))
+
+            def start_background_task(self, target):
+                def guarded():
+                    try:
+                        target()
+                    except Stop:
+                        pass
+                thread = threading.Thread(target=guarded, daemon=True)
+                thread.start()
+                return thread
+
+        sio = FakeSocketIO()
+        tracker.start_emitter(sio)
+        tracker._emitter[1].join(5)
+        assert calls["n"] == 2  # the loop kept going after the error
+        assert sio.emitted[0][0] == "presence" and sio.emitted[0][2] == "chat_g6"
+
+
+# =====================================================================
+# Chat unread counter tests
+# =====================================================================
+
+class TestChatUnread:
+    @pytest.fixture
+    def two_users(self, client):
+        mock_db.save_data("users", [
+            {"username": "TestAdmin", "password_hash": _hash_password("SecurePass123"), "role": "admin"},
+            {"username": "TestUser", "password_hash": _hash_password("UserPass456"), "role": "user"},
+        ])
+        client.post("/api/login", json={"username": "TestAdmin", "password": "SecurePass123"})
+        gid = client.post("/api/chat/groups", json={
+            "name": "Team", "members": ["TestAdmin", "TestUser"]}).get_json()["group"]["id"]
+        return client, gid
+
+    def _login_user(self, client):
+        client.post("/api/logout")
+        client.post("/api/login", json={"username": "TestUser", "password": "UserPass456"})
+
+    def test_groups_list_unread_and_preview(self, two_users):
+        client, gid = two_users
+        for text in ("ett", "två"):
+            client.post(f"/api/chat/groups/{gid}/messages", json={"content": text})
+        own = client.get("/api/chat/groups").get_json()[0]
+        assert own["unread"] == 0  # the sender has read their own messages
+        self._login_user(client)
+        group = client.get("/api/chat/groups").get_json()[0]
+        assert group["unread"] == 2
+        assert group["last_message"]["content"] == "två"
+        assert group["last_message"]["sender"] == "TestAdmin"
+
+    def test_mark_read_clears_count(self, two_users):
+        client, gid = two_users
+        client.post(f"/api/chat/groups/{gid}/messages", json={"content": "hej"})
+        self._login_user(client)
+        assert client.post(f"/api/chat/groups/{gid}/read").get_json()["ok"] is True
+        assert client.get("/api/chat/groups").get_json()[0]["unread"] == 0
+
+    def test_groups_list_does_not_read_messages(self, two_users):
+        client, gid = two_users
+        client.get("/api/chat/groups")  # seeds the summary
+        client.post(f"/api/chat/groups/{gid}/messages", json={"content": "hej"})
+        with patch.object(mock_db, "load_data", wraps=mock_db.load_data) as load:
+            client.get("/api/chat/groups")
+        assert [c.args[0] for c in load.call_args_list] == ["chat_groups"]
+
+    def test_unread_pushed_to_member_sockets(self, two_users):
+        import app as app_module
+        client, gid = two_users
+        with patch.object(app_module.socketio, "emit") as emit:
+            client.post(f"/api/chat/groups/{gid}/messages", json={"content": "ping"})
+        pushes = [c for c in emit.call_args_list if c.args[0] == "unread"]
+        assert [c.kwargs["room"] for c in pushes] == ["user_TestUser"]
+        assert pushes[0].args[1]["unread"] == 1
+        assert pushes[0].args[1]["last_message"]["content"] == "ping"
+
+
+class TestSearch:
+    def test_fold_and_tokenize(self):
+        from search_index import fold, tokenize
+        assert fold("Åsa Öberg") == "asa oberg"
+        assert tokenize("Försäljning AB, anna@foretag.se") == ["forsaljning", "ab", "anna", "foretag", "se"]
+
+    def test_prefix_and_swedish_folding(self, logged_in_admin):
+        logged_in_admin.post("/api/customers", json={"name": "Åsa Öberg", "company": "Försäljning AB"})
+        logged_in_admin.post("/api/expenses", json={"bolag": "Unithread", "belopp": 99,
+                                                    "beskrivning": "Kontorsmaterial"})
+        hits = logged_in_admin.get("/api/search?q=forsalj").get_json()["hits"]
+        assert [(h["kind"], h["title"]) for h in hits] == [("customers", "Åsa Öberg")]
+        assert logged_in_admin.get("/api/search?q=oberg as").get_json()["hits"][0]["title"] == "Åsa Öberg"
+        assert logged_in_admin.get("/api/search?q=kontor").get_json()["hits"][0]["kind"] == "expenses"
+        assert logged_in_admin.get("/api/search?q=oberg kontor").get_json()["hits"] == []
+
+    def test_ranking_and_kinds_filter(self, logged_in_admin):
+        cid = logged_in_admin.post("/api/customers", json={"name": "Svensson Bygg"}).get_json()["customer"]["id"]
+        logged_in_admin.post(f"/api/customers/{cid}/notes", json={"text": "Ring Svenssons kontor"})
+        hits = logged_in_admin.get("/api/search?q=svensson").get_json()["hits"]
+        assert [h["kind"] for h in hits] == ["customers", "customer_notes"]
+        assert hits[1]["ref"] == cid
+        hits = logged_in_admin.get("/api/search?q=svensson&kinds=customer_notes").get_json()["hits"]
+        assert [h["kind"] for h in hits] == ["customer_notes"]
+        assert logged_in_admin.get("/api/search?q=x&kinds=nope").status_code == 400
+
+    def test_index_follows_writes(self, logged_in_admin):
+        cid = logged_in_admin.post("/api/customers", json={"name": "Gammalt Namn"}).get_json()["customer"]["id"]
+        logged_in_admin.put(f"/api/customers/{cid}", json={"name": "Nytt Namn"})
+        assert logged_in_admin.get("/api/search?q=gammalt").get_json()["hits"] == []
+        assert len(logged_in_admin.get("/api/search?q=nytt").get_json()["hits"]) == 1
+        assert [c["id"] for c in logged_in_admin.get("/api/customers?q=nyt").get_json()] == [cid]
+        logged_in_admin.delete(f"/api/customers/{cid}")
+        assert logged_in_admin.get("/api/search?q=nytt").get_json()["hits"] == []
+
+    def test_built_from_existing_sheets(self, logged_in_admin):
+        mock_db.save_data("quotes", [{"id": "Q-1", "title": "Webbshop", "customer_name": "Ölbryggarna",
+                                      "items": json.dumps([{"description": "Kassasystem"}])}])
+        from ingestion import ingest_sync_result
+        ingest_sync_result(mock_db, {"expenses": [{"datum": "2025-03-10", "belopp": 10,
+                                                   "beskrivning": "Annonsering", "source_id": "x"}]},
+                           "meta_ads", "Unithread")
+        assert logged_in_admin.get("/api/search?q=olbryggarna").get_json()["hits"][0]["id"] == "Q-1"
+        assert logged_in_admin.get("/api/search?q=kassa").get_json()["hits"][0]["id"] == "Q-1"
+        assert logged_in_admin.get("/api/search?q=annons").get_json()["hits"][0]["kind"] == "expenses"
+
+    def test_chat_hits_only_from_own_groups(self, client):
+        mock_db.save_data("users", [
+            {"username": "TestAdmin", "password_hash": _hash_password("SecurePass123"), "role": "admin"},
+            {"username": "TestUser", "password_hash": _hash_password("UserPass456"), "role": "user"},
+        ])
+        client.post("/api/login", json={"username": "TestAdmin", "password": "SecurePass123"})
+        team = client.post("/api/chat/groups", json={"name": "Team", "members": ["TestAdmin", "TestUser"]})
+        board = client.post("/api/chat/groups", json={"name": "Styrelse", "members": ["TestAdmin"]})
+        for group, text in ((team, "möte på fredag"), (board, "hemligt möte")):
+            client.post(f"/api/chat/groups/{group.get_json()['group']['id']}/messages", json={"content": text})
+        assert len(client.get("/api/search?q=mote").get_json()["hits"]) == 2
+        client.post("/api/logout")
+        client.post("/api/login", json={"username": "TestUser", "password": "UserPass456"})
+        hits = client.get("/api/search?q=mote").get_json()["hits"]
+        assert [h["snippet"].split(" · ")[0] for h in hits] == ["möte på fredag"]
+
+
+class TestBlobStore:
+    def _upload(self, client, pid, content, name):
+        res = client.post(f"/api/projects/{pid}/files", data={"files": (io.BytesIO(content), name)},
+                          content_type="multipart/form-data")
+        return res.get_json()["files"][0]
+
+    def test_same_receipt_stored_once(self, logged_in_admin, tmp_path, monkeypatch):
+        import hashlib
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path / "receipts")
+        names = []
+        for _ in range(2):
+            res = logged_in_admin.post("/api/receipts", data={
+                "bolag": "Unithread", "belopp": "100",
+                "files": (io.BytesIO(b"%PDF-1.4 kvitto"), "Kvitto.PDF"),
+            }, content_type="multipart/form-data")
+            names.append(json.loads(res.get_json()["receipt"]["files"])[0])
+        assert names[0] == names[1] == hashlib.sha256(b"%PDF-1.4 kvitto").hexdigest() + ".pdf"
+        assert [p.name for p in (tmp_path / "receipts").iterdir()] == [names[0]]
+        assert logged_in_admin.get(f"/uploads/{names[0]}").data == b"%PDF-1.4 kvitto"
+
+    def test_deleted_with_last_reference(self, logged_in_admin, tmp_path, monkeypatch):
+        from blob_store import blob_store
+        monkeypatch.setitem(app.config, "PROJECT_UPLOAD_FOLDER", tmp_path)
+        pid = logged_in_admin.post("/api/projects", json={"name": "P"}).get_json()["project"]["id"]
+        first = self._upload(logged_in_admin, pid, b"ritning", "a.dwg")
+        second = self._upload(logged_in_admin, pid, b"ritning", "b.dwg")
+        assert first["filename"] == second["filename"]
+        assert first["original_name"] == "a.dwg" and second["original_name"] == "b.dwg"
+        assert blob_store.refs("projects", first["filename"]) == 2
+        logged_in_admin.delete(f"/api/projects/{pid}/files/{first['id']}")
+        assert (tmp_path / first["filename"]).exists()
+        logged_in_admin.delete(f"/api/projects/{pid}/files/{second['id']}")
+        assert not (tmp_path / first["filename"]).exists()
+        assert blob_store.refs("projects", first["filename"]) == 0
+
+    def test_project_delete_releases_files(self, logged_in_admin, tmp_path, monkeypatch):
+        monkeypatch.setitem(app.config, "PROJECT_UPLOAD_FOLDER", tmp_path)
+        pid = logged_in_admin.post("/api/projects", json={"name": "P"}).get_json()["project"]["id"]
+        other = logged_in_admin.post("/api/projects", json={"name": "Q"}).get_json()["project"]["id"]
+        shared = self._upload(logged_in_admin, pid, b"delad", "x.txt")["filename"]
+        self._upload(logged_in_admin, other, b"delad", "x.txt")
+        only = self._upload(logged_in_admin, pid, b"egen", "y.txt")["filename"]
+        logged_in_admin.delete(f"/api/projects/{pid}")
+        assert (tmp_path / shared).exists()
+        assert not (tmp_path / only).exists()
+        assert not [p for p in tmp_path.iterdir() if p.name.startswith(".upload-")]
+
+    def test_legacy_file_deleted_on_release(self, tmp_path):
+        from blob_store import blob_store
+        (tmp_path / "1a2b3c4d_gammal.pdf").write_bytes(b"x")
+        assert blob_store.release("projects", tmp_path, "1a2b3c4d_gammal.pdf") is True
+        assert not (tmp_path / "1a2b3c4d_gammal.pdf").exists()
+
+
+class TestChunkedUpload:
+    DATA = bytes(range(256)) * 40  # 10 240 bytes
+
+    def _start(self, client, target="projects", size=None, name="ritning.pdf"):
+        res = client.post("/api/uploads", json={"filename": name, "size": size or len(self.DATA),
+                                                "target": target})
+        return res.get_json()["upload"]["id"]
+
+    def _put(self, client, uid, offset, data):
+        return client.put(f"/api/uploads/{uid}?offset={offset}", data=data,
+                          content_type="application/octet-stream")
+
+    def test_chunks_complete_and_attach(self, logged_in_admin, tmp_path, monkeypatch):
+        import hashlib
+        monkeypatch.setitem(app.config, "PROJECT_UPLOAD_FOLDER", tmp_path / "projects")
+        pid = logged_in_admin.post("/api/projects", json={"name": "P"}).get_json()["project"]["id"]
+        uid = self._start(logged_in_admin)
+        for offset in range(0, len(self.DATA), 4096):
+            res = self._put(logged_in_admin, uid, offset, self.DATA[offset:offset + 4096])
+            assert res.get_json()["offset"] == min(offset + 4096, len(self.DATA))
+        digest = hashlib.sha256(self.DATA).hexdigest()
+        done = logged_in_admin.post(f"/api/uploads/{uid}/complete", json={"sha256": digest}).get_json()
+        assert done["upload"]["name"] == f"{digest}.pdf"
+        res = logged_in_admin.post(f"/api/projects/{pid}/files", data={"uploads": uid},
+                                   content_type="multipart/form-data").get_json()
+        assert res["files"][0]["original_name"] == "ritning.pdf"
+        assert (tmp_path / "projects" / f"{digest}.pdf").read_bytes() == self.DATA
+        assert logged_in_admin.get(f"/api/uploads/{uid}").status_code == 404  # claimed
+
+    def test_resume_after_interruption(self, logged_in_admin, tmp_path, monkeypatch):
+        import hashlib
+        from chunked_upload import upload_sessions
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path / "receipts")
+        uid = self._start(logged_in_admin, target="receipts")
+        self._put(logged_in_admin, uid, 0, self.DATA[:5000])
+        res = self._put(logged_in_admin, uid, 8000, self.DATA[8000:])
+        assert res.status_code == 409 and res.get_json()["offset"] == 5000
+        upload_sessions._hashers.clear()  # e.g. the next chunk reaches another worker
+        assert logged_in_admin.get(f"/api/uploads/{uid}").get_json()["upload"]["offset"] == 5000
+        self._put(logged_in_admin, uid, 5000, self.DATA[5000:])
+        name = logged_in_admin.post(f"/api/uploads/{uid}/complete").get_json()["upload"]["name"]
+        assert name.startswith(hashlib.sha256(self.DATA).hexdigest())
+        receipt = logged_in_admin.post("/api/receipts", data={"bolag": "Unithread", "belopp": "5",
+                                                              "uploads": uid},
+                                       content_type="multipart/form-data").get_json()["receipt"]
+        assert json.loads(receipt["files"]) == [name]
+
+    def test_rejects_bad_checksum_and_oversize(self, logged_in_admin):
+        uid = self._start(logged_in_admin, size=10)
+        assert self._put(logged_in_admin, uid, 0, b"x" * 11).status_code == 400
+        self._put(logged_in_admin, uid, 0, b"x" * 10)
+        res = logged_in_admin.post(f"/api/uploads/{uid}/complete", json={"sha256": "0" * 64})
+        assert res.status_code == 400
+        assert logged_in_admin.get(f"/api/uploads/{uid}").get_json()["upload"]["offset"] == 0
+        assert logged_in_admin.post("/api/uploads", json={"filename": "a", "size": 10 ** 13}).status_code == 400
+
+    def test_other_users_upload_is_private(self, client, logged_in_admin):
+        uid = self._start(logged_in_admin)
+        logged_in_admin.post("/api/logout")
+        mock_db.save_data("users", [{"username": "TestUser", "role": "user",
+                                     "password_hash": _hash_password("UserPass456")}])
+        client.post("/api/login", json={"username": "TestUser", "password": "UserPass456"})
+        assert self._put(client, uid, 0, b"x").status_code == 403
+
+    def test_sweep_drops_stale_uploads(self, tmp_path):
+        from chunked_upload import upload_sessions
+        from blob_store import blob_store
+        upload = upload_sessions.create("u", "projects", tmp_path / "projects", "a.txt", 3)
+        upload_sessions.write_chunk(upload["id"], "u", 0, io.BytesIO(b"abc"))
+        name = upload_sessions.complete(upload["id"], "u")["name"]
+        assert (tmp_path / "projects" / name).exists()
+        assert upload_sessions.sweep(ttl=-1) == 1
+        assert not (tmp_path / "projects" / name).exists()
+        assert blob_store.refs("projects", name) == 0
+
+
+class TestThumbnails:
+    def _png(self, size=(800, 600)):
+        Image = pytest.importorskip("PIL.Image")
+        buf = io.BytesIO()
+        Image.new("RGB", size, (200, 30, 30)).save(buf, "PNG")
+        return buf.getvalue()
+
+    def test_receipt_thumbnail_snapped_and_cached(self, logged_in_admin, tmp_path, monkeypatch):
+        from PIL import Image
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path)
+        res = logged_in_admin.post("/api/receipts", data={
+            "bolag": "Unithread", "belopp": "1", "files": (io.BytesIO(self._png()), "kvitto.png"),
+        }, content_type="multipart/form-data")
+        name = json.loads(res.get_json()["receipt"]["files"])[0]
+        res = logged_in_admin.get(f"/uploads/{name}/thumb?w=300")
+        assert res.status_code == 200 and res.mimetype == "image/jpeg"
+        assert "immutable" in res.headers["Cache-Control"]
+        assert Image.open(io.BytesIO(res.data)).size == (320, 240)
+        assert (tmp_path / "thumbs" / f"{name}-320.jpg").exists()
+        assert logged_in_admin.get(f"/uploads/{name}").data == self._png()  # original still served
+
+    def test_unsupported_file_has_no_thumbnail(self, logged_in_admin, tmp_path, monkeypatch):
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path)
+        (tmp_path / "notes.txt").write_text("hej")
+        assert logged_in_admin.get("/uploads/notes.txt/thumb").status_code == 404
+        assert logged_in_admin.get("/uploads/saknas.png/thumb").status_code == 404
+        assert logged_in_admin.get("/uploads/x.png/thumb?w=abc").status_code == 400
+
+    def test_project_file_thumbnails_deleted_with_file(self, logged_in_admin, tmp_path, monkeypatch):
+        monkeypatch.setitem(app.config, "PROJECT_UPLOAD_FOLDER", tmp_path)
+        pid = logged_in_admin.post("/api/projects", json={"name": "P"}).get_json()["project"]["id"]
+        f = logged_in_admin.post(f"/api/projects/{pid}/files", data={"files": (io.BytesIO(self._png()), "a.png")},
+                                 content_type="multipart/form-data").get_json()["files"][0]
+        assert logged_in_admin.get(f"/api/projects/files/{f['filename']}/thumb?w=160").status_code == 200
+        assert logged_in_admin.get(f"/api/projects/files/{f['filename']}/thumb").status_code == 200
+        assert len(list((tmp_path / "thumbs").iterdir())) == 2
+        logged_in_admin.delete(f"/api/projects/{pid}/files/{f['id']}")
+        assert list((tmp_path / "thumbs").iterdir()) == []
+
+
+class TestUploadServing:
+    PDF = b"%PDF-1.4 " + b"x" * 1000
+
+    def _receipt(self, client):
+        res = client.post("/api/receipts", data={"bolag": "Unithread", "belopp": "1",
+                                                 "files": (io.BytesIO(self.PDF), "faktura.pdf")},
+                          content_type="multipart/form-data")
+        return json.loads(res.get_json()["receipt"]["files"])[0]
+
+    def test_content_addressed_etag_304_and_range(self, logged_in_admin, tmp_path, monkeypatch):
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path / "receipts")
+        name = self._receipt(logged_in_admin)
+        res = logged_in_admin.get(f"/uploads/{name}")
+        assert res.headers["ETag"] == f'"{name}"'
+        assert res.headers["Cache-Control"] == "private, max-age=31536000, immutable"
+        assert res.headers["Accept-Ranges"] == "bytes"
+        res = logged_in_admin.get(f"/uploads/{name}", headers={"If-None-Match": f'"{name}"'})
+        assert res.status_code == 304 and res.data == b""
+        res = logged_in_admin.get(f"/uploads/{name}", headers={"Range": "bytes=0-7"})
+        assert res.status_code == 206 and res.data == b"%PDF-1.4"
+        assert res.headers["Content-Range"] == f"bytes 0-7/{len(self.PDF)}"
+
+    def test_legacy_upload_is_revalidated(self, logged_in_admin, tmp_path, monkeypatch):
+        monkeypatch.setitem(app.config, "PROJECT_UPLOAD_FOLDER", tmp_path)
+        (tmp_path / "1a2b3c4d_plan.pdf").write_bytes(self.PDF)
+        res = logged_in_admin.get("/api/projects/files/1a2b3c4d_plan.pdf")
+        assert res.headers["Cache-Control"] == "private, no-cache"
+        etag = res.headers["ETag"]
+        res = logged_in_admin.get("/api/projects/files/1a2b3c4d_plan.pdf", headers={"If-None-Match": etag})
+        assert res.status_code == 304
+        assert logged_in_admin.get("/uploads/..%2Fapp.py").status_code == 404
+
+    def test_offload_headers(self, logged_in_admin, tmp_path, monkeypatch):
+        import file_serving
+        monkeypatch.setitem(app.config, "UPLOAD_FOLDER", tmp_path / "receipts")
+        name = self._receipt(logged_in_admin)
+        monkeypatch.setattr(file_serving, "UPLOAD_OFFLOAD", "x-accel-redirect")
+        res = logged_in_admin.get(f"/uploads/{name}")
+        assert res.headers["X-Accel-Redirect"] == f"/_uploads/receipts/{name}"
+        assert res.data == b"" and res.mimetype == "application/pdf"
+        assert logged_in_admin.get(f"/uploads/{name}", headers={"If-None-Match": f'"{name}"'}).status_code == 304
+        monkeypatch.setattr(file_serving, "UPLOAD_OFFLOAD", "x-sendfile")
+        res = logged_in_admin.get(f"/uploads/{name}")
+        assert res.headers["X-Sendfile"] == str(tmp_path / "receipts" / name)
+
+
+class TestDriveQueue:
+    def _queue(self, tmp_path, uploader, workers=2):
+        from drive_queue import DriveUploadQueue
+        return DriveUploadQueue(path=tmp_path / "drive.db", workers=workers, uploader=uploader)
+
+    def _file(self, tmp_path, name="kvitto.pdf"):
+        path = tmp_path / name
+        path.write_bytes(b"%PDF-1.4")
+        return path
+
+    def _due(self, queue):
+        conn = queue._connect()
+        conn.execute("UPDATE uploads SET next_attempt = 0")
+        conn.commit()
+
+    def test_uploads_and_writes_link_back(self, tmp_path):
+        uploaded, linked = [], []
+        queue = self._queue(tmp_path, lambda path, name: uploaded.append(name) or f"https://drive/{name}")
+        queue.register("kvitton", lambda ref, name, link: linked.append((ref, link)) or True)
+        upload_id = queue.enqueue("kvitton", "k1", self._file(tmp_path))
+        assert queue.status("kvitton", "k1") == "pending"
+        assert queue.run_once() == 1
+        assert uploaded == ["kvitto.pdf"]
+        assert linked == [("k1", "https://drive/kvitto.pdf")]
+        assert queue.status("kvitton", "k1") == "done"
+        assert queue.links("kvitton", ["k1", "k9"]) == {"k1": "https://drive/kvitto.pdf"}
+        assert queue.run_once() == 0  # done rows are not processed again
+
+    def test_write_back_waits_for_the_row(self, tmp_path):
+        import time
+        uploads = []
+        queue = self._queue(tmp_path, lambda path, name: uploads.append(name) or "https://drive/x")
+        queue.register("kvitton", lambda ref, name, link: False)  # row not saved yet
+        upload_id = queue.enqueue("kvitton", "k1", self._file(tmp_path))
+        queue.run_once()
+        row = queue.get(upload_id)
+        assert row["status"] == "uploaded" and row["link"] == "https://drive/x"
+        assert row["next_attempt"] > time.time()
+        assert queue.run_once() == 0  # not due yet
+        queue.register("kvitton", lambda ref, name, link: True)
+        self._due(queue)
+        assert queue.links("kvitton", ["k1"]) == {"k1": "https://drive/x"}  # available before write-back
+        queue.run_once()
+        assert queue.get(upload_id)["status"] == "done"
+        assert len(uploads) == 1  # the retry only writes the link back
+
+    def test_retries_with_backoff_and_gives_up(self, tmp_path, monkeypatch):
+        import time
+        import drive_queue
+        calls = []
+
+        def flaky(path, name):
+            calls.append(name)
+            raise ConnectionError("Connection aborted")
+
+        queue = self._queue(tmp_path, flaky)
+        queue.register("kvitton", lambda *a: True)
+        upload_id = queue.enqueue("kvitton", "k1", self._file(tmp_path))
+        queue.run_once()
+        row = queue.get(upload_id)
+        assert row["status"] == "pending" and row["attempts"] == 1
+        assert row["next_attempt"] - time.time() > drive_queue.RETRY_BASE - 5
+        monkeypatch.setattr(drive_queue, "MAX_ATTEMPTS", 3)
+        for _ in range(2):
+            self._due(queue)
+            queue.run_once()
+        row = queue.get(upload_id)
+        assert row["status"] == "failed" and "Connection aborted" in row["error"]
+        assert len(calls) == 3
+
+        def no_quota(path, name):
+            raise RuntimeError("Service Accounts do not have storage quota")
+
+        queue.uploader = no_quota
+        quota_id = queue.enqueue("kvitton", "k2", self._file(tmp_path, "b.pdf"))
+        queue.run_once()
+        assert queue.get(quota_id)["status"] == "failed"  # not retried
+
+    def test_bounded_concurrency_and_targets(self, tmp_path):
+        import time
+        import threading
+        lock = threading.Lock()
+        active, peak = [0], [0]
+
+        def slow(path, name):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return f"https://drive/{name}"
+
+        queue = self._queue(tmp_path, slow, workers=2)
+        queue.register("kvitton", lambda *a: True)
+        for i in range(5):
+            queue.enqueue("kvitton", f"k{i}", self._file(tmp_path, f"{i}.pdf"))
+        other = queue.enqueue("main", "m1", self._file(tmp_path, "m.pdf"))
+        while queue.run_once():
+            pass
+        assert peak[0] == 2
+        assert queue.get(other)["status"] == "pending"  # no handler in this process
+
+
+# =====================================================================
+# Incremental sync checkpoint tests
+# =====================================================================
+
+class TestIntegrationCheckpoints:
+    def test_since_from_checkpoint_rereads_late_window(self):
+        from integrations import TikTokAdsAdapter
+        adapter = TikTokAdsAdapter({"access_token": "x", "advertiser_id": "1"})
+        assert adapter.late_data_days == 3
+        since = adapter.since_from_checkpoint({"last_complete_day": "2025-03-10"})
+        assert since == "2025-03-08"
+
+    def test_late_data_days_configurable(self):
+        from integrations import MetaAdsAdapter
+        adapter = MetaAdsAdapter({"access_token": "x", "ad_account_id": "1", "late_data_days": "0"})
+        assert adapter.late_data_days == 0
+        assert adapter.since_from_checkpoint({"last_complete_day": "2025-03-10"}) == "2025-03-11"
+
+    def test_no_checkpoint_means_default_window(self):
+        from integrations import GelatoAdapter
+        adapter = GelatoAdapter({"api_key": "x"})
+        assert adapter.since_from_checkpoint({}) is None
+
+    def test_gelato_reads_only_its_window(self):
+        from integrations import GelatoAdapter
+        adapter = GelatoAdapter({"api_key": "x"})
+        adapter.PAGE_SIZE = 2
+        pages = [
+            [{"id": "o4", "createdAt": "2025-03-12T09:00:00+0000"},
+             {"id": "o3", "createdAt": "2025-03-10T09:00:00+0000"}],
+            [{"id": "o2", "createdAt": "2025-03-09T09:00:00+0000"},
+             {"id": "o1", "createdAt": "2025-02-28T09:00:00+0000"}],
+            [{"id": "o0", "createdAt": "2025-02-01T09:00:00+0000"},
+             {"id": "o-", "createdAt": "2025-01-01T09:00:00+0000"}],
+        ]
+        for page in pages:
+            for order in page:
+                order["financialSummary"] = {"productionCost": {"amount": "10"}}
+        calls = []
+
+        def fake_request(method, url, **kwargs):
+            calls.append(kwargs["params"])
+            return MagicMock(json=MagicMock(return_value={"orders": pages[len(calls) - 1]}))
+
+        with patch.object(adapter, "_request", side_effect=fake_request):
+            records = list(adapter.iter_records("2025-03-01", "2025-03-10"))
+        assert [r["source_id"] for _, r in records] == ["o3", "o2"]
+        assert len(calls) == 2  # stopped at the first order before the window
+        assert calls[0]["startDate"] == "2025-03-01T00:00:00Z"
+        assert calls[0]["endDate"] == "2025-03-10T23:59:59Z"
+
+    def test_checkpoint_not_advanced_on_errors(self):
+        from integrations import MetaAdsAdapter
+        adapter = MetaAdsAdapter({"access_token": "x", "ad_account_id": "1"})
+        adapter.synced_through = "2025-03-10"
+        adapter.errors.append("boom")
+        assert adapter.next_checkpoint({"last_complete_day": "2025-03-01"}) == {"last_complete_day": "2025-03-01"}
+
+    def test_shopify_checkpoint_tracks_high_water_marks(self):
+        from integrations import ShopifyAdapter
+        adapter = ShopifyAdapter({"shop_domain": "test", "access_token": "x"})
+        adapter.synced_through = "2025-03-10"
+        adapter.last_updated_at = "2025-03-11T08:00:00+01:00"
+        adapter.last_order_id = 42
+        cp = adapter.next_checkpoint({"last_order_id": 40})
+        assert cp == {"last_complete_day": "2025-03-10",
+                      "updated_at": "2025-03-11T08:00:00+01:00", "last_order_id": 42}
+
+    def test_sync_stores_checkpoint(self, logged_in_admin):
+        logged_in_admin.post("/api/integrations", json={
+            "platform": "meta_ads", "bolag": "Unithread",
+            "access_token": "x", "ad_account_id": "1",
+        })
+        int_id = mock_db.load_data("integrations")[0]["id"]
+        adapter = MagicMock(errors=[])
+        adapter.iter_incremental.return_value = iter([])
+        adapter.next_checkpoint.return_value = {"last_complete_day": "2025-03-10"}
+        with patch("app.create_adapter", return_value=adapter):
+            res = logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={})
+        assert res.get_json()["ok"] is True
+        adapter.iter_incremental.assert_called_once_with({})
+        stored = mock_db.load_data("integrations")[0]
+        assert json.loads(stored["checkpoint"]) == {"last_complete_day": "2025-03-10"}
+
+
+    def _sync_from(self, client, since_date, checkpoint):
+        from integrations import MetaAdsAdapter
+        client.post("/api/integrations", json={
+            "platform": "meta_ads", "bolag": "Unithread",
+            "access_token": "x", "ad_account_id": "1",
+        })
+        rows = mock_db.load_data("integrations")
+        rows[0]["checkpoint"] = json.dumps(checkpoint)
+        mock_db.save_data("integrations", rows)
+        adapter = MetaAdsAdapter({"access_token": "x", "ad_account_id": "1"})
+        adapter.synced_through = "2025-03-20"
+        with patch("app.create_adapter", return_value=adapter), \
+                patch.object(adapter, "iter_records", return_value=iter([])):
+            client.post(f"/api/integrations/{rows[0]['id']}/sync", json={"since_date": since_date})
+        return json.loads(mock_db.load_data("integrations")[0]["checkpoint"])
+
+    def test_range_after_checkpoint_leaves_it_alone(self, logged_in_admin):
+        # 2025-03-02 .. 2025-03-14 were never fetched: incremental syncs must still read them
+        cp = self._sync_from(logged_in_admin, "2025-03-15", {"last_complete_day": "2025-03-01"})
+        assert cp == {"last_complete_day": "2025-03-01"}
+
+    def test_range_covering_checkpoint_advances_it(self, logged_in_admin):
+        cp = self._sync_from(logged_in_admin, "2025-02-01", {"last_complete_day": "2025-03-01"})
+        assert cp == {"last_complete_day": "2025-03-20"}
+
+# =====================================================================
+# Integration dedup index tests
+# =====================================================================
+
+class TestSourceIndex:
+    def _setup_integration(self, client):
+        client.post("/api/integrations", json={
+            "platform": "meta_ads", "bolag": "Unithread",
+            "access_token": "x", "ad_account_id": "1",
+        })
+        return mock_db.load_data("integrations")[0]["id"]
+
+    def _stub_adapter(self, expenses):
+        from integrations import MetaAdsAdapter
+        adapter = MagicMock(errors=[], UPSERT_CHANGED=MetaAdsAdapter.UPSERT_CHANGED)
+        adapter.iter_incremental.side_effect = lambda cp: iter([("expenses", e) for e in expenses])
+        adapter.next_checkpoint.return_value = {}
+        return adapter
+
+    def _meta_day(self, amount):
+        return {"datum": "2025-03-10", "kategori": "Marknadsföring", "beskrivning": "Meta Ads",
+                "belopp": amount, "moms_sats": 0, "source": "meta_ads", "source_id": "meta_2025-03-10"}
+
+    def test_index_built_from_sheet(self, isolated_sync_index):
+        mock_db.save_data("expenses", [{"id": "e1", "bolag": "Unithread", "source": "gelato",
+                                        "source_id": "o1", "belopp": 10}])
+        isolated_sync_index.ensure_built(mock_db, "expenses")
+        assert isolated_sync_index.lookup("expenses", "Unithread", "gelato", "o1") == {"row_id": "e1", "belopp": 10.0}
+        assert isolated_sync_index.lookup("expenses", "Unithread", "shopify", "o1") is None
+        assert isolated_sync_index.lookup("expenses", "Merchoteket", "gelato", "o1") is None
+
+    def test_index_without_bolag_is_rebuilt(self, isolated_sync_index):
+        import sqlite3
+        conn = sqlite3.connect(str(isolated_sync_index.path))
+        conn.execute("CREATE TABLE source_rows (sheet TEXT, source TEXT, source_id TEXT, row_id TEXT,"
+                     " belopp REAL, PRIMARY KEY (sheet, source, source_id))")
+        conn.execute("CREATE TABLE built_sheets (sheet TEXT PRIMARY KEY, built_at TEXT)")
+        conn.execute("INSERT INTO source_rows VALUES ('expenses', 'gelato', 'o1', 'e1', 10)")
+        conn.execute("INSERT INTO built_sheets VALUES ('expenses', '2025-01-01 00:00:00')")
+        conn.commit()
+        conn.close()
+        mock_db.save_data("expenses", [{"id": "e1", "bolag": "Unithread", "source": "gelato",
+                                        "source_id": "o1", "belopp": 10}])
+        isolated_sync_index.ensure_built(mock_db, "expenses")
+        assert isolated_sync_index.lookup("expenses", "Unithread", "gelato", "o1") == {"row_id": "e1", "belopp": 10.0}
+
+    def test_same_day_for_two_businesses_is_kept_apart(self):
+        from ingestion import ingest_sync_result
+        ingest_sync_result(mock_db, {"expenses": [self._meta_day(100)]}, "meta_ads", "Unithread",
+                           upsert_changed=True)
+        counts = ingest_sync_result(mock_db, {"expenses": [self._meta_day(40)]}, "meta_ads", "Merchoteket",
+                                    upsert_changed=True)
+        assert counts["added_expenses"] == 1
+        assert counts["updated"] == 0
+        amounts = {r["bolag"]: r["belopp"] for r in mock_db.load_data("expenses")}
+        assert amounts == {"Unithread": 100, "Merchoteket": 40}
+
+    def test_resync_skips_known_rows(self, logged_in_admin):
+        int_id = self._setup_integration(logged_in_admin)
+        with patch("app.create_adapter", return_value=self._stub_adapter([self._meta_day(100)])):
+            first = logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={}).get_json()
+            second = logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={}).get_json()
+        assert first["added_expenses"] == 1
+        assert second["added_expenses"] == 0
+        assert second["skipped"] == 1
+        assert len(mock_db.load_data("expenses")) == 1
+
+    def test_changed_ad_spend_is_upserted(self, logged_in_admin):
+        int_id = self._setup_integration(logged_in_admin)
+        with patch("app.create_adapter", return_value=self._stub_adapter([self._meta_day(100)])):
+            logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={})
+        with patch("app.create_adapter", return_value=self._stub_adapter([self._meta_day(130.5)])):
+            res = logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={}).get_json()
+        assert res["updated"] == 1
+        rows = mock_db.load_data("expenses")
+        assert len(rows) == 1
+        assert rows[0]["belopp"] == 130.5
+
+    def test_upsert_keeps_rows_added_meanwhile(self, logged_in_admin):
+        from ingestion import ingest_sync_result
+        ingest_sync_result(mock_db, {"expenses": [self._meta_day(100)]}, "meta_ads", "Unithread")
+        mock_db.append_row("expenses", {"id": "manuell", "bolag": "Unithread", "belopp": 55})
+        with patch.object(mock_db, "save_data") as save_data:
+            counts = ingest_sync_result(mock_db, {"expenses": [self._meta_day(120)]}, "meta_ads",
+                                        "Unithread", upsert_changed=True)
+        assert counts["updated"] == 1
+        save_data.assert_not_called()
+        assert sorted(r["belopp"] for r in mock_db.load_data("expenses")) == [55, 120]
+
+    def test_deleted_row_can_be_reimported(self, logged_in_admin, isolated_sync_index):
+        int_id = self._setup_integration(logged_in_admin)
+        with patch("app.create_adapter", return_value=self._stub_adapter([self._meta_day(100)])):
+            logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={})
+            eid = mock_db.load_data("expenses")[0]["id"]
+            logged_in_admin.delete(f"/api/expenses/{eid}")
+            assert isolated_sync_index.lookup("expenses", "Unithread", "meta_ads", "meta_2025-03-10") is None
+            res = logged_in_admin.post(f"/api/integrations/{int_id}/sync", json={}).get_json()
+        assert res["added_expenses"] == 1
+
+
+# =====================================================================
+# Ingestion pipeline tests
+# =====================================================================
+
+class TestIngestion:
+    def test_normalizes_and_computes_moms(self):
+        from ingestion import ingest_sync_result
+        result = {"expenses": [{"datum": "2025-03-10", "kategori": "Bank & Avgifter",
+                                "beskrivning": "Avgift", "belopp": "125", "moms_sats": 25,
+                                "source_id": "fee_1"}],
+                  "revenue": [{"datum": "2025-03-10T12:00:00", "belopp": 300, "kund": "Anna",
+                               "source_id": "order_1"}]}
+        counts = ingest_sync_result(mock_db, result, "shopify", "Unithread")
+        assert counts["added_expenses"] == 1
+        assert counts["added_revenue"] == 1
+        exp = mock_db.load_data("expenses")[0]
+        assert exp["moms_belopp"] == 25.0
+        assert exp["leverantor"] == "Shopify"
+        assert mock_db.load_data("revenue")[0]["datum"] == "2025-03-10"
+
+    def test_invalid_and_duplicate_records_counted(self):
+        from ingestion import ingest_sync_result
+        result = {"expenses": [
+            {"datum": "2025-03-10", "belopp": 10, "source_id": "a"},
+            {"datum": "2025-03-10", "belopp": 10, "source_id": "a"},
+            {"datum": "inte-ett-datum", "belopp": 10, "source_id": "b"},
+            {"datum": "2025-03-10", "belopp": -5, "source_id": "c"},
+        ]}
+        counts = ingest_sync_result(mock_db, result, "gelato", "Unithread")
+        assert counts == {"added_expenses": 1, "added_revenue": 0, "updated": 0,
+                          "skipped": 1, "invalid": 2}
+
+    def test_one_bulk_append_per_sheet(self):
+        from ingestion import ingest_sync_result
+        result = {"expenses": [{"datum": "2025-03-%02d" % d, "belopp": d, "source_id": f"d{d}"}
+                               for d in range(1, 11)]}
+        with patch.object(mock_db, "append_rows", wraps=mock_db.append_rows) as bulk, \
+                patch.object(mock_db, "append_row") as single:
+            ingest_sync_result(mock_db, result, "tiktok_ads", "Unithread")
+        assert bulk.call_count == 1
+        single.assert_not_called()
+
+    def test_stream_consumed_in_fixed_chunks(self):
+        from ingestion import ingest_records
+        pulled = []
+
+        def stream():
+            for d in range(1, 8):
+                pulled.append(d)
+                yield "expenses", {"datum": "2025-03-%02d" % d, "belopp": d, "source_id": f"s{d}"}
+
+        with patch.object(mock_db, "append_rows", wraps=mock_db.append_rows) as bulk:
+            counts = ingest_records(mock_db, stream(), "meta_ads", "Unithread", chunk_size=3)
+        assert counts["added_expenses"] == 7
+        assert [len(c.args[1]) for c in bulk.call_args_list] == [3, 3, 1]
+
+    def test_shopify_iter_records_follows_pagination(self):
+        from integrations import ShopifyAdapter
+        adapter = ShopifyAdapter({"shop_domain": "test", "access_token": "x"})
+        page1 = MagicMock(links={"next": {"url": "https://test.myshopify.com/next"}})
+        page1.json.return_value = {"orders": [{"id": 1, "created_at": "2025-03-01T10:00:00",
+                                               "updated_at": "2025-03-01T10:00:00", "total_price": "100"}]}
+        page2 = MagicMock(links={})
+        page2.json.return_value = {"orders": [{"id": 2, "created_at": "2025-03-02T10:00:00",
+                                               "updated_at": "2025-03-02T11:00:00", "total_price": "50"}]}
+        with patch.object(adapter, "_request", side_effect=[page1, page2]) as req:
+            records = list(adapter.iter_records("2025-03-01"))
+        assert req.call_args_list[1].args[1] == "https://test.myshopify.com/next"
+        assert req.call_args_list[1].kwargs["params"] == {"fields": req.call_args_list[0].kwargs["params"]["fields"]}
+        assert [k for k, _ in records] == ["revenue", "revenue", "expenses"]
+        assert adapter.last_order_id == 2
+        assert adapter.last_updated_at == "2025-03-02T11:00:00"
+
+
+# =====================================================================
+# Historical backfill tests
+# =====================================================================
+
+class TestBackfill:
+    def _integration(self):
+        config = {"id": "int_meta", "platform": "meta_ads", "bolag": "Unithread",
+                  "access_token": "x", "ad_account_id": "1"}
+        mock_db.save_data("integrations", [config])
+        return config
+
+    def _adapter_factory(self, fail_on=None):
+        """Adapter stub that returns one expense per requested chunk."""
+        def factory(platform, config):
+            adapter = MagicMock(errors=[], UPSERT_CHANGED=True)
+
+            def iter_records(start, end):
+                if start == fail_on:
+                    raise RuntimeError("timeout")
+                yield "expenses", {"datum": start, "belopp": 10, "source_id": f"meta_{start}"}
+            adapter.iter_records.side_effect = iter_records
+            return adapter
+        return factory
+
+    def test_plan_chunks(self):
+        from backfill import plan_chunks
+        chunks = plan_chunks("2024-01-01", "2024-03-05", 31)
+        assert chunks == [("2024-01-01", "2024-01-31"), ("2024-02-01", "2024-03-02"),
+                          ("2024-03-03", "2024-03-05")]
+
+    def test_chunk_size_per_platform(self, isolated_backfill_store):
+        job = isolated_backfill_store.create_job(
+            {"id": "i", "platform": "tiktok_ads", "bolag": "Unithread"}, "2024-01-01", "2024-01-31")
+        assert job["total_chunks"] == 2
+
+    def test_run_and_resume_after_failure(self, isolated_backfill_store):
+        from backfill import run_job
+        config = self._integration()
+        job = isolated_backfill_store.create_job(config, "2024-01-01", "2024-03-31")
+        with patch("backfill.create_adapter", self._adapter_factory(fail_on="2024-02-01")):
+            job = run_job(mock_db, job["id"], max_workers=2)
+        assert job["status"] == "partial"
+        assert job["done_chunks"] == 2
+        with patch("backfill.create_adapter", self._adapter_factory()):
+            job = run_job(mock_db, job["id"])
+        assert job["status"] == "done"
+        assert job["added_expenses"] == 3
+        assert len(mock_db.load_data("expenses")) == 3
+
+    def test_backfill_route(self, logged_in_admin):
+        self._integration()
+        with patch("backfill.create_adapter", self._adapter_factory()), \
+                patch("app.socketio.start_background_task", side_effect=lambda f, *a: f(*a)):
+            res = logged_in_admin.post("/api/integrations/int_meta/backfill",
+                                       json={"from": "2024-01-01", "to": "2024-01-20"})
+        job_id = res.get_json()["job"]["id"]
+        status = logged_in_admin.get(f"/api/integrations/backfill/{job_id}").get_json()
+        assert status["status"] == "done"
+        assert status["added_expenses"] == 1
+
+    def test_backfill_route_rejects_bad_range(self, logged_in_admin):
+        self._integration()
+        res = logged_in_admin.post("/api/integrations/int_meta/backfill",
+                                   json={"from": "2024-05-01", "to": "2024-01-01"})
+        assert res.status_code == 400
+
 
 # =====================================================================
 # Chat group deletion tests
@@ -1003,7 +2834,8 @@ class TestChatDeletion:
         # Verify group is gone
         res = logged_in_admin.get("/api/chat/groups")
         assert all(g.get("id") != gid for g in res.get_json())
-        # Verify messages are also deleted
+        # Verify messages are also deleted (the group's partition is dropped)
+        assert f"chat_{gid}" not in mock_db._data
         msgs = mock_db.load_data("chat_messages")
         assert all(m.get("group_id") != gid for m in msgs)
 
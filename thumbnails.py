@@ -0,0 +1,169 @@
+"""
+Unithread App — Thumbnails and PDF previews for uploaded files.
+
+Lists show receipts and project files as small JPEG derivatives instead
+of the full-resolution upload: images are scaled down, PDFs are rendered
+from their first page. Derivatives are stored next to the upload, in
+<folder>/thumbs/<name>-<width>.jpg, and since upload names never change
+content (content-addressed, see blob_store.py) they never go stale.
+
+The default widths are rendered by a small background pool as soon as a
+file is uploaded; any other allowed width is rendered on first request.
+Widths are snapped up to WIDTHS so a client cannot fill the disk with
+arbitrary sizes.
+
+Pillow (images) and PyMuPDF (PDFs) are optional dependencies, already
+required by the Streamlit apps; without them no derivative is produced
+and callers fall back to the original file.
+"""
+
+import os
+import uuid
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = ImageOps = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # pragma: no cover - optional dependency
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (160, 320, 640, 1280)
+DEFAULT_WIDTHS = (320,)  # rendered at upload time (list thumbnails)
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", 2))
+JPEG_QUALITY = 80
+IMAGE_TYPES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+MAX_PIXELS = 80_000_000  # refuse decompression bombs
+
+
+def snap_width(width):
+    """The smallest allowed width >= width (the largest for anything bigger)."""
+    for allowed in WIDTHS:
+        if width <= allowed:
+            return allowed
+    return WIDTHS[-1]
+
+
+def thumb_path(folder, name, width):
+    return Path(folder) / "thumbs" / f"{name}-{width}.jpg"
+
+
+def supported(name):
+    """Whether a derivative can be made for this file with the installed libraries."""
+    ext = Path(name).suffix.lower()
+    if ext == ".pdf":
+        return fitz is not None and Image is not None
+    return ext in IMAGE_TYPES and Image is not None
+
+
+def _open_pdf_page(source, width):
+    doc = fitz.open(str(source))
+    try:
+        page = doc[0]
+        zoom = width / max(page.rect.width, 1)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    finally:
+        doc.close()
+
+
+def _open_image(source, width):
+    img = Image.open(source)
+    if img.width * img.height > MAX_PIXELS:
+        raise ValueError("Bilden är för stor för en miniatyr")
+    img.draft("RGB", (width, width * 4))  # JPEG: decode at reduced size
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((width, width * 4))
+    return img.convert("RGB")
+
+
+def render(source, target, width):
+    """Write a JPEG derivative of source, at most width pixels wide, to target."""
+    source = Path(source)
+    if source.suffix.lower() == ".pdf":
+        img = _open_pdf_page(source, width)
+    else:
+        img = _open_image(source, width)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+    try:
+        img.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        os.replace(tmp, target)  # readers never see a half-written file
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return target
+
+
+class Thumbnailer:
+    """Renders derivatives in a background pool; on demand for widths not made yet."""
+
+    def __init__(self, workers=THUMB_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._pending = {}  # derivative path -> Future
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumbs")
+            return self._pool
+
+    def _submit(self, folder, name, width):
+        target = thumb_path(folder, name, width)
+        pool = self._executor()
+        with self._lock:
+            future = self._pending.get(target)
+            if future is None:
+                future = self._pending[target] = pool.submit(self._render, folder, name, width)
+        future.add_done_callback(lambda _: self._forget(target))
+        return future
+
+    def _forget(self, target):
+        with self._lock:
+            self._pending.pop(target, None)
+
+    def _render(self, folder, name, width):
+        target = thumb_path(folder, name, width)
+        if target.exists():
+            return target
+        try:
+            return render(Path(folder) / name, target, width)
+        except Exception as e:
+            logger.warning(f"Could not render thumbnail of {name}: {e}")
+            return None
+
+    def schedule(self, folder, name, widths=DEFAULT_WIDTHS):
+        """Render the default derivatives of a new upload in the background."""
+        if not supported(name):
+            return
+        for width in widths:
+            self._submit(folder, name, width)
+
+    def get(self, folder, name, width):
+        """Path of the derivative (rendering it now if needed), or None if none can be made."""
+        width = snap_width(width)
+        target = thumb_path(folder, name, width)
+        if target.exists():
+            return target
+        if not supported(name) or not (Path(folder) / name).is_file():
+            return None
+        return self._submit(folder, name, width).result()
+
+    def discard(self, folder, name):
+        """Delete the derivatives of a deleted upload."""
+        for width in WIDTHS:
+            thumb_path(folder, name, width).unlink(missing_ok=True)
+
+
+# Singleton
+thumbnailer = Thumbnailer()